@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Enrichment benchmark for ``cdenrichrgenestoterm.py``
+
+Generates synthetic gene set libraries, gene lists and Enrichr
+report files of configurable size and times these cases:
+
+* ``load``: parsing report files with ``load_data_frame_from_outputfiles``
+* ``select``: the filter, sort and select of the best term done by
+  ``get_best_term`` on all rows of the report files
+* ``main_stub``: end to end ``main`` with a stub in place of Enrichr
+  that writes report files just like gseapy does, so no network is used
+* ``main_local``: end to end ``main`` with ``--gmtdir`` pointing at
+  the synthetic libraries compiled to the memory mapped format
+
+Each case runs in a fresh interpreter so its peak RSS is its own.
+Throughput, p50 and p99 latency and peak RSS of every case are
+output as JSON and compared to a stored baseline run with the
+same settings, ``baseline.json`` next to this script. Exits with 1 if
+throughput, p50 latency or peak RSS of any case is more than
+``--tolerance`` worse than the baseline, so it can be used as a
+regression guard. Use ``--savebaseline`` to store a new baseline
+after an intended change or on a new machine.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+import contextlib
+
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'baseline.json')
+
+CASE_KINDS = ['load', 'select', 'main_stub', 'main_local']
+
+REPORT_SUFFIX = '.human.enrichr.reports.txt'
+
+REPORT_HEADER = ['Gene_set', 'Term', 'Overlap', 'P-value',
+                 'Adjusted P-value', 'Old P-value',
+                 'Old Adjusted P-value', 'Odds Ratio',
+                 'Combined Score', 'Genes']
+
+MAX_REPORT_GENES = 50
+
+
+def _parse_arguments(desc, args):
+    parser = argparse.ArgumentParser(description=desc,
+                                     formatter_class=argparse.
+                                     RawDescriptionHelpFormatter)
+    parser.add_argument('--genecounts', default='10,500,5000',
+                        help='Comma delimited sizes of gene lists')
+    parser.add_argument('--librarycounts', default='1,20',
+                        help='Comma delimited numbers of libraries')
+    parser.add_argument('--terms', type=int, default=2000,
+                        help='Number of terms in each library')
+    parser.add_argument('--universe', type=int, default=20000,
+                        help='Number of distinct genes in libraries')
+    parser.add_argument('--cases', default=','.join(CASE_KINDS),
+                        help='Comma delimited cases to run')
+    parser.add_argument('--runs', type=int, default=10,
+                        help='Number of timed runs of each case, after '
+                             'one untimed warm up run')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='Seed for synthetic data')
+    parser.add_argument('--baseline', default=BASELINE_FILE,
+                        help='Baseline JSON file to compare to, '
+                             'ignored if it does not exist')
+    parser.add_argument('--savebaseline', action='store_true',
+                        help='Write results to --baseline instead '
+                             'of comparing to it')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed fraction a metric can be worse '
+                             'than the baseline')
+    parser.add_argument('--runcase',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--workdir',
+                        help=argparse.SUPPRESS)
+    return parser.parse_args(args)
+
+
+def _get_ints(val):
+    return [int(x) for x in val.split(',') if len(x.strip()) > 0]
+
+
+def get_library_names(num_libraries):
+    """
+    Gets names of the first `num_libraries` synthetic libraries
+    """
+    return ['Synthetic_' + str(x) for x in range(num_libraries)]
+
+
+def get_universe(num_genes):
+    """
+    Gets `num_genes` synthetic gene symbols
+    """
+    return ['GENE' + str(x) for x in range(num_genes)]
+
+
+def write_libraries(gmtdir, num_libraries, num_terms, universe, rand):
+    """
+    Writes `num_libraries` GMT files of `num_terms` terms, each
+    with 5 to 500 genes drawn from `universe`, to `gmtdir` and
+    compiles them
+    """
+    from cdenrichrgenestoterm import compiledlibrary
+    os.makedirs(gmtdir)
+    for library in get_library_names(num_libraries):
+        with open(os.path.join(gmtdir, library + '.gmt'), 'w') as f:
+            for term in range(num_terms):
+                genes = rand.sample(universe, rand.randint(5, 500))
+                f.write(library + '_term' + str(term) + '\t\t' +
+                        '\t'.join(genes) + '\n')
+        compiledlibrary.compile_library(gmtdir, library)
+
+
+def write_reports(reportdir, num_libraries, num_terms, genes, rand):
+    """
+    Writes a report file like the ones gseapy writes for each of
+    `num_libraries` to `reportdir`, with `num_terms` rows of
+    random P-values and genes drawn from `genes`
+    """
+    os.makedirs(reportdir)
+    for library in get_library_names(num_libraries):
+        path = os.path.join(reportdir, library + REPORT_SUFFIX)
+        with open(path, 'w') as f:
+            f.write('\t'.join(REPORT_HEADER) + '\n')
+            for term in range(num_terms):
+                hits = rand.sample(genes, rand.randint(
+                    1, min(len(genes), MAX_REPORT_GENES)))
+                pval = rand.random() ** 4
+                f.write('\t'.join([library, library + '_term' + str(term),
+                                   str(len(hits)) + '/' +
+                                   str(rand.randint(len(hits), 500)),
+                                   repr(pval), repr(min(1.0, pval * 20)),
+                                   '0', '0', '1.0', '1.0',
+                                   ';'.join(hits)]) + '\n')
+
+
+def _link_reports(srcdir, destdir, num_libraries):
+    os.makedirs(destdir)
+    for library in get_library_names(num_libraries):
+        name = library + REPORT_SUFFIX
+        try:
+            os.symlink(os.path.join(srcdir, name),
+                       os.path.join(destdir, name))
+        except OSError:
+            shutil.copy(os.path.join(srcdir, name), destdir)
+
+
+def make_workload(workdir, theargs):
+    """
+    Writes synthetic libraries, gene lists and report files for
+    the sizes in `theargs` to `workdir`
+    """
+    rand = random.Random(theargs.seed)
+    universe = get_universe(theargs.universe)
+    library_counts = _get_ints(theargs.librarycounts)
+    max_libraries = max(library_counts)
+    write_libraries(os.path.join(workdir, 'gmt'), max_libraries,
+                    theargs.terms, universe, rand)
+    for num_genes in _get_ints(theargs.genecounts):
+        genes = rand.sample(universe, min(num_genes, len(universe)))
+        genedir = os.path.join(workdir, 'g' + str(num_genes))
+        os.makedirs(genedir)
+        with open(os.path.join(genedir, 'genes.txt'), 'w') as f:
+            f.write(','.join(genes))
+        alldir = os.path.join(genedir, 'all')
+        write_reports(alldir, max_libraries, theargs.terms, genes, rand)
+        for num_libraries in library_counts:
+            _link_reports(alldir, os.path.join(genedir, 'l' +
+                                               str(num_libraries)),
+                          num_libraries)
+
+
+def get_cases(theargs):
+    """
+    Gets case names for `theargs`, each of form
+    ``<kind>/genes=<count>/libraries=<count>``
+    """
+    res = []
+    for kind in theargs.cases.split(','):
+        for num_genes in _get_ints(theargs.genecounts):
+            for num_libraries in _get_ints(theargs.librarycounts):
+                res.append(kind + '/genes=' + str(num_genes) +
+                           '/libraries=' + str(num_libraries))
+    return res
+
+
+def _parse_case(case):
+    fields = case.split('/')
+    return (fields[0], int(fields[1].split('=')[1]),
+            int(fields[2].split('=')[1]))
+
+
+class StubEnrichr(object):
+    """
+    Stands in for gseapy, writing canned report files for the
+    requested libraries to the output directory
+    """
+    def __init__(self, reportdir):
+        self._reportdir = reportdir
+
+    def enrichr(self, gene_list=None, gene_sets=None, cutoff=0.05,
+                no_plot=True, outdir=None):
+        for library in gene_sets.split(','):
+            shutil.copy(os.path.join(self._reportdir,
+                                     library + REPORT_SUFFIX), outdir)
+        return None
+
+
+def _get_peak_rss_mb():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+
+def get_case_function(case, workdir):
+    """
+    Sets up `case` and gets a function that runs it once
+    """
+    from cdenrichrgenestoterm import cdenrichrgenestoterm
+    kind, num_genes, num_libraries = _parse_case(case)
+    genedir = os.path.join(workdir, 'g' + str(num_genes))
+    genes_file = os.path.join(genedir, 'genes.txt')
+    reportdir = os.path.join(genedir, 'l' + str(num_libraries))
+    genesets = ','.join(get_library_names(num_libraries))
+    with open(genes_file, 'r') as f:
+        genes = cdenrichrgenestoterm.parse_genes(f.read())
+
+    if kind == 'load':
+        return lambda: cdenrichrgenestoterm.\
+            load_data_frame_from_outputfiles(outdir=reportdir, keep=1)
+    if kind == 'select':
+        df_result = cdenrichrgenestoterm.load_data_frame_from_outputfiles(
+            outdir=reportdir)
+        theargs = cdenrichrgenestoterm._parse_arguments('', [genes_file])
+        return lambda: cdenrichrgenestoterm.get_best_term(df_result,
+                                                          genes, theargs)
+    args = ['cdenrichrgenestoterm.py', genes_file, '--genesets', genesets]
+    if kind == 'main_stub':
+        stub = StubEnrichr(os.path.join(genedir, 'all'))
+        cdenrichrgenestoterm.get_enrichr = lambda theargs: stub
+        tmpdir = os.path.join(workdir, 'tmp')
+        os.makedirs(tmpdir, exist_ok=True)
+        args.extend(['--tmpdir', tmpdir])
+    elif kind == 'main_local':
+        args.extend(['--gmtdir', os.path.join(workdir, 'gmt')])
+    else:
+        raise ValueError('Unknown case ' + case)
+
+    def run_main():
+        with open(os.devnull, 'w') as devnull:
+            with contextlib.redirect_stdout(devnull), \
+                    contextlib.redirect_stderr(devnull):
+                if cdenrichrgenestoterm.main(args) != 0:
+                    raise RuntimeError('main failed for ' + case)
+    return run_main
+
+
+def _get_percentile(sorted_vals, percent):
+    idx = int(round(percent / 100.0 * (len(sorted_vals) - 1)))
+    return sorted_vals[idx]
+
+
+def run_case(case, workdir, runs):
+    """
+    Runs `case` once untimed and then `runs` times
+
+    :return: metrics of case
+    :rtype: dict
+    """
+    func = get_case_function(case, workdir)
+    func()
+    times = []
+    for i in range(max(runs, 1)):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return {'runs': len(times),
+            'throughput_per_s': round(len(times) / sum(times), 2),
+            'p50_ms': round(_get_percentile(times, 50) * 1000.0, 3),
+            'p99_ms': round(_get_percentile(times, 99) * 1000.0, 3),
+            'peak_rss_mb': round(_get_peak_rss_mb(), 1)}
+
+
+def run_case_in_subprocess(case, workdir, runs):
+    """
+    Runs `case` in a fresh interpreter via ``--runcase``
+    """
+    cmd = [sys.executable, os.path.abspath(__file__), '--runcase', case,
+           '--workdir', workdir, '--runs', str(runs)]
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    if proc.returncode != 0:
+        raise RuntimeError(case + ' failed: ' + proc.stderr)
+    return json.loads(proc.stdout)
+
+
+def get_config(theargs):
+    """
+    Gets settings that change the results
+    """
+    return {x: getattr(theargs, x) for x in ['genecounts', 'librarycounts',
+                                             'terms', 'universe', 'runs',
+                                             'seed']}
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    Compares `results` to `baseline` results for cases in both,
+    both must have been run with the same settings
+
+    :return: descriptions of metrics more than `tolerance` worse
+    :rtype: list
+    """
+    regressions = []
+    for case, metrics in results.items():
+        base = baseline.get(case)
+        if base is None:
+            continue
+        for name in ['p50_ms', 'peak_rss_mb']:
+            if metrics[name] > base[name] * (1.0 + tolerance):
+                regressions.append(case + ' ' + name + ' ' +
+                                   str(metrics[name]) + ' > baseline ' +
+                                   str(base[name]))
+        if metrics['throughput_per_s'] * (1.0 + tolerance) < \
+                base['throughput_per_s']:
+            regressions.append(case + ' throughput_per_s ' +
+                               str(metrics['throughput_per_s']) +
+                               ' < baseline ' +
+                               str(base['throughput_per_s']))
+    return regressions
+
+
+def main(args):
+    theargs = _parse_arguments(__doc__, args[1:])
+    if theargs.runcase is not None:
+        json.dump(run_case(theargs.runcase, theargs.workdir, theargs.runs),
+                  sys.stdout)
+        return 0
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+        make_workload(temp_dir, theargs)
+        results = {}
+        for case in get_cases(theargs):
+            results[case] = run_case_in_subprocess(case, temp_dir,
+                                                   theargs.runs)
+    finally:
+        shutil.rmtree(temp_dir)
+
+    report = {'config': get_config(theargs), 'results': results}
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+    if theargs.savebaseline is True:
+        with open(theargs.baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+        return 0
+    if not os.path.isfile(theargs.baseline):
+        return 0
+    with open(theargs.baseline, 'r') as f:
+        baseline = json.load(f)
+    if baseline.get('config') != report['config']:
+        sys.stderr.write('Settings differ from baseline so results '
+                         'were not compared\n')
+        return 0
+    regressions = compare_to_baseline(results, baseline['results'],
+                                      theargs.tolerance)
+    for regression in regressions:
+        sys.stderr.write('REGRESSION: ' + regression + '\n')
+    if len(regressions) > 0:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main(sys.argv))
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Start up benchmark for ``cdenrichrgenestoterm.py``
+
+Runs the command line tool in fresh interpreters for the
+invocations that should never import heavy dependencies,
+namely ``--help``, empty input and a cache hit, and reports
+wall time along with the slowest imports as reported by
+``python -X importtime``. Exits with 1 if the median wall time
+of any invocation is over ``--maxms`` or any of
+``--heavymodules`` was imported, so it can be used as a
+regression guard.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+
+HEAVY_MODULES = 'pandas,numpy,scipy,gseapy,requests,matplotlib'
+
+
+def _parse_arguments(desc, args):
+    parser = argparse.ArgumentParser(description=desc,
+                                     formatter_class=argparse.
+                                     ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5,
+                        help='Number of times to run each invocation')
+    parser.add_argument('--maxms', type=float, default=250.0,
+                        help='Max median wall time in milliseconds '
+                             'of each invocation')
+    parser.add_argument('--heavymodules', default=HEAVY_MODULES,
+                        help='Comma delimited top level modules that '
+                             'must not be imported')
+    parser.add_argument('--top', type=int, default=5,
+                        help='Number of slowest imports to report')
+    return parser.parse_args(args)
+
+
+def parse_importtime(stderr):
+    """
+    Parses output of ``python -X importtime``
+
+    :param stderr: standard error of the process
+    :type stderr: str
+    :return: list of (cumulative microseconds, module name) tuples
+    :rtype: list
+    """
+    res = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3:
+            continue
+        try:
+            res.append((int(fields[1]), fields[2].strip()))
+        except ValueError:
+            continue
+    return res
+
+
+def run_invocation(args):
+    """
+    Runs the command line tool with `args` in a fresh interpreter
+
+    :return: (wall time in milliseconds, importtime records)
+    :rtype: tuple
+    """
+    code = 'import sys; from cdenrichrgenestoterm import ' \
+           'cdenrichrgenestoterm as c; sys.exit(c.main(sys.argv))'
+    cmd = [sys.executable, '-X', 'importtime', '-c', code] + args
+    start = time.perf_counter()
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE,
+                          universal_newlines=True)
+    elapsed = (time.perf_counter() - start) * 1000.0
+    return elapsed, parse_importtime(proc.stderr)
+
+
+def get_invocations(temp_dir):
+    """
+    Creates inputs and gets invocations to benchmark
+
+    :return: list of (name, args) tuples
+    :rtype: list
+    """
+    from cdenrichrgenestoterm import cdenrichrgenestoterm
+    from cdenrichrgenestoterm.resultcache import ResultCache
+    empty_file = os.path.join(temp_dir, 'empty.txt')
+    open(empty_file, 'a').close()
+    genes_file = os.path.join(temp_dir, 'genes.txt')
+    with open(genes_file, 'w') as f:
+        f.write('A,B,C')
+    cachedir = os.path.join(temp_dir, 'cache')
+    theargs = cdenrichrgenestoterm._parse_arguments('', [genes_file,
+                                                         '--cachedir',
+                                                         cachedir])
+    key = cdenrichrgenestoterm.get_cache_key(['A', 'B', 'C'], theargs)
+    ResultCache(cachedir).store(key, {'name': 'cached'})
+    return [('help', ['--help']),
+            ('empty input', [empty_file]),
+            ('cache hit', [genes_file, '--cachedir', cachedir])]
+
+
+def main(args):
+    theargs = _parse_arguments(__doc__, args[1:])
+    heavy = set(theargs.heavymodules.split(','))
+    temp_dir = tempfile.mkdtemp()
+    failed = False
+    report = {}
+    try:
+        for name, inv_args in get_invocations(temp_dir):
+            times = []
+            imports = []
+            for i in range(theargs.runs):
+                elapsed, imports = run_invocation(inv_args)
+                times.append(elapsed)
+            median = statistics.median(times)
+            slowest = sorted(imports, reverse=True)
+            heavy_found = sorted(set(x[1].split('.')[0] for x in imports)
+                                 & heavy)
+            report[name] = {'median_ms': round(median, 1),
+                            'min_ms': round(min(times), 1),
+                            'heavy_imports': heavy_found,
+                            'slowest_imports': [[x[1], round(x[0] / 1000.0,
+                                                             1)]
+                                                for x in
+                                                slowest[:theargs.top]]}
+            if median > theargs.maxms or len(heavy_found) > 0:
+                failed = True
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    finally:
+        shutil.rmtree(temp_dir)
+    if failed:
+        return 1
+    return 0
+
+
+if __name__ == '__main__':  # pragma: no cover
+    sys.exit(main(sys.argv))
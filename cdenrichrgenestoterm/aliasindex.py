@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import csv
+import argparse
+import numpy
+
+from cdenrichrgenestoterm.compiledlibrary import FixedWidthStringTable
+from cdenrichrgenestoterm.compiledlibrary import write_array_file
+from cdenrichrgenestoterm.compiledlibrary import load_array_file
+
+
+ALIAS_INDEX_SUFFIX = '.aidx'
+"""
+Suffix of alias index files
+"""
+
+MAGIC = b'CDALIX\x00\x01'
+"""
+First bytes of an alias index file, last byte is the format version
+"""
+
+SYMBOL_COLUMNS = ('symbol', 'Approved symbol')
+"""
+Names of the approved symbol column in an HGNC file, the first
+is used in the HGNC complete set and the second in custom downloads
+"""
+
+PREVIOUS_COLUMNS = ('prev_symbol', 'Previous symbols')
+"""
+Names of the previous symbols column in an HGNC file
+"""
+
+ALIAS_COLUMNS = ('alias_symbol', 'Alias symbols')
+"""
+Names of the alias symbols column in an HGNC file
+"""
+
+
+def _get_column(header, names):
+    for name in names:
+        if name in header:
+            return header.index(name)
+    return None
+
+
+def _split_symbols(value):
+    """
+    Splits field of several symbols, which are ``|`` delimited in
+    the HGNC complete set and ``,`` delimited in custom downloads
+    """
+    value = value.strip().strip('"')
+    if len(value) == 0:
+        return []
+    return [x.strip().upper() for x in value.replace('|', ',').split(',')
+            if len(x.strip()) > 0]
+
+
+def read_hgnc_file(hgncfile):
+    """
+    Reads tab delimited HGNC style `hgncfile` with a header line
+    naming an approved symbol column and, optionally, previous and
+    alias symbols columns (see :py:const:`SYMBOL_COLUMNS`,
+    :py:const:`PREVIOUS_COLUMNS` and :py:const:`ALIAS_COLUMNS`).
+
+    Every approved symbol maps to itself. Otherwise a previous
+    symbol wins over an alias and a symbol that maps to more than
+    one approved symbol at its best rank is left out since it
+    cannot be resolved safely
+
+    :param hgncfile: path to file
+    :type hgncfile: str
+    :raises ValueError: if there is no approved symbol column
+    :return: upper case symbol => upper case approved symbol
+    :rtype: dict
+    """
+    candidates = {}
+    with open(hgncfile, 'r', newline='') as f:
+        reader = csv.reader(f, delimiter='\t')
+        header = next(reader, [])
+        symbol_col = _get_column(header, SYMBOL_COLUMNS)
+        if symbol_col is None:
+            raise ValueError(hgncfile + ' has no approved symbol column')
+        other_cols = [(1, _get_column(header, PREVIOUS_COLUMNS)),
+                      (2, _get_column(header, ALIAS_COLUMNS))]
+        for row in reader:
+            if len(row) <= symbol_col:
+                continue
+            symbol = row[symbol_col].strip().upper()
+            if len(symbol) == 0:
+                continue
+            found = [(0, symbol)]
+            for rank, col in other_cols:
+                if col is not None and col < len(row):
+                    found.extend([(rank, x) for x in
+                                  _split_symbols(row[col])])
+            for rank, key in found:
+                cur = candidates.get(key)
+                if cur is None or rank < cur[0]:
+                    candidates[key] = (rank, {symbol})
+                elif rank == cur[0]:
+                    cur[1].add(symbol)
+    return {key: next(iter(symbols))
+            for key, (rank, symbols) in candidates.items()
+            if len(symbols) == 1}
+
+
+class AliasIndex(object):
+    """
+    Read only map of gene symbols, including previous and alias
+    symbols, to approved symbols. Symbols are kept in a sorted
+    fixed width array so a whole gene list is resolved with one
+    vectorized binary search, and when loaded from a file written
+    by :py:func:`write_alias_index` the arrays are memory mapped
+    so loading costs nothing and processes share the pages
+    """
+    def __init__(self, keys, targets, symbols):
+        """
+        Constructor
+
+        :param keys: sorted upper case symbols
+        :type keys: :py:class:`numpy.ndarray` with ``S`` dtype
+        :param targets: index into `symbols` of approved symbol
+                        for each of `keys`
+        :type targets: :py:class:`numpy.ndarray`
+        :param symbols: approved symbols
+        :type symbols: :py:class:`~cdenrichrgenestoterm.compiledlibrary.FixedWidthStringTable`
+        """
+        self._keys = keys
+        self._targets = targets
+        self._symbols = symbols
+
+    def __len__(self):
+        return len(self._keys)
+
+    @staticmethod
+    def from_dict(aliases):
+        """
+        Creates index from `aliases`
+
+        :param aliases: upper case symbol => upper case approved symbol
+                        as returned by :py:func:`read_hgnc_file`
+        :type aliases: dict
+        :return: index
+        :rtype: :py:class:`AliasIndex`
+        """
+        keys = sorted(x.encode('utf-8') for x in aliases.keys())
+        symbols = sorted(set(aliases.values()))
+        symbol_ids = {x: idx for idx, x in enumerate(symbols)}
+        symbol_bytes = [x.encode('utf-8') for x in symbols]
+        key_width = max([len(x) for x in keys] + [1])
+        symbol_width = max([len(x) for x in symbol_bytes] + [1])
+        targets = numpy.array([symbol_ids[aliases[x.decode('utf-8')]]
+                               for x in keys], dtype='<i4')
+        return AliasIndex(numpy.array(keys, dtype='S' + str(key_width)),
+                          targets,
+                          FixedWidthStringTable(
+                              numpy.array(symbol_bytes,
+                                          dtype='S' + str(symbol_width))))
+
+    def resolve(self, genes):
+        """
+        Gets approved symbol for each of `genes`
+
+        :param genes: upper case gene symbols
+        :type genes: list
+        :return: approved symbol, or ``None`` if not in index, for
+                 each of `genes` in the same order
+        :rtype: list
+        """
+        res = [None] * len(genes)
+        if len(genes) == 0 or len(self._keys) == 0:
+            return res
+        width = self._keys.dtype.itemsize
+        encoded = [x.encode('utf-8') for x in genes]
+        # longer symbols cannot be in index and would be truncated
+        positions = [idx for idx, x in enumerate(encoded)
+                     if len(x) <= width]
+        if len(positions) == 0:
+            return res
+        query = numpy.array([encoded[idx] for idx in positions],
+                            dtype=self._keys.dtype)
+        pos = numpy.minimum(numpy.searchsorted(self._keys, query),
+                            len(self._keys) - 1)
+        found = self._keys[pos] == query
+        for idx, key_pos, is_found in zip(positions, pos.tolist(),
+                                          found.tolist()):
+            if is_found:
+                res[idx] = self._symbols[int(self._targets[key_pos])]
+        return res
+
+    def get_arrays(self):
+        """
+        Gets arrays to store, see :py:func:`write_alias_index`
+
+        :return: name => array
+        :rtype: dict
+        """
+        return {'keys': self._keys, 'targets': self._targets,
+                'symbols': self._symbols.array}
+
+
+def write_alias_index(index, path):
+    """
+    Writes `index` to `path` in the memory mappable format of
+    :py:func:`~cdenrichrgenestoterm.compiledlibrary.write_array_file`
+
+    :param index: index to write
+    :type index: :py:class:`AliasIndex`
+    :param path: path to write to
+    :type path: str
+    :return: None
+    """
+    write_array_file(path, MAGIC, {'num_keys': len(index)},
+                     index.get_arrays())
+
+
+def load_alias_index(path):
+    """
+    Memory maps alias index file at `path`
+
+    :param path: path to file written by :py:func:`write_alias_index`
+    :type path: str
+    :raises ValueError: if `path` is not an alias index file
+    :return: index
+    :rtype: :py:class:`AliasIndex`
+    """
+    try:
+        header, arrays = load_array_file(path, MAGIC)
+    except ValueError:
+        raise ValueError(path + ' is not a gene alias index')
+    return AliasIndex(arrays['keys'], arrays['targets'],
+                      FixedWidthStringTable(arrays['symbols']))
+
+
+def build_alias_index(hgncfile, path):
+    """
+    Builds alias index from HGNC style `hgncfile` and writes
+    it to `path`
+
+    :param hgncfile: see :py:func:`read_hgnc_file`
+    :type hgncfile: str
+    :param path: path to write to
+    :type path: str
+    :return: number of symbols in index
+    :rtype: int
+    """
+    index = AliasIndex.from_dict(read_hgnc_file(hgncfile))
+    write_alias_index(index, path)
+    return len(index)
+
+
+class Formatter(argparse.ArgumentDefaultsHelpFormatter,
+                argparse.RawDescriptionHelpFormatter):
+    pass
+
+
+def _parse_arguments(desc, args):
+    """
+    Parses command line arguments
+    :param desc:
+    :param args:
+    :return:
+    """
+    help_fm = Formatter
+    parser = argparse.ArgumentParser(description=desc,
+                                     formatter_class=help_fm)
+    parser.add_argument('hgncfile',
+                        help='Tab delimited HGNC file such as '
+                             'hgnc_complete_set.txt')
+    parser.add_argument('outfile',
+                        help='Alias index file to write, should end '
+                             'with ' + ALIAS_INDEX_SUFFIX)
+    return parser.parse_args(args)
+
+
+def main(args):
+    """
+    Main entry point for aliases command
+
+    :param args: command line arguments with first argument being
+                 :py:const:`~cdenrichrgenestoterm.cdenrichrgenestoterm.ALIASES_COMMAND`
+    :return: 0 for success otherwise failure
+    :rtype: int
+    """
+    desc = """
+        Builds a gene alias index from a tab delimited HGNC file
+        with a header line naming the approved symbol column
+        (symbol or Approved symbol) and, optionally, previous
+        (prev_symbol or Previous symbols) and alias (alias_symbol
+        or Alias symbols) symbols columns.
+
+        Pass the index to the command line tool or server with
+        --aliasindex to map previous and alias symbols in queries
+        to approved symbols and drop unknown symbols before
+        enrichment. The index is memory mapped, not parsed, when
+        loaded.
+    """
+    theargs = _parse_arguments(desc, args[1:])
+    try:
+        count = build_alias_index(theargs.hgncfile, theargs.outfile)
+        sys.stderr.write('Wrote ' + str(count) + ' symbols to ' +
+                         theargs.outfile + '\n')
+        return 0
+    except Exception as e:
+        sys.stderr.write('Caught exception: ' + str(e))
+        return 2
+    finally:
+        sys.stderr.flush()
@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import weakref
+import asyncio
+import argparse
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cdenrichrgenestoterm import cdenrichrgenestoterm
+from cdenrichrgenestoterm import metrics
+from cdenrichrgenestoterm.singleflight import AsyncSingleFlight
+from cdenrichrgenestoterm import enrichrclient
+from cdenrichrgenestoterm.enrichrclient import ENRICHR_URL
+from cdenrichrgenestoterm.enrichrclient import DEFAULT_POOL_SIZE
+from cdenrichrgenestoterm.enrichrclient import EnrichrClient
+from cdenrichrgenestoterm.enrichrclient import read_export_report
+
+MAX_THREADS = 32
+"""
+Max number of threads, shared by every event loop, that make
+blocking requests to Enrichr and parse their results
+"""
+
+
+class EnrichmentOptions(object):
+    """
+    Options of an enrichment query made with :py:func:`enrich_genes`.
+    Each option matches the command line flag of the same name and
+    is checked when set so a bad value fails at construction
+    instead of midway through a query
+    """
+    _TYPES = {'genesets': (str,),
+              'maxpval': (int, float),
+              'topk': (int,),
+              'allterms': (bool,),
+              'offset': (int,),
+              'limit': (int, type(None)),
+              'gmtdir': (str, type(None)),
+              'librarydir': (str, type(None)),
+              'libraryversion': (str, type(None)),
+              'aliasindex': (str, type(None)),
+              'url': (str,),
+              'concurrency': (int,),
+              'retries': (int,),
+              'retrybackoff': (int, float),
+              'retrymaxbackoff': (int, float),
+              'timeout': (int, float, type(None)),
+              'deadline': (int, float, type(None)),
+              'correction': (str,)}
+
+    def __init__(self, genesets=cdenrichrgenestoterm.DEFAULT_GENESETS,
+                 maxpval=0.05, topk=1, allterms=False, offset=0,
+                 limit=None, gmtdir=None, librarydir=None,
+                 libraryversion=None, aliasindex=None, url=ENRICHR_URL,
+                 concurrency=4, retries=2, retrybackoff=1.0,
+                 retrymaxbackoff=30.0, timeout=120.0, deadline=300.0,
+                 correction=cdenrichrgenestoterm.CORRECTION_LIBRARY):
+        """
+        Constructor
+
+        :param genesets: comma delimited gene set libraries
+        :type genesets: str
+        :param maxpval: max Adjusted P-value of a term
+        :type maxpval: float
+        :param topk: number of best terms to return, a list is
+                     returned if greater then 1
+        :type topk: int
+        :param allterms: if ``True`` return list of every term under
+                         `maxpval`, paged with `offset` and `limit`
+        :type allterms: bool
+        :param offset: number of terms to skip with `allterms`
+        :type offset: int
+        :param limit: max number of terms with `allterms`
+        :type limit: int
+        :param gmtdir: if set, enrich locally against
+                       ``<gene set>.gmt`` files in this directory
+        :type gmtdir: str
+        :param librarydir: if set, enrich locally against a library
+                           snapshot in this directory
+        :type librarydir: str
+        :param libraryversion: library snapshot to use with `librarydir`
+        :type libraryversion: str
+        :param aliasindex: alias index to normalize genes with
+        :type aliasindex: str
+        :param url: base URL of Enrichr, or a service with the same
+                    API, used if neither `gmtdir` nor `librarydir`
+                    is set
+        :type url: str
+        :param concurrency: max number of libraries queried at once
+        :type concurrency: int
+        :param retries: max number of tries of each library
+        :type retries: int
+        :param retrybackoff: base delay in seconds between tries
+        :type retrybackoff: float
+        :param retrymaxbackoff: max delay in seconds between tries
+        :type retrymaxbackoff: float
+        :param timeout: max seconds for a single try, ``None`` for no limit
+        :type timeout: float
+        :param deadline: max seconds for all tries of a library,
+                         ``None`` for no limit
+        :type deadline: float
+        :param correction: multiple testing correction, one of
+                           :py:const:`~cdenrichrgenestoterm.cdenrichrgenestoterm.CORRECTIONS`
+        :type correction: str
+        :raises TypeError: if an option has the wrong type
+        :raises ValueError: if an option has an invalid value
+        """
+        self.genesets = genesets
+        self.maxpval = maxpval
+        self.topk = topk
+        self.allterms = allterms
+        self.offset = offset
+        self.limit = limit
+        self.gmtdir = gmtdir
+        self.librarydir = librarydir
+        self.libraryversion = libraryversion
+        self.aliasindex = aliasindex
+        self.url = url
+        self.concurrency = concurrency
+        self.retries = retries
+        self.retrybackoff = retrybackoff
+        self.retrymaxbackoff = retrymaxbackoff
+        self.timeout = timeout
+        self.deadline = deadline
+        self.correction = correction
+
+    def __setattr__(self, name, value):
+        types = EnrichmentOptions._TYPES.get(name)
+        if types is None:
+            raise AttributeError('Unknown option ' + name)
+        # bool is an int so it is only allowed where asked for
+        if not isinstance(value, types) or \
+                (isinstance(value, bool) and bool not in types):
+            raise TypeError(name + ' must be of type ' +
+                            ' or '.join(t.__name__ for t in types) +
+                            ' not ' + type(value).__name__)
+        if name == 'genesets' and \
+                len(cdenrichrgenestoterm.get_libraries(value)) == 0:
+            raise ValueError('genesets must name at least one library')
+        if name in ('topk', 'retries', 'concurrency') and value < 1:
+            raise ValueError(name + ' must be at least 1')
+        if name in ('offset', 'limit') and value is not None and value < 0:
+            raise ValueError(name + ' must not be negative')
+        if name == 'correction' and \
+                value not in cdenrichrgenestoterm.CORRECTIONS:
+            raise ValueError('correction must be one of ' +
+                             ', '.join(cdenrichrgenestoterm.CORRECTIONS))
+        object.__setattr__(self, name, value)
+
+    def to_args(self):
+        """
+        Gets these options as parsed command line arguments
+
+        :return: arguments
+        :rtype: :py:class:`argparse.Namespace`
+        """
+        parser = argparse.ArgumentParser()
+        cdenrichrgenestoterm.add_enrichment_arguments(parser)
+        theargs = parser.parse_args([])
+        for name in EnrichmentOptions._TYPES:
+            setattr(theargs, name, getattr(self, name))
+        return theargs
+
+
+_EXECUTOR = None
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def _get_executor():
+    """
+    Gets thread pool that runs blocking requests and parsing. It
+    is not the default executor of any loop so a request left to
+    finish after its caller was cancelled does not hold up the
+    loop closing
+    """
+    global _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None:
+            _EXECUTOR = ThreadPoolExecutor(max_workers=MAX_THREADS,
+                                           thread_name_prefix='enrichr')
+        return _EXECUTOR
+
+
+async def _run_in_executor(func, *args, **kwargs):
+    """
+    Runs `func` in :py:func:`_get_executor` without blocking the
+    running loop
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(),
+                                      functools.partial(func, *args,
+                                                        **kwargs))
+
+
+class AsyncEnrichrClient(object):
+    """
+    Coroutine interface to the Enrichr HTTP API so any number of
+    queries can be in flight on one event loop. Requests are made
+    with a pooled
+    :py:class:`~cdenrichrgenestoterm.enrichrclient.EnrichrClient`,
+    reusing its keep-alive connections, in a shared thread pool.
+    Cancelling a request stops waiting for it at once while the
+    request itself is left to finish, or to hit its `timeout`, in
+    its thread
+    """
+    def __init__(self, url=ENRICHR_URL, rate_limiter=None,
+                 pool_size=DEFAULT_POOL_SIZE, client=None):
+        """
+        Constructor
+
+        :param url: base URL of Enrichr or a service with the same API
+        :type url: str
+        :param rate_limiter: limiter each request must get a token
+                             from, can be shared with clients in other
+                             threads, if ``None`` requests are not
+                             limited
+        :type rate_limiter: :py:class:`~cdenrichrgenestoterm.enrichrclient.TokenBucket`
+        :param pool_size: max number of connections kept open
+        :type pool_size: int
+        :param client: client to make requests with, if set `url`,
+                       `rate_limiter` and `pool_size` are ignored
+        :type client: :py:class:`~cdenrichrgenestoterm.enrichrclient.EnrichrClient`
+        """
+        if client is None:
+            client = EnrichrClient(url=url, pool_size=pool_size,
+                                   rate_limiter=rate_limiter)
+        self._client = client
+
+    async def add_list(self, genes, description='cdenrichrgenestoterm',
+                       timeout=None):
+        """
+        Uploads `genes` to Enrichr
+
+        :param genes: genes
+        :type genes: list
+        :param description: description of list
+        :type description: str
+        :param timeout: max seconds to connect or wait for data
+        :type timeout: float
+        :return: id of list to pass to :py:meth:`export`
+        :rtype: int
+        """
+        return await _run_in_executor(self._client.add_list, genes,
+                                      description=description,
+                                      timeout=timeout)
+
+    async def export(self, user_list_id, library, timeout=None):
+        """
+        Gets enrichment results of list `user_list_id` against
+        `library` in the tab delimited format of a gseapy report file
+
+        :param user_list_id: id from :py:meth:`add_list`
+        :type user_list_id: int
+        :param library: name of gene set library
+        :type library: str
+        :param timeout: max seconds to connect or wait for data
+        :type timeout: float
+        :return: results
+        :rtype: str
+        """
+        return await _run_in_executor(self._client.export, user_list_id,
+                                      library, timeout=timeout)
+
+
+_LOCAL_ENGINES = {}
+_LOCAL_ENGINES_LOCK = threading.Lock()
+
+_SINGLE_FLIGHTS = weakref.WeakKeyDictionary()
+"""
+Event loop => :py:class:`~cdenrichrgenestoterm.singleflight.AsyncSingleFlight`
+used by :py:func:`enrich_genes` on that loop
+"""
+
+
+def get_single_flight():
+    """
+    Gets single flight of the running event loop so identical
+    queries made at once on it share one enrichment
+
+    :return: single flight of running loop
+    :rtype: :py:class:`~cdenrichrgenestoterm.singleflight.AsyncSingleFlight`
+    """
+    loop = asyncio.get_running_loop()
+    single_flight = _SINGLE_FLIGHTS.get(loop)
+    if single_flight is None:
+        single_flight = AsyncSingleFlight()
+        _SINGLE_FLIGHTS[loop] = single_flight
+    return single_flight
+
+
+def _get_local_engine(theargs):
+    """
+    Gets local engine for `theargs`, reusing it across queries so
+    libraries are loaded once
+    """
+    key = (theargs.gmtdir, theargs.librarydir, theargs.libraryversion)
+    with _LOCAL_ENGINES_LOCK:
+        if key not in _LOCAL_ENGINES:
+            _LOCAL_ENGINES[key] = cdenrichrgenestoterm.get_enrichr(theargs)
+        return _LOCAL_ENGINES[key]
+
+
+async def _query_remote(genes, theargs, client):
+    """
+    Enriches `genes` with `client`, uploading the list once and
+    getting results of up to `theargs.concurrency` libraries at once.
+    Reports are parsed and combined off the event loop
+
+    :return: combined results or ``None`` if every try of any
+             library failed
+    """
+    policy = cdenrichrgenestoterm.get_retry_policy(
+        theargs, retry_count=theargs.retries, timeout_arg='timeout')
+    try:
+        user_list_id = await policy.call_async(client.add_list, genes=genes)
+    except Exception as e:
+        sys.stderr.write('Giving up on adding gene list: ' + str(e) + '\n')
+        return None
+    semaphore = asyncio.Semaphore(max(theargs.concurrency, 1))
+
+    async def query_library(library):
+        async with semaphore:
+            try:
+                with metrics.get_metrics().time_stage('enrich',
+                                                      library=library):
+                    report = await policy.call_async(
+                        client.export, user_list_id=user_list_id,
+                        library=library)
+            except Exception as e:
+                sys.stderr.write('Giving up on ' + library + ': ' +
+                                 str(e) + '\n')
+                return None
+        return await _run_in_executor(read_export_report, report, library)
+
+    results = await asyncio.gather(*[query_library(x) for x in
+                                     cdenrichrgenestoterm.get_libraries(
+                                         theargs.genesets)])
+    if any(res is None for res in results):
+        return None
+    return await _run_in_executor(cdenrichrgenestoterm.combine_results,
+                                  results, theargs)
+
+
+async def enrich_genes(genes, options=None, client=None,
+                       single_flight=None):
+    """
+    Enriches `genes` without blocking the event loop and returns the
+    same result the command line tool outputs. Queries to Enrichr
+    are made via `client` and results are parsed in a thread pool
+    so the event loop is never blocked. With
+    `options.gmtdir` or `options.librarydir` set, enrichment runs
+    locally in the loop's default executor since it is CPU bound,
+    with libraries loaded once and shared by all queries.
+
+    Each try of a library is limited to `options.timeout` seconds
+    and all tries to `options.deadline` seconds. A caller can also
+    cancel the task running this, or wrap it in
+    :py:func:`asyncio.wait_for`, which stops waiting for any HTTP
+    request in flight.
+
+    A query made while an identical one, same normalized genes and
+    options, is in flight on the same event loop awaits and shares
+    its result. The shared enrichment is only cancelled once every
+    query awaiting it is
+
+    :param genes: genes
+    :type genes: list or comma delimited str
+    :param options: query options, if ``None`` defaults are used
+    :type options: :py:class:`EnrichmentOptions`
+    :param client: Enrichr client, if ``None`` one sharing the
+                   connections of the process for `options.url`,
+                   see :py:func:`~cdenrichrgenestoterm.enrichrclient.get_client`,
+                   is used
+    :type client: :py:class:`AsyncEnrichrClient`
+    :param single_flight: coalesces identical queries, if ``None``
+                          the one of the running loop is used, see
+                          :py:func:`get_single_flight`
+    :type single_flight: :py:class:`~cdenrichrgenestoterm.singleflight.AsyncSingleFlight`
+    :raises asyncio.CancelledError: if cancelled
+    :return: best term, list of terms if `options.topk` is greater
+             then 1 or `options.allterms` is ``True``, or ``None``
+             if no term was found or enrichment failed
+    :rtype: dict or list
+    """
+    if options is None:
+        options = EnrichmentOptions()
+    theargs = options.to_args()
+    if isinstance(genes, str):
+        genes = cdenrichrgenestoterm.parse_genes(genes)
+    genes = cdenrichrgenestoterm.normalize_genes(
+        genes, alias_index=cdenrichrgenestoterm.get_alias_index(theargs))[0]
+    if len(genes) == 0:
+        sys.stderr.write('No genes found in input\n')
+        return None
+    if single_flight is None:
+        single_flight = get_single_flight()
+    is_local = theargs.gmtdir is not None or theargs.librarydir is not None
+    key = cdenrichrgenestoterm.get_cache_key(genes, theargs)
+    return (await single_flight.do(key, _enrich, genes=genes,
+                                   theargs=theargs, is_local=is_local,
+                                   client=client))[0]
+
+
+async def _enrich(genes, theargs, is_local, client):
+    """
+    Core of :py:func:`enrich_genes` run once per set of
+    identical queries in flight
+    """
+    if is_local:
+        loop = asyncio.get_running_loop()
+        df_result = await loop.run_in_executor(
+            None, functools.partial(cdenrichrgenestoterm.query_enrichr,
+                                    genes, theargs,
+                                    _get_local_engine(theargs),
+                                    retry_count=theargs.retries))
+    else:
+        if client is None:
+            client = AsyncEnrichrClient(
+                client=enrichrclient.get_client(theargs))
+        df_result = await _query_remote(genes, theargs, client)
+    if df_result is None:
+        return None
+    return await _run_in_executor(_select_terms, df_result, genes, theargs)
+
+
+def _select_terms(df_result, genes, theargs):
+    """
+    Gets terms to return from `df_result`
+    """
+    with metrics.get_metrics().time_stage('select'):
+        return cdenrichrgenestoterm._get_terms(df_result, genes, theargs,
+                                               materialize=True)
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+
+import io
+import sys
+import json
+import argparse
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from cdenrichrgenestoterm import metrics
+
+
+DEFAULT_CHUNK_SIZE = 16
+"""
+Number of gene lists sent to a worker process at a time
+"""
+
+_WORKER_STATE = {}
+"""
+Engine, cache and arguments of a worker process. Set in the parent
+before workers are forked so they inherit them, including any gene
+set libraries already loaded, without pickling
+"""
+
+
+def _get_mp_context():
+    """
+    Gets fork context where available so workers share the parent's
+    loaded libraries copy-on-write, otherwise the default context
+    """
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+
+def _init_worker(theargs, retry_count, record_metrics):
+    """
+    Sets up a worker process. Under fork the state set by
+    :py:meth:`BatchExecutor.run` is inherited, otherwise an engine
+    and cache are created here. Compiled libraries are memory
+    mapped so even then workers share their pages
+    """
+    from cdenrichrgenestoterm import cdenrichrgenestoterm
+    _WORKER_STATE['metrics'] = record_metrics
+    if 'enrichr' in _WORKER_STATE:
+        return
+    _WORKER_STATE['theargs'] = theargs
+    _WORKER_STATE['retry_count'] = retry_count
+    _WORKER_STATE['enrichr'] = cdenrichrgenestoterm.get_enrichr(theargs)
+    _WORKER_STATE['cache'] = cdenrichrgenestoterm.get_result_cache(theargs)
+
+
+def _run_chunk(records):
+    """
+    Enriches `records` in a worker process
+
+    :param records: list of (id, genes) tuples
+    :type records: list
+    :return: (list of output line of each record, metrics record of
+             chunk or ``None`` if metrics are not recorded)
+    :rtype: tuple
+    """
+    from cdenrichrgenestoterm import cdenrichrgenestoterm
+    recorder = None
+    if _WORKER_STATE['metrics'] is True:
+        recorder = metrics.StageMetrics()
+        metrics.set_metrics(recorder)
+    outputs = []
+    for gene_list_id, genes in records:
+        out = io.StringIO()
+        cdenrichrgenestoterm.run_batch_record(
+            gene_list_id, genes, _WORKER_STATE['theargs'], out,
+            enrichr=_WORKER_STATE['enrichr'],
+            retry_count=_WORKER_STATE['retry_count'],
+            cache=_WORKER_STATE['cache'])
+        outputs.append(out.getvalue())
+    if recorder is None:
+        return outputs, None
+    return outputs, recorder.get_record()
+
+
+def _get_chunks(records, chunk_size):
+    """
+    Generator that groups `records` into lists of up to
+    `chunk_size`
+    """
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def _get_coalesce_key(genes):
+    """
+    Gets key under which identical gene lists are coalesced or
+    ``None`` if `genes` is not a list of genes
+    """
+    if genes is None:
+        return None
+    return tuple(sorted(set(genes)))
+
+
+class _PendingChunk(object):
+    """
+    Chunk of gene lists in flight, see :py:meth:`BatchExecutor.run`
+    """
+    def __init__(self):
+        self.future = None
+        self.records = []
+        self.keys = []
+        self.slots = []
+        self.outputs = None
+
+
+class BatchExecutor(object):
+    """
+    Enriches a batch of gene lists across a pool of processes so a
+    local engine can use every core. Gene lists are sent to workers
+    in chunks and each worker runs the same per gene list code as
+    :py:func:`~cdenrichrgenestoterm.cdenrichrgenestoterm.run_enrichr_batch`
+    so output is identical. Output is written in input order and
+    at most `max_pending` chunks are in flight at once, so memory
+    stays bounded no matter how large the batch is or how far the
+    workers get ahead of a slow reader of the output.
+
+    Like :py:class:`~cdenrichrgenestoterm.singleflight.SingleFlight`
+    does for threads, a gene list identical to one already in flight
+    is not sent to a worker, it is given the result of that one
+    """
+    def __init__(self, theargs, workers, enrichr=None, retry_count=2,
+                 cache=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                 max_pending=None):
+        """
+        Constructor
+
+        :param theargs: parsed command line arguments
+        :type theargs: :py:class:`argparse.Namespace`
+        :param workers: number of worker processes
+        :type workers: int
+        :param enrichr: enrichment engine, if ``None`` one is picked
+                        via :py:func:`~cdenrichrgenestoterm.cdenrichrgenestoterm.get_enrichr`
+        :param retry_count: number of times to try enrichment
+        :type retry_count: int
+        :param cache: result cache or ``None``
+        :type cache: :py:class:`~cdenrichrgenestoterm.resultcache.ResultCache`
+        :param chunk_size: number of gene lists sent to a worker at
+                           a time
+        :type chunk_size: int
+        :param max_pending: max chunks in flight, if ``None`` twice
+                            `workers`
+        :type max_pending: int
+        """
+        self._theargs = theargs
+        self._workers = max(workers, 1)
+        self._enrichr = enrichr
+        self._retry_count = retry_count
+        self._cache = cache
+        self._chunk_size = max(chunk_size, 1)
+        if max_pending is None:
+            max_pending = 2 * self._workers
+        self._max_pending = max(max_pending, 1)
+
+    def _preload_libraries(self, enrichr):
+        """
+        Loads libraries of a local engine in this process so forked
+        workers inherit them instead of each loading its own copy.
+        Errors are left for the workers to report per gene list
+        """
+        if not hasattr(enrichr, 'get_library'):
+            return
+        from cdenrichrgenestoterm import cdenrichrgenestoterm
+        for library in cdenrichrgenestoterm.get_libraries(
+                self._theargs.genesets):
+            try:
+                enrichr.get_library(library)
+            except Exception as e:
+                sys.stderr.write('Unable to preload ' + library +
+                                 ': ' + str(e) + '\n')
+
+    def run(self, records, out):
+        """
+        Enriches `records` writing one JSON line per record to `out`
+        in the order of `records`
+
+        :param records: (id, genes) tuples, can be an iterator which
+                        is only read as workers free up
+        :type records: iterable
+        :param out: where to write results
+        :type out: file
+        :return: number of records processed
+        :rtype: int
+        """
+        from cdenrichrgenestoterm import cdenrichrgenestoterm
+        context = _get_mp_context()
+        forked = context.get_start_method() == 'fork'
+        # cache was already cleared, if asked to, by the caller
+        worker_args = argparse.Namespace(**vars(self._theargs))
+        worker_args.clearcache = False
+        _WORKER_STATE.clear()
+        if forked:
+            enrichr = self._enrichr
+            if enrichr is None:
+                enrichr = cdenrichrgenestoterm.get_enrichr(self._theargs)
+            self._preload_libraries(enrichr)
+            _WORKER_STATE.update({'theargs': worker_args,
+                                  'retry_count': self._retry_count,
+                                  'enrichr': enrichr,
+                                  'cache': self._cache})
+        count = 0
+        pending = collections.deque()
+        in_flight = {}
+        try:
+            with ProcessPoolExecutor(max_workers=self._workers,
+                                     mp_context=context,
+                                     initializer=_init_worker,
+                                     initargs=(worker_args,
+                                               self._retry_count,
+                                               metrics.get_metrics().
+                                               enabled)) as pool:
+                for chunk in _get_chunks(records, self._chunk_size):
+                    while len(pending) >= self._max_pending:
+                        self._write_chunk(pending.popleft(), out,
+                                          in_flight)
+                    pending.append(self._submit_chunk(pool, chunk, out,
+                                                      in_flight))
+                    count += len(chunk)
+                while len(pending) > 0:
+                    self._write_chunk(pending.popleft(), out, in_flight)
+        finally:
+            _WORKER_STATE.clear()
+        return count
+
+    def _submit_chunk(self, pool, chunk, out, in_flight):
+        """
+        Sends gene lists of `chunk` to a worker except those identical
+        to one in `in_flight`, which are given its output instead
+
+        :return: chunk in flight
+        :rtype: :py:class:`_PendingChunk`
+        """
+        pending = _PendingChunk()
+        for gene_list_id, genes in chunk:
+            key = _get_coalesce_key(genes)
+            leader = in_flight.get(key)
+            if leader is not None:
+                metrics.get_metrics().increment('coalesced')
+                pending.slots.append((gene_list_id,) + leader)
+                continue
+            leader = (pending, len(pending.records))
+            pending.slots.append((gene_list_id,) + leader)
+            pending.records.append((gene_list_id, genes))
+            if key is not None:
+                in_flight[key] = leader
+                pending.keys.append(key)
+        if len(pending.records) > 0:
+            # workers are forked on submit and would otherwise
+            # write out anything still buffered when they exit
+            out.flush()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pending.future = pool.submit(_run_chunk, pending.records)
+        return pending
+
+    def _write_chunk(self, pending, out, in_flight):
+        """
+        Waits for chunk `pending` and writes its output to `out`,
+        adding metrics recorded by the worker to those of this process
+        """
+        pending.outputs = []
+        if pending.future is not None:
+            pending.outputs, record = pending.future.result()
+            if record is not None:
+                metrics.get_metrics().merge(record)
+        for key in pending.keys:
+            if in_flight.get(key, (None,))[0] is pending:
+                del in_flight[key]
+        for gene_list_id, leader, idx in pending.slots:
+            output = leader.outputs[idx]
+            leader_id = leader.records[idx][0]
+            if leader_id != gene_list_id:
+                # only the id differs from the line of the leader
+                output = '{"id": ' + json.dumps(gene_list_id) + \
+                    output[len('{"id": ' + json.dumps(leader_id)):]
+            out.write(output)
+        out.flush()
@@ -4,20 +4,237 @@ import os
 import sys
 import argparse
 import json
-import pandas
+import shutil
+import tempfile
+import threading
+import time
 from contextlib import redirect_stdout
 
-with redirect_stdout(sys.stderr):
-    import gseapy
+# pandas, gseapy and the local engine, which needs numpy and scipy,
+# are heavy to import so they are imported by the functions that
+# need them. That way --help, empty input and cache hits never
+# pay for them, see tests/test_startup.py
+from cdenrichrgenestoterm.resultcache import ResultCache
+from cdenrichrgenestoterm.retrypolicy import RetryPolicy
+from cdenrichrgenestoterm import metrics
+from cdenrichrgenestoterm.enrichrclient import ENRICHR_URL
 
 
 ADJUSTED_PVALUE = 'Adjusted P-value'
 PVALUE = 'P-value'
 
+CACHE_KEY_ARGS = ['genesets', 'maxpval', 'gmtdir', 'topk', 'librarydir',
+                  'allterms', 'offset', 'limit', 'correction']
+"""
+Arguments that change the result and hence are part
+of the cache key, see :py:func:`get_cache_key`
+"""
+
+RESULT_DTYPES = {'Gene_set': str,
+                 'Term': str,
+                 'Overlap': str,
+                 PVALUE: 'float64',
+                 ADJUSTED_PVALUE: 'float64',
+                 'Genes': str}
+"""
+Columns of enrichment results that are used and their types,
+other columns in report files are not parsed
+"""
+
+CORRECTION_LIBRARY = 'library'
+"""
+Keep Adjusted P-value as computed within each library
+"""
+
+CORRECTIONS = [CORRECTION_LIBRARY, 'bh', 'bonferroni']
+"""
+Choices of --correction, the others are methods of
+:py:func:`~cdenrichrgenestoterm.correction.adjust_pvalues`
+"""
+
+READ_CHUNK_SIZE = 10000
+"""
+Number of rows of a report file parsed at a time
+"""
+
+SERVE_COMMAND = 'serve'
+"""
+First argument that starts persistent server,
+see :py:mod:`cdenrichrgenestoterm.server`
+"""
+
+COMPILE_COMMAND = 'compile'
+"""
+First argument that compiles GMT gene set libraries,
+see :py:mod:`cdenrichrgenestoterm.compiledlibrary`
+"""
+
+LIBRARY_COMMAND = 'library'
+"""
+First argument that manages offline gene set library snapshots,
+see :py:mod:`cdenrichrgenestoterm.librarystore`
+"""
+
+ALIASES_COMMAND = 'aliases'
+"""
+First argument that builds a gene alias index,
+see :py:mod:`cdenrichrgenestoterm.aliasindex`
+"""
+
+MAX_REPORTED_GENES = 20
+"""
+Max number of dropped or mapped genes named in messages
+written by :py:func:`normalize_genes`
+"""
+
+DEFAULT_GENESETS = 'GO_Biological_Process_2018,' \
+                   'GO_Cellular_Component_2018,' \
+                   'GO_Molecular_Function_2018'
+"""
+Default gene set libraries to enrich against
+"""
+
 class Formatter(argparse.ArgumentDefaultsHelpFormatter, argparse.RawDescriptionHelpFormatter):
     pass
 
 
+def add_enrichment_arguments(parser):
+    """
+    Adds arguments that control enrichment to `parser`. These
+    are shared by the command line tool and the server
+
+    :param parser: parser to update
+    :type parser: :py:class:`argparse.ArgumentParser`
+    :return: None
+    """
+    parser.add_argument('--maxpval', type=float, default=0.05,
+                        help='Max p value')
+    parser.add_argument('--tmpdir', default='/tmp',
+                        help='Temp directory under which a private, '
+                             'automatically removed, directory is made '
+                             'for each query that needs to hold output '
+                             'from task')
+    parser.add_argument('--genesets', default=DEFAULT_GENESETS,
+                        help='Gene sets to enrich against. '
+                             'Should be comma delimited')
+    parser.add_argument('--gmtdir',
+                        help='If set, enrichment is run locally against '
+                             '<gene set>.gmt files in this directory '
+                             'instead of calling the Enrichr service')
+    parser.add_argument('--librarydir',
+                        help='If set, enrichment is run locally against '
+                             'a library snapshot in this directory made '
+                             'with the library command. Takes precedence '
+                             'over --gmtdir')
+    parser.add_argument('--libraryversion',
+                        help='Library snapshot to use with --librarydir, '
+                             'if unset the current snapshot is used')
+    parser.add_argument('--aliasindex',
+                        help='If set, previous and alias gene symbols are '
+                             'mapped to approved symbols with this index, '
+                             'made with the aliases command, and symbols '
+                             'not in it are dropped before enrichment')
+    parser.add_argument('--url', default=ENRICHR_URL,
+                        help='Base URL of Enrichr, or a service with the '
+                             'same API, used if neither --gmtdir nor '
+                             '--librarydir is set')
+    parser.add_argument('--poolsize', type=int, default=10,
+                        help='Max number of keep-alive connections to '
+                             '--url shared by all queries of a process')
+    parser.add_argument('--ratelimit', type=float, default=0,
+                        help='Max requests per second made to --url by '
+                             'each process, set to the quota of the '
+                             'service. 0 or less means no limit')
+    parser.add_argument('--rateburst', type=int, default=1,
+                        help='Max requests made at once under '
+                             '--ratelimit after a quiet period')
+    parser.add_argument('--gseapy', action='store_true',
+                        help='If set, Enrichr is queried via gseapy, '
+                             'the default before 0.5.0, which opens '
+                             'new connections for every request, '
+                             'ignoring --url, --poolsize, --ratelimit '
+                             'and --rateburst')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='Max number of gene set libraries to query '
+                             'at once. Each library is queried '
+                             'separately in its own thread. If 1 or less '
+                             'all libraries are passed in one query')
+    parser.add_argument('--retries', type=int, default=2,
+                        help='Max number of times to try a query of '
+                             'each library. Errors such as a missing '
+                             'library or invalid query are not retried')
+    parser.add_argument('--retrybackoff', type=float, default=1.0,
+                        help='Base delay in seconds between tries, doubled '
+                             'after each try. Actual delay is random '
+                             'between 0 and this so clients do not retry '
+                             'in lock step')
+    parser.add_argument('--retrymaxbackoff', type=float, default=30.0,
+                        help='Max delay in seconds between tries')
+    parser.add_argument('--timeout', type=float, default=120.0,
+                        help='Max seconds for a single try of a query '
+                             'to --url, 0 or less means no limit. Not '
+                             'applied with --gseapy or local libraries '
+                             'since those can not be interrupted, only '
+                             '--deadline is checked between their tries')
+    parser.add_argument('--deadline', type=float, default=300.0,
+                        help='Max seconds for all tries of a query '
+                             'including delays between them, 0 or less '
+                             'means no limit')
+    parser.add_argument('--correction', choices=CORRECTIONS,
+                        default=CORRECTION_LIBRARY,
+                        help='Multiple testing correction of the Adjusted '
+                             'P value terms are filtered by --maxpval and '
+                             'ranked on. library keeps the one each '
+                             'library computed on its own, bh and '
+                             'bonferroni recompute Benjamini-Hochberg or '
+                             'Bonferroni once over the terms of all '
+                             '--genesets so they are on one scale')
+    parser.add_argument('--topk', type=int, default=1,
+                        help='Number of best terms to output. If greater '
+                             'then 1 output is a JSON list of up to this '
+                             'many terms, best first')
+    parser.add_argument('--allterms', action='store_true',
+                        help='If set, output is a JSON list of every term '
+                             'with Adjusted P value under --maxpval, best '
+                             'first, instead of --topk terms. List is '
+                             'written as terms are converted so large '
+                             'results are never held in memory at once')
+    parser.add_argument('--offset', type=int, default=0,
+                        help='With --allterms, number of best terms to '
+                             'skip')
+    parser.add_argument('--limit', type=int,
+                        help='With --allterms, max number of terms to '
+                             'output, if unset all are output')
+    parser.add_argument('--cachedir',
+                        help='If set, results are cached in this directory '
+                             'keyed on the normalized gene list, '
+                             '--genesets, --maxpval, --topk, --gmtdir, '
+                             '--correction and library snapshot')
+    parser.add_argument('--cachemaxentries', type=int, default=100000,
+                        help='Max number of results to keep in cache, '
+                             'least recently used are removed first')
+    parser.add_argument('--cachettl', type=float, default=604800,
+                        help='Seconds a cached result is valid for')
+    parser.add_argument('--nocache', action='store_true',
+                        help='If set, --cachedir is neither read nor '
+                             'written')
+    parser.add_argument('--clearcache', action='store_true',
+                        help='If set, --cachedir is emptied before running')
+    parser.add_argument('--metrics', action='store_true',
+                        help='If set, time spent in each stage (import, '
+                             'input read, enrichment per library, retries, '
+                             'result load, filter/sort and serialization) '
+                             'is written to standard error as one JSON '
+                             '{"metrics": RECORD} line at exit')
+    parser.add_argument('--metricsfile',
+                        help='If set, the JSON metrics line is appended '
+                             'to this file instead of standard error')
+    parser.add_argument('--prometheusfile',
+                        help='If set, metrics are written to this file in '
+                             'Prometheus text format at exit. The server '
+                             'also serves them at GET /metrics')
+
+
 def _parse_arguments(desc, args):
     """
     Parses command line arguments
@@ -30,15 +247,35 @@ def _parse_arguments(desc, args):
                                      formatter_class=help_fm)
     parser.add_argument('input',
                         help='comma delimited list of genes in file')
-    parser.add_argument('--maxpval', type=float, default=0.05,
-                        help='Max p value')
-    parser.add_argument('--tmpdir', default='/tmp',
-                        help='Temp directory to hold output from task')
-    parser.add_argument('--genesets', default='GO_Biological_Process_2018,'
-                                              'GO_Cellular_Component_2018,'
-                                              'GO_Molecular_Function_2018',
-                        help='Gene sets to enrich against. '
-                             'Should be comma delimited')
+    add_enrichment_arguments(parser)
+    parser.add_argument('--batch', action='store_true',
+                        help='If set, input is treated as a batch of gene '
+                             'lists, either one comma delimited list per '
+                             'line or one JSON {"id": ID, "genes": GENES} '
+                             'record per line. Output is one JSON '
+                             '{"id": ID, "result": RESULT} record per '
+                             'line where RESULT is null if no term was '
+                             'found')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes to enrich --batch gene '
+                             'lists with. Output order and content do not '
+                             'change. 1 or less enriches in this process')
+    parser.add_argument('--hierarchy', action='store_true',
+                        help='If set, input is a JSON community hierarchy '
+                             '{"communities": [{"id": ID, "genes": GENES}], '
+                             '"edges": [[PARENT ID, CHILD ID]]} and every '
+                             'community is enriched in one pass reusing '
+                             'overlap counts of child communities when '
+                             '--gmtdir or --librarydir is set. Output is as '
+                             'for --batch with children before parents')
+    parser.add_argument('--incremental',
+                        help='If set, with --gmtdir or --librarydir, the '
+                             'per term overlap counts of each gene list '
+                             'are kept in this directory under its --batch '
+                             'id, or the input file path, and when a list '
+                             'with the same id is enriched again only the '
+                             'genes added and removed since are applied '
+                             'instead of rescoring the whole library')
     return parser.parse_args(args)
 
 
@@ -52,14 +289,170 @@ def read_inputfile(inputfile):
         return f.read()
 
 
-def load_data_frame_from_outputfiles(outdir=None):
+def parse_genes(genes):
+    """
+    Converts comma delimited string of genes into list of
+    upper case genes
+
+    :param genes: comma delimited genes
+    :type genes: str
+    :return: genes
+    :rtype: list
+    """
+    return genes.strip(',').strip('\n').upper().split(',')
+
+
+_ALIAS_INDEXES = {}
+_ALIAS_INDEXES_LOCK = threading.Lock()
+
+
+def get_alias_index(theargs):
+    """
+    Gets alias index set by `theargs.aliasindex`, loading it on
+    first use and reusing it after that
+
+    :param theargs: parsed command line arguments
+    :type theargs: :py:class:`argparse.Namespace`
+    :raises ValueError: if file is not an alias index
+    :return: index or ``None`` if not set
+    :rtype: :py:class:`~cdenrichrgenestoterm.aliasindex.AliasIndex`
+    """
+    path = getattr(theargs, 'aliasindex', None)
+    if path is None:
+        return None
+    with _ALIAS_INDEXES_LOCK:
+        if path not in _ALIAS_INDEXES:
+            from cdenrichrgenestoterm import aliasindex
+            _ALIAS_INDEXES[path] = aliasindex.load_alias_index(path)
+        return _ALIAS_INDEXES[path]
+
+
+def _get_gene_summary(genes):
+    summary = ', '.join(genes[:MAX_REPORTED_GENES])
+    if len(genes) > MAX_REPORTED_GENES:
+        summary += ', ...'
+    return summary
+
+
+def normalize_genes(genes, alias_index=None):
+    """
+    Normalizes `genes` in one pass by stripping whitespace, upper
+    casing, dropping empty and duplicate genes and, if `alias_index`
+    is set, mapping each gene to its approved symbol and dropping
+    genes not in the index. Order of first appearance is kept.
+    Dropped and mapped genes are reported to :py:const:`sys.stderr`
+    and counted as ``genes_dropped`` and ``genes_mapped`` metrics
+
+    :param genes: genes as returned by :py:func:`parse_genes`
+    :type genes: list
+    :param alias_index: index of approved symbols
+    :type alias_index: :py:class:`~cdenrichrgenestoterm.aliasindex.AliasIndex`
+    :return: (normalized genes, dropped genes, list of
+             (gene, approved symbol) tuples for mapped genes)
+    :rtype: tuple
+    """
+    cleaned = [x for x in (g.strip().upper() for g in genes)
+               if len(x) > 0]
+    if alias_index is None:
+        resolved = cleaned
+    else:
+        resolved = alias_index.resolve(cleaned)
+    res = []
+    seen = set()
+    dropped = []
+    mapped = []
+    for gene, symbol in zip(cleaned, resolved):
+        if symbol is None or symbol in seen:
+            dropped.append(gene)
+            continue
+        if symbol != gene:
+            mapped.append((gene, symbol))
+        seen.add(symbol)
+        res.append(symbol)
+    if len(dropped) > 0:
+        sys.stderr.write('Dropped ' + str(len(dropped)) +
+                         ' unknown or duplicate genes: ' +
+                         _get_gene_summary(dropped) + '\n')
+        metrics.get_metrics().increment('genes_dropped', len(dropped))
+    if len(mapped) > 0:
+        sys.stderr.write('Mapped ' + str(len(mapped)) +
+                         ' genes to approved symbols: ' +
+                         _get_gene_summary([x[0] + ' -> ' + x[1]
+                                            for x in mapped]) + '\n')
+        metrics.get_metrics().increment('genes_mapped', len(mapped))
+    return res, dropped, mapped
+
+
+def read_batch_inputfile(inputfile):
+    """
+    Generator that reads gene lists from a batch `inputfile`. Each
+    non empty line is either a JSON record of form
+    ``{"id": ID, "genes": GENES}`` where GENES is a list or a comma
+    delimited string, or a comma delimited list of genes in which
+    case the id is the line number starting at 1. An invalid JSON
+    record is written to :py:const:`sys.stderr` with its line
+    number and gets ``None`` genes so the rest of the batch is
+    still read
+
+    :param inputfile: batch input file
+    :type inputfile: str
+    :return: (id, list of genes or ``None``) for each gene list
+    :rtype: tuple
+    """
+    with open(inputfile, 'r') as f:
+        for line_num, line in enumerate(f, start=1):
+            line = line.strip()
+            if len(line) == 0:
+                continue
+            if not line.startswith('{'):
+                yield line_num, parse_genes(line)
+                continue
+            gene_list_id = line_num
+            try:
+                record = json.loads(line)
+                gene_list_id = record.get('id', line_num)
+                genes = record['genes']
+                if not isinstance(genes, str):
+                    genes = ','.join(genes)
+            except (ValueError, KeyError, TypeError) as e:
+                sys.stderr.write('Invalid gene list on line ' +
+                                 str(line_num) + ': ' + repr(e) + '\n')
+                yield gene_list_id, None
+                continue
+            yield gene_list_id, parse_genes(genes)
+
+
+def _get_best_rows(df, keep):
+    """
+    Gets the `keep` best rows of `df` by Adjusted P-value and
+    then P-value or all of `df` if `keep` is ``None``
+    """
+    if keep is None or df.shape[0] <= keep:
+        return df
+    return df.nsmallest(keep, [ADJUSTED_PVALUE, PVALUE])
+
+
+def load_data_frame_from_outputfiles(outdir=None, keep=None,
+                                     chunksize=READ_CHUNK_SIZE):
     """
     Loads all files ending with `.txt` loading them
-    into a single pandas data frame
-    :param outdir:
+    into a single pandas data frame. Only the columns in
+    :py:const:`RESULT_DTYPES` are parsed, with those dtypes,
+    and files are read `chunksize` rows
+    at a time. If `keep` is set only a running set of the `keep`
+    best rows, as ranked by :py:func:`get_best_term`, is held so
+    memory use does not grow with the size of the files
+
+    :param outdir: directory holding report files
+    :type outdir: str
+    :param keep: number of best rows to keep or ``None`` for all
+    :type keep: int
+    :param chunksize: number of rows to parse at a time
+    :type chunksize: int
     :return: combined data of .txt files into single pandas data frame
     :rtype: :py:class:`pandas.DataFrame`
     """
+    import pandas
     d_frames = []
     for entry in os.listdir(outdir):
         if not entry.endswith('.txt'):
@@ -67,8 +460,15 @@ def load_data_frame_from_outputfiles(outdir=None):
         full_path = os.path.join(outdir, entry)
         if not os.path.isfile(full_path):
             continue
-        df = pandas.read_csv(full_path, delimiter='\t', header=0)
-        d_frames.append(df)
+        with pandas.read_csv(full_path, delimiter='\t', header=0,
+                             usecols=lambda x: x in RESULT_DTYPES,
+                             dtype=RESULT_DTYPES,
+                             chunksize=chunksize) as reader:
+            for chunk in reader:
+                d_frames.append(_get_best_rows(chunk, keep))
+                if keep is not None and len(d_frames) > 1:
+                    d_frames = [_get_best_rows(pandas.concat(d_frames),
+                                               keep)]
 
     if len(d_frames) == 0:
         return pandas.DataFrame()
@@ -78,35 +478,560 @@ def load_data_frame_from_outputfiles(outdir=None):
     return mega_df
 
 
+_GSEAPY_IMPORT_LOCK = threading.Lock()
+
+
+class GseapyEnrichr(object):
+    """
+    Queries the Enrichr service via :py:func:`gseapy.enrichr`,
+    importing :py:mod:`gseapy` on first use. It is called from
+    worker threads of :py:func:`query_enrichr`, which already sends
+    what gseapy prints to standard error, so it does not redirect
+    standard output itself as that would swap it for every thread
+    """
+    results_in_memory = True
+    """
+    Results are returned in ``results`` attribute so no
+    report files need to be written
+    """
+
+    def enrichr(self, **kwargs):
+        """
+        Calls :py:func:`gseapy.enrichr` passing `kwargs`
+
+        :return: object with results in ``results`` attribute
+        """
+        with _GSEAPY_IMPORT_LOCK:
+            with metrics.get_metrics().time_stage('import'):
+                import gseapy
+        return gseapy.enrichr(**kwargs)
+
+
+def get_enrichr(theargs):
+    """
+    Gets the enrichment engine to use. If `theargs.librarydir` is
+    set a :py:class:`~cdenrichrgenestoterm.localenrichr.LocalEnrichr`
+    for the library snapshot set by `theargs.libraryversion` is
+    returned, else if `theargs.gmtdir` is set a
+    :py:class:`~cdenrichrgenestoterm.localenrichr.LocalEnrichr`
+    for that directory is returned, else if `theargs.gseapy` is set
+    :py:class:`GseapyEnrichr` otherwise
+    :py:class:`~cdenrichrgenestoterm.enrichrclient.PooledEnrichr`
+    which queries the Enrichr service over the connection pool and
+    rate limit of the process, see
+    :py:func:`~cdenrichrgenestoterm.enrichrclient.get_client`.
+    If `theargs.incremental` is set the local engine is wrapped in an
+    :py:class:`~cdenrichrgenestoterm.incremental.IncrementalEnricher`
+    keeping its states in that directory
+
+    :param theargs: parsed command line arguments
+    :type theargs: :py:class:`argparse.Namespace`
+    :raises LookupError: if library snapshot does not exist
+    :raises ValueError: if `theargs.incremental` is set without a
+                        local engine
+    :return: object with an ``enrichr()`` method
+    """
+    if _is_local_engine(theargs) is False:
+        if getattr(theargs, 'gseapy', False) is True:
+            return GseapyEnrichr()
+        from cdenrichrgenestoterm import enrichrclient
+        return enrichrclient.PooledEnrichr(
+            enrichrclient.get_client(theargs))
+    from cdenrichrgenestoterm.localenrichr import LocalEnrichr
+    if getattr(theargs, 'librarydir', None) is not None:
+        from cdenrichrgenestoterm.librarystore import LibraryStore
+        store = LibraryStore(theargs.librarydir)
+        local = LocalEnrichr(store.get_snapshot_dir(theargs.libraryversion),
+                             checksums=store.get_checksums(
+                                 theargs.libraryversion),
+                             file_stats=store.get_file_stats(
+                                 theargs.libraryversion))
+    else:
+        local = LocalEnrichr(theargs.gmtdir)
+    statedir = getattr(theargs, 'incremental', None)
+    if statedir is not None:
+        from cdenrichrgenestoterm.incremental import IncrementalEnricher
+        return IncrementalEnricher(local, statedir=statedir)
+    return local
+
+
+def _is_local_engine(theargs):
+    """
+    Tells if :py:func:`get_enrichr` returns a local engine for
+    `theargs` without creating it
+
+    :param theargs: parsed command line arguments
+    :type theargs: :py:class:`argparse.Namespace`
+    :raises ValueError: if `theargs.incremental` is set without a
+                        local engine
+    :return: ``True`` if `theargs.librarydir` or `theargs.gmtdir`
+             is set
+    :rtype: bool
+    """
+    local = (getattr(theargs, 'librarydir', None) is not None or
+             theargs.gmtdir is not None)
+    if getattr(theargs, 'incremental', None) is not None and not local:
+        raise ValueError('--incremental requires --gmtdir or '
+                         '--librarydir')
+    return local
+
+
+class _LazyEnrichr(object):
+    """
+    Enrichment engine made by `factory` on first call of
+    :py:meth:`get`, which :py:func:`_enrich_and_store` does on a
+    cache miss, so runs answered from the result cache never
+    import the modules the engine needs
+    """
+    def __init__(self, factory):
+        """
+        Constructor
+
+        :param factory: function without arguments that returns
+                        the enrichment engine
+        :type factory: callable
+        """
+        self._factory = factory
+        self._enrichr = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Gets the enrichment engine, making it on first call
+
+        :return: object with an ``enrichr()`` method
+        """
+        with self._lock:
+            if self._enrichr is None:
+                self._enrichr = self._factory()
+            return self._enrichr
+
+
+def get_result_cache(theargs):
+    """
+    Gets result cache as set by `theargs`, emptying it
+    if `theargs.clearcache` is set
+
+    :param theargs: parsed command line arguments
+    :type theargs: :py:class:`argparse.Namespace`
+    :return: cache or ``None`` if caching is disabled
+    :rtype: :py:class:`~cdenrichrgenestoterm.resultcache.ResultCache`
+    """
+    if theargs.cachedir is None:
+        return None
+    cache = ResultCache(theargs.cachedir,
+                        max_entries=theargs.cachemaxentries,
+                        ttl=theargs.cachettl)
+    if theargs.clearcache is True:
+        cache.clear()
+    if theargs.nocache is True:
+        return None
+    return cache
+
+
+def get_cache_key(genes, theargs):
+    """
+    Gets cache key for `genes` which is a hash of the sorted upper
+    case genes, the values of :py:const:`CACHE_KEY_ARGS`, the engine
+    that enriches them, see :py:func:`get_enrichr`, and, if
+    `theargs.librarydir` is set, the library snapshot in use
+
+    :param genes: genes
+    :type genes: list
+    :param theargs: parsed command line arguments
+    :type theargs: :py:class:`argparse.Namespace`
+    :return: key
+    :rtype: str
+    """
+    params = {x: getattr(theargs, x, None) for x in CACHE_KEY_ARGS}
+    if params['librarydir'] is not None:
+        from cdenrichrgenestoterm import librarystore
+        params['libraryversion'] = librarystore.get_library_version(theargs)
+    if params['librarydir'] is not None or params['gmtdir'] is not None:
+        params['engine'] = 'local'
+    elif getattr(theargs, 'gseapy', False) is True:
+        params['engine'] = 'gseapy'
+    else:
+        params['engine'] = getattr(theargs, 'url', ENRICHR_URL)
+    return ResultCache.make_key(genes, params)
+
+
 def run_enrichr(inputfile, theargs,
-                enrichr=gseapy,
-                retry_count=2):
+                enrichr=None,
+                retry_count=2,
+                cache=None):
     """
-    todo
-    :param inputfile:
-    :return:
+    Runs enrichment on genes in `inputfile` and returns best term
+
+    :param inputfile: file with comma delimited list of genes
+    :type inputfile: str
+    :param theargs: parsed command line arguments
+    :type theargs: :py:class:`argparse.Namespace`
+    :param enrichr: enrichment engine, if ``None`` one is picked
+                    via :py:func:`get_enrichr`
+    :param retry_count: number of times to try enrichment
+    :type retry_count: int
+    :param cache: result cache, if ``None`` one is created via
+                  :py:func:`get_result_cache`
+    :type cache: :py:class:`~cdenrichrgenestoterm.resultcache.ResultCache`
+    :return: best term or ``None`` if none found
+    :rtype: dict
     """
-    genes = read_inputfile(inputfile)
-    genes = genes.strip(',').strip('\n').upper().split(',')
-    if genes is None or (len(genes) == 1 and len(genes[0].strip()) == 0):
-        sys.stderr.write('No genes found in input')
+    with metrics.get_metrics().time_stage('input_read'):
+        genes = parse_genes(read_inputfile(inputfile))
+    if cache is None:
+        cache = get_result_cache(theargs)
+    if getattr(theargs, 'incremental', None) is not None:
+        if enrichr is None:
+            enrichr = get_enrichr(theargs)
+        enrichr = _get_list_engine(enrichr, inputfile)
+    return run_enrichr_on_genes(genes, theargs, enrichr=enrichr,
+                                retry_count=retry_count, cache=cache)
+
+
+def get_retry_policy(theargs, retry_count=2, timeout_arg=None):
+    """
+    Gets policy for retrying failed enrichment queries as set by
+    `theargs`
+
+    :param theargs: parsed command line arguments
+    :type theargs: :py:class:`argparse.Namespace`
+    :param retry_count: max number of times to try enrichment
+    :type retry_count: int
+    :param timeout_arg: keyword argument each try is given its
+                        timeout in, ``None`` if tries can not be
+                        interrupted, see
+                        :py:class:`~cdenrichrgenestoterm.retrypolicy.RetryPolicy`
+    :type timeout_arg: str
+    :return: retry policy
+    :rtype: :py:class:`~cdenrichrgenestoterm.retrypolicy.RetryPolicy`
+    """
+    return RetryPolicy(max_tries=retry_count,
+                       backoff=getattr(theargs, 'retrybackoff', 1.0),
+                       max_backoff=getattr(theargs, 'retrymaxbackoff', 30.0),
+                       timeout=getattr(theargs, 'timeout', None),
+                       deadline=getattr(theargs, 'deadline', None),
+                       timeout_arg=timeout_arg)
+
+
+def get_libraries(genesets):
+    """
+    Splits comma delimited `genesets` into list of library names
+
+    :param genesets: comma delimited gene set library names
+    :type genesets: str
+    :return: library names
+    :rtype: list
+    """
+    return [x.strip() for x in genesets.split(',') if len(x.strip()) > 0]
+
+
+def query_enrichr(genes, theargs, enrichr, retry_count=2):
+    """
+    Runs enrichment of `genes` with `enrichr` and gets the results.
+
+    Each library in `theargs.genesets` is queried separately, with
+    up to `theargs.concurrency` of them in flight at once on a thread
+    pool, so wall time is that of the slowest library instead of
+    the sum of all of them. Each library is tried up to `retry_count`
+    times. If `theargs.concurrency` is 1 or less all the libraries
+    are passed to a single call of `enrichr` instead.
+
+    If `enrichr` has a ``results_in_memory`` attribute set to
+    ``True`` the results are taken straight from the ``results``
+    attribute of the object its ``enrichr()`` returns and no
+    output directory is passed. Otherwise `enrichr` is given a
+    new private directory under `theargs.tmpdir`, the report files
+    it writes there are loaded via
+    :py:func:`load_data_frame_from_outputfiles` and the directory
+    is removed. This way concurrent queries sharing `theargs.tmpdir`
+    never read each others results or stale files
+
+    Results of the libraries are combined with
+    :py:func:`combine_results` so only the rows that could be
+    output, see :py:func:`get_num_rows_to_keep`, are returned
+
+    :param genes: upper case genes as returned by :py:func:`parse_genes`
+    :type genes: list
+    :param theargs: parsed command line arguments
+    :type theargs: :py:class:`argparse.Namespace`
+    :param enrichr: enrichment engine
+    :param retry_count: number of times to try enrichment
+    :type retry_count: int
+    :return: combined results or ``None`` if every try of any
+             library failed
+    :rtype: :py:class:`pandas.DataFrame`
+    """
+    in_memory = getattr(enrichr, 'results_in_memory', False) is True
+    outdir = None
+    if in_memory is False:
+        outdir = tempfile.mkdtemp(prefix='cdenrichr_', dir=theargs.tmpdir)
+    libraries = get_libraries(theargs.genesets)
+    if theargs.concurrency <= 1 or len(libraries) <= 1:
+        libraries = [theargs.genesets]
+    try:
+        if len(libraries) == 1:
+            results = [_query_library(genes, libraries[0], theargs,
+                                      enrichr, outdir,
+                                      retry_count=retry_count)]
+        else:
+            from concurrent.futures import ThreadPoolExecutor
+            num_workers = min(theargs.concurrency, len(libraries))
+            with ThreadPoolExecutor(max_workers=num_workers) as pool:
+                futures = [pool.submit(_query_library, genes, library,
+                                       theargs, enrichr, outdir,
+                                       retry_count=retry_count)
+                           for library in libraries]
+                results = [f.result() for f in futures]
+        if any(res is None for res in results):
+            return None
+        if outdir is not None:
+            with metrics.get_metrics().time_stage('result_load'):
+                df_result = load_data_frame_from_outputfiles(
+                    outdir=outdir, keep=_get_num_rows_to_load(theargs))
+                return combine_results([df_result], theargs)
+    finally:
+        if outdir is not None:
+            shutil.rmtree(outdir, ignore_errors=True)
+
+    with metrics.get_metrics().time_stage('result_load'):
+        return combine_results(results, theargs)
+
+
+def _get_num_rows_to_load(theargs):
+    """
+    Gets number of best rows of each library's results needed
+    by :py:func:`combine_results`, ``None`` for all of them
+    """
+    if get_correction(theargs) != CORRECTION_LIBRARY:
         return None
-    cur_try = 1
-    with redirect_stdout(sys.stderr):
-        while cur_try <= retry_count:
-            try:
-                enrichr.enrichr(gene_list=genes, gene_sets=theargs.genesets,
-                                cutoff=theargs.maxpval,
-                                no_plot=True, outdir=theargs.tmpdir)
-                break
-            except Exception as e:
-                sys.stderr.write('Try # ' + str(cur_try) + ' caught exception: ' + str(e))
-                cur_try += 1
-                if cur_try > retry_count:
-                    sys.stderr.write('Retries exceeded')
-                    return None
+    return get_num_rows_to_keep(theargs)
+
+
+def get_correction(theargs):
+    """
+    Gets multiple testing correction set by `theargs.correction`
 
-    df_result = load_data_frame_from_outputfiles(outdir=theargs.tmpdir)
+    :param theargs: parsed command line arguments
+    :type theargs: :py:class:`argparse.Namespace`
+    :return: one of :py:const:`CORRECTIONS`
+    :rtype: str
+    """
+    correction = getattr(theargs, 'correction', None)
+    if correction is None:
+        return CORRECTION_LIBRARY
+    return correction
+
+
+def correct_pvalues(df_result, theargs):
+    """
+    Recomputes Adjusted P-value of every row of `df_result` from
+    its P-value with the correction set by `theargs.correction`
+    in one vectorized pass over all the libraries. With
+    :py:const:`CORRECTION_LIBRARY` `df_result` is returned as is
+
+    :param df_result: enrichment results of every library
+    :type df_result: :py:class:`pandas.DataFrame`
+    :param theargs: parsed command line arguments
+    :type theargs: :py:class:`argparse.Namespace`
+    :return: results with corrected Adjusted P-value
+    :rtype: :py:class:`pandas.DataFrame`
+    """
+    correction = get_correction(theargs)
+    if correction == CORRECTION_LIBRARY or df_result.shape[0] == 0:
+        return df_result
+    from cdenrichrgenestoterm.correction import adjust_pvalues
+    with metrics.get_metrics().time_stage('correct'):
+        adjusted = adjust_pvalues(df_result[PVALUE].to_numpy(), correction)
+        return df_result.assign(**{ADJUSTED_PVALUE: adjusted})
+
+
+def combine_results(results, theargs):
+    """
+    Combines `results` of each library into one data frame,
+    corrected with :py:func:`correct_pvalues`, keeping only the
+    rows that could be output, see :py:func:`get_num_rows_to_keep`.
+    Unless the correction is :py:const:`CORRECTION_LIBRARY` every
+    row of `results` is needed since each one counts as a test
+
+    :param results: results of each library
+    :type results: list
+    :param theargs: parsed command line arguments
+    :type theargs: :py:class:`argparse.Namespace`
+    :return: combined results
+    :rtype: :py:class:`pandas.DataFrame`
+    """
+    import pandas
+    keep = get_num_rows_to_keep(theargs)
+    load_keep = _get_num_rows_to_load(theargs)
+    d_frames = [_get_best_rows(df, load_keep) for df in results
+                if df.shape[0] > 0]
+    if len(d_frames) == 0:
+        return pandas.DataFrame()
+    mega_df = _get_best_rows(correct_pvalues(pandas.concat(d_frames),
+                                             theargs), keep)
+    mega_df.reset_index(drop=True, inplace=True)
+    return mega_df
+
+
+def _query_library(genes, genesets, theargs, enrichr, outdir,
+                   retry_count=2):
+    """
+    Runs enrichment of `genes` against `genesets` with `enrichr`
+    trying up to `retry_count` times with the policy from
+    :py:func:`get_retry_policy`, passing each try its timeout if
+    `enrichr` has a ``supports_timeout`` attribute set to ``True``.
+    Other engines can not be interrupted so only the deadline is
+    checked between their tries. Report files are written
+    to `outdir` or kept in memory if `outdir` is ``None``
+
+    :return: results if kept in memory, ``True`` if written to
+             `outdir`, or ``None`` if every try failed
+    """
+    timeout_arg = None
+    if getattr(enrichr, 'supports_timeout', False) is True:
+        timeout_arg = 'timeout'
+    policy = get_retry_policy(theargs, retry_count=retry_count,
+                              timeout_arg=timeout_arg)
+    try:
+        with metrics.get_metrics().time_stage('enrich', library=genesets):
+            res = policy.call(enrichr.enrichr, gene_list=genes,
+                              gene_sets=genesets,
+                              cutoff=theargs.maxpval,
+                              no_plot=True, outdir=outdir)
+    except Exception as e:
+        sys.stderr.write('Giving up on ' + str(genesets) + ': ' +
+                         str(e) + '\n')
+        return None
+
+    if outdir is not None:
+        return True
+    import pandas
+    df_result = getattr(res, 'results', None)
+    if not isinstance(df_result, pandas.DataFrame):
+        return pandas.DataFrame()
+    return df_result
+
+
+def get_num_rows_to_keep(theargs):
+    """
+    Gets number of best rows of enrichment results needed to make
+    the output set by `theargs`
+
+    :param theargs: parsed command line arguments
+    :type theargs: :py:class:`argparse.Namespace`
+    :return: number of rows or ``None`` if all rows are needed
+    :rtype: int
+    """
+    if getattr(theargs, 'allterms', False) is True:
+        if theargs.limit is None:
+            return None
+        return max(theargs.offset, 0) + max(theargs.limit, 0)
+    return max(theargs.topk, 1)
+
+
+def get_ranked_terms(df_result, genes, theargs):
+    """
+    Gets terms in `df_result` with Adjusted P-value no more than
+    `theargs.maxpval` ranked by Adjusted P-value and then P-value
+    skipping the first `theargs.offset` and returning at most
+    `theargs.limit` of them. Terms are converted from rows as the
+    returned iterator is consumed
+
+    :param df_result: enrichment results, see :py:func:`query_enrichr`
+    :type df_result: :py:class:`pandas.DataFrame`
+    :param genes: genes that were enriched
+    :type genes: list
+    :param theargs: parsed command line arguments
+    :type theargs: :py:class:`argparse.Namespace`
+    :return: iterator of terms, in format of
+             :py:func:`get_term_from_row`, which is empty if
+             `theargs.offset` is past the last term or ``None``
+             if no term passed the filter
+    :rtype: iterator
+    """
+    if df_result.shape[0] == 0:
+        sys.stderr.write('Empty data frame\n')
+        return None
+    df_result = df_result[df_result[ADJUSTED_PVALUE] <= theargs.maxpval]
+    if df_result.shape[0] == 0:
+        sys.stderr.write('Empty data frame after p value filter\n')
+        return None
+    offset = max(theargs.offset, 0)
+    end = get_num_rows_to_keep(theargs)
+    if end is None:
+        df_ranked = df_result.sort_values([ADJUSTED_PVALUE, PVALUE],
+                                          kind='mergesort')
+    else:
+        df_ranked = df_result.nsmallest(end, [ADJUSTED_PVALUE, PVALUE])
+    return _iter_terms(df_ranked.iloc[offset:end], genes)
+
+
+def _iter_terms(df_result, genes, chunksize=READ_CHUNK_SIZE):
+    """
+    Generator of terms for rows of `df_result` converting
+    `chunksize` rows at a time
+    """
+    for start in range(0, df_result.shape[0], chunksize):
+        for row in df_result.iloc[start:start +
+                                  chunksize].to_dict('records'):
+            yield get_term_from_row(row, genes)
+
+
+def write_json_list(items, out):
+    """
+    Writes `items` to `out` as a JSON list one item at a time
+    so `items` can be an iterator that is never held in memory
+
+    :param items: JSON serializable items
+    :type items: iterable
+    :param out: where to write
+    :type out: file
+    :return: None
+    """
+    out.write('[')
+    for idx, item in enumerate(items):
+        if idx > 0:
+            out.write(', ')
+        json.dump(item, out)
+    out.write(']')
+
+
+def write_result(theres, out):
+    """
+    Writes result of :py:func:`run_enrichr_on_genes` to `out`
+    as JSON
+
+    :param theres: term, list or iterator of terms, or ``None``
+    :param out: where to write
+    :type out: file
+    :return: None
+    """
+    if theres is None or isinstance(theres, dict):
+        json.dump(theres, out)
+        return
+    write_json_list(theres, out)
+
+
+def get_best_term(df_result, genes, theargs):
+    """
+    Gets best term in `df_result` as determined by Adjusted
+    P-value and then P-value, ignoring terms with Adjusted P-value
+    over `theargs.maxpval`. If `theargs.topk` is greater then 1
+    a list of up to that many best terms, best first, is returned
+    instead. Only the top rows are selected, the rest of
+    `df_result` is never sorted
+
+    :param df_result: enrichment results, see :py:func:`query_enrichr`
+    :type df_result: :py:class:`pandas.DataFrame`
+    :param genes: genes that were enriched
+    :type genes: list
+    :param theargs: parsed command line arguments
+    :type theargs: :py:class:`argparse.Namespace`
+    :return: best term, list of best terms if `theargs.topk` is
+             greater then 1, or ``None`` if none found
+    :rtype: dict or list
+    """
     if df_result.shape[0] == 0:
         sys.stderr.write('Empty data frame\n')
         return None
@@ -122,26 +1047,336 @@ def run_enrichr(inputfile, theargs,
     5  Jensen_DISEASES                 Carcinoma  1/11318  0.999993               1.0            0                     0    0.003910    2.732093e-08   TAT
     """
     # filter out any rows where min overlap is not met
-    df_result.drop(df_result[df_result[ADJUSTED_PVALUE] > theargs.maxpval].index,
-                   inplace=True)
+    df_result = df_result[df_result[ADJUSTED_PVALUE] <= theargs.maxpval]
     if df_result.shape[0] == 0:
         sys.stderr.write('Empty data frame after p value filter\n')
         return None
-    df_result.sort_values([ADJUSTED_PVALUE, PVALUE],
-                          ascending=True, inplace=True)
 
-    df_result.reset_index(drop=True, inplace=True)
-    theres = {'name': df_result['Term'][0],
-              'source': df_result['Gene_set'][0],
+    # partial selection of the k best rows instead of sorting them all
+    df_top = df_result.nsmallest(max(theargs.topk, 1),
+                                 [ADJUSTED_PVALUE, PVALUE])
+    terms = [get_term_from_row(row, genes)
+             for row in df_top.to_dict('records')]
+    if theargs.topk <= 1:
+        return terms[0]
+    return terms
+
+
+def get_term_from_row(row, genes):
+    """
+    Converts `row` of enrichment results into term dict output
+    by this tool
+
+    :param row: row of enrichment results, column name => value
+    :type row: dict
+    :param genes: genes that were enriched
+    :type genes: list
+    :return: term
+    :rtype: dict
+    """
+    overlap = str(row['Overlap'])
+    theres = {'name': row['Term'],
+              'source': row['Gene_set'],
               'sourceTermId': '',
-              'p_value': df_result[ADJUSTED_PVALUE][0],
+              'p_value': float(row[ADJUSTED_PVALUE]),
               'description': '',
-              'term_size': int(df_result['Overlap'][0][df_result['Overlap'][0].index('/')+1:]),
-              'intersections': df_result['Genes'][0].split(';')}
+              'term_size': int(overlap[overlap.index('/')+1:]),
+              'intersections': row['Genes'].split(';')}
     theres['jaccard'] = round(len(theres['intersections'])/len(genes), 3)
     return theres
 
 
+def run_enrichr_on_genes(genes, theargs, enrichr=None,
+                         retry_count=2, cache=None, single_flight=None):
+    """
+    Runs enrichment on `genes` and returns best term, or terms
+    if `theargs.topk` is greater then 1 or `theargs.allterms` is set.
+    In the latter case, unless `cache` or `single_flight` is set, the
+    terms are returned as an iterator, see :py:func:`get_ranked_terms`.
+    Genes are first normalized with :py:func:`normalize_genes` and
+    if none are left nothing is enriched
+
+    :param genes: upper case genes as returned by :py:func:`parse_genes`
+    :type genes: list
+    :param theargs: parsed command line arguments
+    :type theargs: :py:class:`argparse.Namespace`
+    :param enrichr: enrichment engine, if ``None`` one is picked
+                    via :py:func:`get_enrichr` but only if the
+                    result is not in `cache`
+    :param retry_count: number of times to try enrichment
+    :type retry_count: int
+    :param cache: if set, results are looked up in and stored to
+                  this cache
+    :type cache: :py:class:`~cdenrichrgenestoterm.resultcache.ResultCache`
+    :param single_flight: if set, a call made while an identical one,
+                          by :py:func:`get_cache_key`, is in flight on
+                          another thread waits for and shares its result
+    :type single_flight: :py:class:`~cdenrichrgenestoterm.singleflight.SingleFlight`
+    :return: best term or ``None`` if none found
+    :rtype: dict, list or iterator
+    """
+    if genes is None:
+        sys.stderr.write('No genes found in input')
+        return None
+    genes = normalize_genes(genes, alias_index=get_alias_index(theargs))[0]
+    if len(genes) == 0:
+        sys.stderr.write('No genes found in input')
+        return None
+    cache_key = None
+    if cache is not None or single_flight is not None:
+        cache_key = get_cache_key(genes, theargs)
+    if cache is not None:
+        found, theres = cache.lookup(cache_key)
+        if found is True:
+            metrics.get_metrics().increment('cache_hits')
+            return theres
+        metrics.get_metrics().increment('cache_misses')
+    if single_flight is None:
+        return _enrich_and_store(genes, theargs, enrichr, retry_count,
+                                 cache, cache_key)
+    return single_flight.do(cache_key, _enrich_and_store, genes=genes,
+                            theargs=theargs, enrichr=enrichr,
+                            retry_count=retry_count, cache=cache,
+                            cache_key=cache_key, materialize=True)[0]
+
+
+def _enrich_and_store(genes, theargs, enrichr, retry_count, cache,
+                      cache_key, materialize=False):
+    """
+    Core of :py:func:`run_enrichr_on_genes` run once cache and
+    single flight checks are done
+    """
+    if enrichr is None:
+        enrichr = get_enrichr(theargs)
+    elif isinstance(enrichr, _LazyEnrichr):
+        enrichr = enrichr.get()
+    df_result = query_enrichr(genes, theargs, enrichr,
+                              retry_count=retry_count)
+    if df_result is None:
+        return None
+    with metrics.get_metrics().time_stage('select'):
+        theres = _get_terms(df_result, genes, theargs,
+                            materialize=materialize or cache is not None)
+    if cache is not None:
+        cache.store(cache_key, theres)
+    return theres
+
+
+def _get_terms(df_result, genes, theargs, materialize=False):
+    """
+    Gets output for `df_result` via :py:func:`get_ranked_terms` if
+    `theargs.allterms` is set, converted to a list if `materialize`
+    is ``True``, otherwise via :py:func:`get_best_term`
+    """
+    if getattr(theargs, 'allterms', False) is True:
+        theres = get_ranked_terms(df_result, genes, theargs)
+        if materialize is True and theres is not None:
+            theres = list(theres)
+        return theres
+    return get_best_term(df_result, genes, theargs)
+
+
+def _write_record(record_id, theres, out):
+    """
+    Writes JSON ``{"id": `record_id`, "result": `theres`}`` line
+    to `out`
+    """
+    with metrics.get_metrics().time_stage('serialize'):
+        out.write('{"id": ' + json.dumps(record_id) + ', "result": ')
+        write_result(theres, out)
+        out.write('}\n')
+        out.flush()
+
+
+def _get_list_engine(enrichr, list_id):
+    """
+    Gets engine for gene list `list_id` from `enrichr` if it
+    keeps state per gene list, see
+    :py:meth:`~cdenrichrgenestoterm.incremental.IncrementalEnricher.get_engine`,
+    otherwise `enrichr`. If `enrichr` is not made yet neither is
+    the engine returned
+    """
+    if isinstance(enrichr, _LazyEnrichr):
+        return _LazyEnrichr(lambda: _get_list_engine(enrichr.get(),
+                                                     list_id))
+    if hasattr(enrichr, 'get_engine'):
+        return enrichr.get_engine(list_id)
+    return enrichr
+
+
+def run_enrichr_batch(inputfile, theargs, out=None,
+                      enrichr=None, retry_count=2, cache=None):
+    """
+    Runs enrichment on every gene list in batch `inputfile`
+    writing one JSON record per gene list to `out` as soon as
+    it is done. The enrichment engine is created on the first
+    gene list not in `cache` and reused for the rest
+
+    :param inputfile: batch input file, see
+                      :py:func:`read_batch_inputfile`
+    :type inputfile: str
+    :param theargs: parsed command line arguments
+    :type theargs: :py:class:`argparse.Namespace`
+    :param out: where to write results, if ``None``
+                :py:const:`sys.stdout` is used
+    :type out: file
+    :param enrichr: enrichment engine, if ``None`` one is picked
+                    via :py:func:`get_enrichr`
+    :param retry_count: number of times to try enrichment
+    :type retry_count: int
+    :param cache: result cache, if ``None`` one is created via
+                  :py:func:`get_result_cache`
+    :type cache: :py:class:`~cdenrichrgenestoterm.resultcache.ResultCache`
+    :return: number of gene lists processed
+    :rtype: int
+    """
+    if out is None:
+        out = sys.stdout
+    if cache is None:
+        cache = get_result_cache(theargs)
+    workers = getattr(theargs, 'workers', 1)
+    if workers is not None and workers > 1:
+        from cdenrichrgenestoterm.batchexecutor import BatchExecutor
+        executor = BatchExecutor(theargs, workers, enrichr=enrichr,
+                                 retry_count=retry_count, cache=cache)
+        return executor.run(read_batch_inputfile(inputfile), out)
+    if enrichr is None:
+        # checked here so bad arguments fail the batch once instead
+        # of every gene list that misses the cache
+        _is_local_engine(theargs)
+        enrichr = _LazyEnrichr(lambda: get_enrichr(theargs))
+    count = 0
+    for gene_list_id, genes in read_batch_inputfile(inputfile):
+        run_batch_record(gene_list_id, genes, theargs, out,
+                         enrichr=enrichr, retry_count=retry_count,
+                         cache=cache)
+        count += 1
+    return count
+
+
+def run_batch_record(gene_list_id, genes, theargs, out,
+                     enrichr=None, retry_count=2, cache=None):
+    """
+    Runs enrichment on one gene list of a batch and writes its
+    JSON ``{"id": ID, "result": RESULT}`` line to `out`. An error
+    is written to :py:const:`sys.stderr` and gives a ``null``
+    result so one bad gene list does not stop the batch
+
+    :param gene_list_id: id of gene list
+    :param genes: upper case genes as returned by :py:func:`parse_genes`
+                  or ``None`` if the gene list was invalid, which
+                  gives a ``null`` result
+    :type genes: list
+    :param theargs: parsed command line arguments
+    :type theargs: :py:class:`argparse.Namespace`
+    :param out: where to write result
+    :type out: file
+    :param enrichr: enrichment engine
+    :param retry_count: number of times to try enrichment
+    :type retry_count: int
+    :param cache: result cache or ``None``
+    :type cache: :py:class:`~cdenrichrgenestoterm.resultcache.ResultCache`
+    :return: None
+    """
+    if genes is None:
+        _write_record(gene_list_id, None, out)
+        return
+    try:
+        theres = run_enrichr_on_genes(genes, theargs,
+                                      enrichr=_get_list_engine(
+                                          enrichr, gene_list_id),
+                                      retry_count=retry_count,
+                                      cache=cache)
+    except Exception as e:
+        sys.stderr.write('Gene list ' + str(gene_list_id) +
+                         ' caught exception: ' + str(e) + '\n')
+        theres = None
+    _write_record(gene_list_id, theres, out)
+
+
+def run_enrichr_hierarchy(inputfile, theargs, out=None,
+                          enrichr=None, retry_count=2, cache=None):
+    """
+    Runs enrichment on every community in hierarchy `inputfile`
+    writing one JSON record per community to `out`, children
+    before parents. With a local engine all communities are
+    enriched in one pass by
+    :py:class:`~cdenrichrgenestoterm.hierarchy.HierarchyEnricher`
+    which reuses overlap counts of child communities. In that case
+    `cache` is only written to since reading a community from it
+    would leave its parents without the counts to build on. Other
+    engines enrich each community on its own via
+    :py:func:`run_enrichr_on_genes` and are only created on the
+    first community not in `cache`
+
+    :param inputfile: hierarchy file, see
+                      :py:func:`~cdenrichrgenestoterm.hierarchy.read_hierarchy_file`
+    :type inputfile: str
+    :param theargs: parsed command line arguments
+    :type theargs: :py:class:`argparse.Namespace`
+    :param out: where to write results, if ``None``
+                :py:const:`sys.stdout` is used
+    :type out: file
+    :param enrichr: enrichment engine, if ``None`` one is picked
+                    via :py:func:`get_enrichr`
+    :param retry_count: number of times to try enrichment
+    :type retry_count: int
+    :param cache: result cache, if ``None`` one is created via
+                  :py:func:`get_result_cache`
+    :type cache: :py:class:`~cdenrichrgenestoterm.resultcache.ResultCache`
+    :raises ValueError: if hierarchy is invalid
+    :return: number of communities processed
+    :rtype: int
+    """
+    from cdenrichrgenestoterm import hierarchy
+    if out is None:
+        out = sys.stdout
+    if enrichr is None:
+        if _is_local_engine(theargs) is True:
+            enrichr = get_enrichr(theargs)
+        else:
+            enrichr = _LazyEnrichr(lambda: get_enrichr(theargs))
+    if cache is None:
+        cache = get_result_cache(theargs)
+    with metrics.get_metrics().time_stage('input_read'):
+        communities, children = hierarchy.read_hierarchy_file(inputfile)
+    alias_index = get_alias_index(theargs)
+    communities = [(c_id, normalize_genes(genes,
+                                          alias_index=alias_index)[0])
+                   for c_id, genes in communities]
+    count = 0
+    if not hasattr(enrichr, 'get_library'):
+        genes_by_id = dict(communities)
+        for c_id in hierarchy.get_enrichment_order([x[0] for x in
+                                                    communities],
+                                                   children):
+            try:
+                theres = run_enrichr_on_genes(genes_by_id[c_id], theargs,
+                                              enrichr=enrichr,
+                                              retry_count=retry_count,
+                                              cache=cache)
+            except Exception as e:
+                sys.stderr.write('Community ' + str(c_id) +
+                                 ' caught exception: ' + str(e) + '\n')
+                theres = None
+            _write_record(c_id, theres, out)
+            count += 1
+        return count
+
+    enricher = hierarchy.HierarchyEnricher(enrichr,
+                                           get_libraries(theargs.genesets))
+    for c_id, genes, df_result in enricher.enrich(communities, children):
+        df_result = correct_pvalues(df_result, theargs)
+        with metrics.get_metrics().time_stage('select'):
+            theres = _get_terms(df_result, genes, theargs,
+                                materialize=cache is not None)
+        if cache is not None:
+            cache.store(get_cache_key(genes, theargs), theres)
+        _write_record(c_id, theres, out)
+        count += 1
+    return count
+
+
 def main(args):
     """
     Main entry point for program
@@ -151,7 +1386,9 @@ def main(args):
     :rtype: int
     """
     desc = """
-        Running Enrichr via gseapy 0.10.4 
+        Running Enrichr over a pool of keep-alive connections,
+        or via gseapy 0.10.4 if --gseapy is set, or, if --gmtdir is
+        set, locally against <gene set>.gmt files in that directory
 
         Takes file with comma delimited list of genes as input and
         outputs best matching term (as determined by Adjusted P value)
@@ -165,27 +1402,115 @@ def main(args):
          "description": "EMPTY STRING",
          "intersections": "List of Genes that intersect"
         }
+
+        If --topk is greater then 1 a list of up to that many
+        terms in the above format is output, best first.
+
+        If --allterms is set a list of every term under --maxpval
+        in the above format is output, best first. Use --offset
+        and --limit to page through it.
+
+        If --batch is set the input file holds many gene lists
+        and one JSON record is output per line for each of them.
+        If --hierarchy is set the input file holds a community
+        hierarchy and one JSON record is output per community
+
+        To start a persistent server that keeps libraries and
+        imports loaded between queries run:
+
+        cdenrichrgenestoterm.py serve -h
+
+        To compile <gene set>.gmt files in --gmtdir into a binary
+        format that is memory mapped instead of parsed run:
+
+        cdenrichrgenestoterm.py compile -h
+
+        To download gene set libraries into a versioned local
+        snapshot for use with --librarydir run:
+
+        cdenrichrgenestoterm.py library -h
+
+        To build an index that maps previous and alias gene
+        symbols to approved symbols for use with --aliasindex run:
+
+        cdenrichrgenestoterm.py aliases -h
         
     """
 
+    if len(args) > 1 and args[1] == SERVE_COMMAND:
+        from cdenrichrgenestoterm import server
+        return server.main(args[1:])
+
+    if len(args) > 1 and args[1] == COMPILE_COMMAND:
+        from cdenrichrgenestoterm import compiledlibrary
+        return compiledlibrary.main(args[1:])
+
+    if len(args) > 1 and args[1] == LIBRARY_COMMAND:
+        from cdenrichrgenestoterm import librarystore
+        return librarystore.main(args[1:])
+
+    if len(args) > 1 and args[1] == ALIASES_COMMAND:
+        from cdenrichrgenestoterm import aliasindex
+        return aliasindex.main(args[1:])
+
     theargs = _parse_arguments(desc, args[1:])
+    recorder = None
+    if metrics.is_requested(theargs):
+        recorder = metrics.StageMetrics()
+        start = time.perf_counter()
+        metrics.set_metrics(recorder)
 
+    out = sys.stdout
     try:
         inputfile = os.path.abspath(theargs.input)
-        theres = run_enrichr(inputfile, theargs)
+        # anything gseapy prints goes to stderr so only results are
+        # written to stdout. This is done here, before any threads
+        # are started, since redirect_stdout swaps sys.stdout for
+        # the whole process and is not safe to use concurrently
+        with redirect_stdout(sys.stderr):
+            if theargs.hierarchy is True:
+                run_enrichr_hierarchy(inputfile, theargs, out=out,
+                                      retry_count=theargs.retries)
+                out.flush()
+                return 0
+            if theargs.batch is True:
+                run_enrichr_batch(inputfile, theargs, out=out,
+                                  retry_count=theargs.retries)
+                out.flush()
+                return 0
+            theres = run_enrichr(inputfile, theargs,
+                                 retry_count=theargs.retries)
         sys.stderr.flush()
         if theres is None:
             sys.stderr.write('No terms found\n')
         else:
-            json.dump(theres, sys.stdout)
-        sys.stdout.flush()
+            with metrics.get_metrics().time_stage('serialize'):
+                write_result(theres, out)
+        out.flush()
         return 0
     except Exception as e:
         sys.stderr.write('Caught exception: ' + str(e))
         return 2
     finally:
+        if recorder is not None:
+            recorder.record('total', time.perf_counter() - start)
+            metrics.set_metrics(None)
+            try:
+                metrics.write_metrics(theargs, recorder)
+            except OSError as e:
+                sys.stderr.write('Unable to write metrics: ' + str(e) + '\n')
         sys.stderr.flush()
 
 
+def console_main():
+    """
+    Entry point for installed ``cdenrichrgenestoterm.py`` script
+
+    :return: 0 for success otherwise failure
+    :rtype: int
+    """
+    return main(sys.argv)
+
+
 if __name__ == '__main__':  # pragma: no cover
     sys.exit(main(sys.argv))
@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import mmap
+import struct
+import argparse
+import tempfile
+import numpy
+from scipy.sparse import csr_matrix
+
+from cdenrichrgenestoterm.localenrichr import TermLibrary
+from cdenrichrgenestoterm.localenrichr import get_gmt_file
+
+
+COMPILED_SUFFIX = '.tlib'
+"""
+Suffix of compiled gene set library files
+"""
+
+MAGIC = b'CDTLIB\x00\x01'
+"""
+First bytes of a compiled gene set library file, last byte is
+the format version
+"""
+
+ALIGNMENT = 64
+"""
+Byte alignment of each array in a compiled gene set library file
+"""
+
+_HEADER_LEN = struct.Struct('<Q')
+
+
+class StringTable(object):
+    """
+    Read only sequence of strings stored as one UTF-8 blob and an
+    array of offsets into it where string ``i`` is
+    ``blob[offsets[i]:offsets[i + 1]]``
+    """
+    def __init__(self, offsets, blob):
+        """
+        Constructor
+
+        :param offsets: start of each string plus end of last one
+        :type offsets: :py:class:`numpy.ndarray`
+        :param blob: UTF-8 bytes of all strings concatenated
+        :type blob: :py:class:`numpy.ndarray`
+        """
+        self._offsets = offsets
+        self._blob = blob
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        return self._blob[self._offsets[idx]:
+                          self._offsets[idx + 1]].tobytes().decode('utf-8')
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+class FixedWidthStringTable(object):
+    """
+    Read only sequence of strings stored as a sorted fixed width
+    bytes array so strings can be looked up with a binary search
+    """
+    def __init__(self, array):
+        """
+        Constructor
+
+        :param array: sorted UTF-8 strings
+        :type array: :py:class:`numpy.ndarray` with ``S`` dtype
+        """
+        self.array = array
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, idx):
+        return self.array[idx].decode('utf-8')
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def get_ids(self, strings):
+        """
+        Gets index of each of `strings` found in this table
+
+        :param strings: strings to look up
+        :type strings: list
+        :return: sorted unique indexes of `strings` found
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        width = self.array.dtype.itemsize
+        encoded = [x.encode('utf-8') for x in set(strings)]
+        # longer strings cannot be in table and would be truncated
+        query = numpy.array([x for x in encoded if len(x) <= width],
+                            dtype=self.array.dtype)
+        if len(query) == 0 or len(self.array) == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        pos = numpy.searchsorted(self.array, query)
+        pos = numpy.minimum(pos, len(self.array) - 1)
+        found = pos[self.array[pos] == query]
+        return numpy.unique(found).astype(numpy.int64)
+
+
+class CompiledTermLibrary(TermLibrary):
+    """
+    :py:class:`~cdenrichrgenestoterm.localenrichr.TermLibrary` whose
+    arrays are memory mapped from a compiled library file written by
+    :py:func:`write_compiled_library`. Nothing is parsed or copied
+    on load and processes mapping the same file share its pages in
+    the page cache
+    """
+    def __init__(self, name, genes, terms, matrix, term_sizes,
+                 checksum=None):
+        """
+        Constructor
+
+        :param name: name of library
+        :type name: str
+        :param genes: gene symbols, index is the gene id
+        :type genes: :py:class:`FixedWidthStringTable`
+        :param terms: term names, index is the term id
+        :type terms: :py:class:`StringTable`
+        :param matrix: gene by term incidence matrix
+        :type matrix: :py:class:`scipy.sparse.csr_matrix`
+        :param term_sizes: number of genes in each term
+        :type term_sizes: :py:class:`numpy.ndarray`
+        :param checksum: as returned by
+                         :py:meth:`~cdenrichrgenestoterm.localenrichr.TermLibrary.get_checksum`
+                         when compiled, ``None`` to compute it when
+                         first asked for
+        :type checksum: str
+        """
+        self.name = name
+        self.genes = genes
+        self.terms = terms
+        self._matrix = matrix
+        self.term_sizes = term_sizes
+        self._checksum = checksum
+
+    def get_gene_ids(self, gene_list):
+        """
+        Maps `gene_list` to sorted unique gene ids with a binary
+        search of the gene table, genes not in this library are
+        dropped
+
+        :param gene_list: gene symbols
+        :type gene_list: list
+        :return: gene ids
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        return self.genes.get_ids(gene_list)
+
+
+def get_compiled_file(gmtdir, library):
+    """
+    Gets path of compiled file for `library` in `gmtdir`, which
+    may not exist
+
+    :param gmtdir: directory of gene set libraries
+    :type gmtdir: str
+    :param library: name of library
+    :type library: str
+    :return: path
+    :rtype: str
+    """
+    return os.path.join(gmtdir, library + COMPILED_SUFFIX)
+
+
+def _get_index_dtype(library):
+    if max(library._matrix.nnz, len(library.genes),
+           len(library.terms)) < 2 ** 31:
+        return numpy.dtype('<i4')
+    return numpy.dtype('<i8')
+
+
+def _get_arrays(library):
+    """
+    Gets arrays to store for `library` as name => array
+    """
+    index_dtype = _get_index_dtype(library)
+    matrix = library._matrix.tocsr()
+    matrix.sort_indices()
+    gene_bytes = [g.encode('utf-8') for g in library.genes]
+    width = max([len(g) for g in gene_bytes] + [1])
+    term_bytes = [t.encode('utf-8') for t in library.terms]
+    term_offsets = numpy.zeros(len(term_bytes) + 1, dtype='<i8')
+    term_offsets[1:] = numpy.cumsum(numpy.array([len(t) for t in term_bytes],
+                                                dtype='<i8'))
+    return {'indptr': matrix.indptr.astype(index_dtype),
+            'indices': matrix.indices.astype(index_dtype),
+            'data': numpy.ones(matrix.nnz, dtype=numpy.int8),
+            'term_sizes': numpy.asarray(library.term_sizes,
+                                        dtype=index_dtype),
+            'genes': numpy.array(gene_bytes, dtype='S' + str(width)),
+            'term_offsets': term_offsets,
+            'term_names': numpy.frombuffer(b''.join(term_bytes),
+                                           dtype=numpy.uint8)}
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_array_file(path, magic, header, arrays):
+    """
+    Writes `arrays` to `path` as `magic`, an 8 byte little endian
+    header length, a JSON header and then each array aligned to
+    :py:const:`ALIGNMENT` bytes. The header is `header` plus the
+    offset, dtype and length of each array. The file is written to
+    a temporary name and renamed into place so readers never see a
+    partial file
+
+    :param path: path to write to
+    :type path: str
+    :param magic: first bytes of file
+    :type magic: bytes
+    :param header: JSON serializable values to store in header
+    :type header: dict
+    :param arrays: name => one dimensional array
+    :type arrays: dict
+    :return: None
+    """
+    names = sorted(arrays.keys())
+    header = dict(header)
+    header['arrays'] = {}
+
+    # header size depends on offsets so compute offsets relative
+    # to start of data and place data after the padded header
+    rel_offset = 0
+    for name in names:
+        header['arrays'][name] = {'offset': rel_offset,
+                                  'dtype': arrays[name].dtype.str,
+                                  'count': len(arrays[name])}
+        rel_offset = _align(rel_offset + arrays[name].nbytes)
+    header_bytes = json.dumps(header, sort_keys=True).encode('utf-8')
+    data_start = _align(len(magic) + _HEADER_LEN.size + len(header_bytes))
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                    suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(magic)
+            f.write(_HEADER_LEN.pack(len(header_bytes)))
+            f.write(header_bytes)
+            for name in names:
+                f.seek(data_start + header['arrays'][name]['offset'])
+                f.write(arrays[name].tobytes())
+            f.truncate(data_start + rel_offset)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def load_array_file(path, magic):
+    """
+    Memory maps file at `path` written by :py:func:`write_array_file`
+
+    :param path: path to file
+    :type path: str
+    :param magic: expected first bytes of file
+    :type magic: bytes
+    :raises ValueError: if `path` does not start with `magic`
+    :return: (header, name => read only array backed by the mapping)
+    :rtype: tuple
+    """
+    with open(path, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    prefix_len = len(magic) + _HEADER_LEN.size
+    if len(mapped) < prefix_len or mapped[:len(magic)] != magic:
+        mapped.close()
+        raise ValueError(path + ' is not of the expected format')
+    header_len = _HEADER_LEN.unpack(mapped[len(magic):prefix_len])[0]
+    header = json.loads(mapped[prefix_len:prefix_len +
+                               header_len].decode('utf-8'))
+    data_start = _align(prefix_len + header_len)
+    arrays = {}
+    for name, info in header['arrays'].items():
+        arrays[name] = numpy.frombuffer(mapped, dtype=info['dtype'],
+                                        count=info['count'],
+                                        offset=data_start + info['offset'])
+    return header, arrays
+
+
+def write_compiled_library(library, path):
+    """
+    Writes `library` to `path` in the compiled format, see
+    :py:func:`write_array_file`, with :py:const:`MAGIC` and
+    the library name, dimensions and checksum in the header
+
+    :param library: library to write
+    :type library: :py:class:`~cdenrichrgenestoterm.localenrichr.TermLibrary`
+    :param path: path to write to
+    :type path: str
+    :return: None
+    """
+    write_array_file(path, MAGIC, {'name': library.name,
+                                   'num_genes': len(library.genes),
+                                   'num_terms': len(library.terms),
+                                   'checksum': library.get_checksum()},
+                     _get_arrays(library))
+
+
+def load_compiled_library(path):
+    """
+    Memory maps compiled library file at `path`
+
+    :param path: path to file written by :py:func:`write_compiled_library`
+    :type path: str
+    :raises ValueError: if `path` is not a compiled library file
+    :return: library
+    :rtype: :py:class:`CompiledTermLibrary`
+    """
+    try:
+        header, arrays = load_array_file(path, MAGIC)
+    except ValueError:
+        raise ValueError(path + ' is not a compiled gene set library')
+    matrix = csr_matrix((arrays['data'], arrays['indices'],
+                         arrays['indptr']),
+                        shape=(header['num_genes'], header['num_terms']),
+                        copy=False)
+    return CompiledTermLibrary(header['name'],
+                               FixedWidthStringTable(arrays['genes']),
+                               StringTable(arrays['term_offsets'],
+                                           arrays['term_names']),
+                               matrix, arrays['term_sizes'],
+                               checksum=header.get('checksum'))
+
+
+def compile_library(gmtdir, library, outdir=None):
+    """
+    Compiles ``<library>.gmt`` in `gmtdir` to
+    ``<library>.tlib`` in `outdir`
+
+    :param gmtdir: directory containing ``<library>.gmt`` files
+    :type gmtdir: str
+    :param library: name of library
+    :type library: str
+    :param outdir: directory to write to, if ``None`` `gmtdir` is used
+    :type outdir: str
+    :raises LookupError: if no GMT file exists for `library`
+    :return: path to compiled file
+    :rtype: str
+    """
+    if outdir is None:
+        outdir = gmtdir
+    term_library = TermLibrary.from_gmt_file(library,
+                                             get_gmt_file(gmtdir, library))
+    path = get_compiled_file(outdir, library)
+    write_compiled_library(term_library, path)
+    return path
+
+
+class Formatter(argparse.ArgumentDefaultsHelpFormatter,
+                argparse.RawDescriptionHelpFormatter):
+    pass
+
+
+def _parse_arguments(desc, args):
+    """
+    Parses command line arguments
+    :param desc:
+    :param args:
+    :return:
+    """
+    from cdenrichrgenestoterm import cdenrichrgenestoterm
+    help_fm = Formatter
+    parser = argparse.ArgumentParser(description=desc,
+                                     formatter_class=help_fm)
+    parser.add_argument('--gmtdir', required=True,
+                        help='Directory containing <gene set>.gmt files')
+    parser.add_argument('--genesets',
+                        default=cdenrichrgenestoterm.DEFAULT_GENESETS,
+                        help='Gene sets to compile. '
+                             'Should be comma delimited')
+    parser.add_argument('--outdir',
+                        help='Directory to write <gene set>' +
+                             COMPILED_SUFFIX + ' files to, if unset '
+                             '--gmtdir is used')
+    return parser.parse_args(args)
+
+
+def main(args):
+    """
+    Main entry point for compile command
+
+    :param args: command line arguments with first argument being
+                 :py:const:`~cdenrichrgenestoterm.cdenrichrgenestoterm.COMPILE_COMMAND`
+    :return: 0 for success otherwise failure
+    :rtype: int
+    """
+    desc = """
+        Compiles <gene set>.gmt files into a binary format that
+        is memory mapped at query time instead of parsed. When
+        --gmtdir is passed to the command line tool or server a
+        <gene set>""" + COMPILED_SUFFIX + """ file there is used in
+        place of <gene set>.gmt unless the latter is newer.
+    """
+    theargs = _parse_arguments(desc, args[1:])
+    try:
+        from cdenrichrgenestoterm import cdenrichrgenestoterm
+        for library in cdenrichrgenestoterm.get_libraries(theargs.genesets):
+            path = compile_library(theargs.gmtdir, library,
+                                   outdir=theargs.outdir)
+            sys.stderr.write('Wrote ' + path + '\n')
+        return 0
+    except Exception as e:
+        sys.stderr.write('Caught exception: ' + str(e))
+        return 2
+    finally:
+        sys.stderr.flush()
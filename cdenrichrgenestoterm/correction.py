@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+import numpy
+
+
+BENJAMINI_HOCHBERG = 'bh'
+"""
+Benjamini-Hochberg false discovery rate correction
+"""
+
+BONFERRONI = 'bonferroni'
+"""
+Bonferroni family wise error rate correction
+"""
+
+
+def benjamini_hochberg(pvals):
+    """
+    Benjamini-Hochberg adjustment of `pvals` done with one sort
+    and a cumulative minimum so it scales to hundreds of thousands
+    of P-values
+
+    :param pvals: P-values
+    :type pvals: list or :py:class:`numpy.ndarray`
+    :return: adjusted P-values in same order as `pvals`
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    pvals = numpy.asarray(pvals, dtype=numpy.float64)
+    num_pvals = pvals.shape[0]
+    if num_pvals == 0:
+        return pvals
+    order = numpy.argsort(pvals)[::-1]
+    ranks = numpy.arange(num_pvals, 0, -1)
+    adjusted = numpy.minimum.accumulate(pvals[order] * num_pvals / ranks)
+    res = numpy.empty(num_pvals, dtype=numpy.float64)
+    res[order] = numpy.minimum(adjusted, 1.0)
+    return res
+
+
+def bonferroni(pvals):
+    """
+    Bonferroni adjustment of `pvals`
+
+    :param pvals: P-values
+    :type pvals: list or :py:class:`numpy.ndarray`
+    :return: adjusted P-values in same order as `pvals`
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    pvals = numpy.asarray(pvals, dtype=numpy.float64)
+    return numpy.minimum(pvals * pvals.shape[0], 1.0)
+
+
+_METHODS = {BENJAMINI_HOCHBERG: benjamini_hochberg,
+            BONFERRONI: bonferroni}
+
+
+def adjust_pvalues(pvals, method):
+    """
+    Adjusts `pvals` for multiple testing with `method`
+
+    :param pvals: P-values of every test
+    :type pvals: list or :py:class:`numpy.ndarray`
+    :param method: :py:const:`BENJAMINI_HOCHBERG` or
+                   :py:const:`BONFERRONI`
+    :type method: str
+    :raises ValueError: if `method` is unknown
+    :return: adjusted P-values in same order as `pvals`
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    if method not in _METHODS:
+        raise ValueError('Unknown correction: ' + str(method))
+    return _METHODS[method](pvals)
@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import time
+import threading
+import collections
+
+from cdenrichrgenestoterm import metrics
+from cdenrichrgenestoterm.singleflight import SingleFlight
+
+
+ENRICHR_URL = 'https://maayanlab.cloud/Enrichr'
+"""
+Base URL of the Enrichr service
+"""
+
+DEFAULT_POOL_SIZE = 10
+"""
+Max number of keep-alive connections kept open to Enrichr
+"""
+
+MAX_LIST_IDS = 1024
+"""
+Max number of uploaded gene list ids remembered by
+:py:class:`PooledEnrichr`
+"""
+
+
+def read_export_report(report, library):
+    """
+    Parses tab delimited `report` exported by Enrichr for `library`
+    keeping only the columns in
+    :py:const:`~cdenrichrgenestoterm.cdenrichrgenestoterm.RESULT_DTYPES`
+
+    :param report: report as returned by :py:meth:`EnrichrClient.export`
+    :type report: str
+    :param library: name of gene set library, set as ``Gene_set``
+                    column if report does not have one
+    :type library: str
+    :return: results
+    :rtype: :py:class:`pandas.DataFrame`
+    """
+    import pandas
+    from cdenrichrgenestoterm import cdenrichrgenestoterm
+    if len(report.strip()) == 0:
+        return pandas.DataFrame()
+    df = pandas.read_csv(io.StringIO(report), delimiter='\t', header=0,
+                         usecols=lambda x: x in
+                         cdenrichrgenestoterm.RESULT_DTYPES,
+                         dtype=cdenrichrgenestoterm.RESULT_DTYPES)
+    if 'Gene_set' not in df.columns:
+        df.insert(0, 'Gene_set', library)
+    return df
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket rate limiter. Tokens are added at
+    `rate` per second up to `burst` and each request takes one,
+    waiting for it if none are left. Requests are granted in the
+    order they ask so none starves under load. A `rate` of 0 or
+    less means no limit, though the bucket can still be paused
+    with :py:meth:`defer`, such as when the server answers with
+    HTTP 429 and a Retry-After header
+    """
+    def __init__(self, rate, burst=1, clock=time.monotonic,
+                 sleep=time.sleep):
+        """
+        Constructor
+
+        :param rate: tokens added per second
+        :type rate: float
+        :param burst: max number of tokens, i.e. max requests
+                      made at once after a quiet period
+        :type burst: int
+        :param clock: function returning current time in seconds
+        :param sleep: function used to wait for a token
+        """
+        self._rate = rate if rate is not None and rate > 0 else None
+        self._burst = max(burst, 1)
+        self._clock = clock
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tokens = float(self._burst)
+        self._last = clock()
+        self._paused_until = None
+
+    def reserve(self):
+        """
+        Takes a token and gets how long to wait before using it
+
+        :return: seconds to wait
+        :rtype: float
+        """
+        with self._lock:
+            now = self._clock()
+            delay = 0.0
+            if self._paused_until is not None:
+                delay = max(self._paused_until - now, 0.0)
+            if self._rate is not None:
+                self._tokens = min(float(self._burst),
+                                   self._tokens +
+                                   (now - self._last) * self._rate)
+                self._last = now
+                self._tokens -= 1.0
+                if self._tokens < 0:
+                    delay = max(delay, -self._tokens / self._rate)
+            return delay
+
+    def acquire(self):
+        """
+        Waits for a token
+
+        :return: seconds waited
+        :rtype: float
+        """
+        delay = self.reserve()
+        if delay > 0:
+            with metrics.get_metrics().time_stage('rate_limit_wait'):
+                self._sleep(delay)
+        return delay
+
+    def defer(self, seconds):
+        """
+        Makes every request wait until `seconds` from now
+
+        :param seconds: seconds to pause for
+        :type seconds: float
+        :return: None
+        """
+        with self._lock:
+            until = self._clock() + seconds
+            if self._paused_until is None or until > self._paused_until:
+                self._paused_until = until
+
+
+class EnrichrResponseError(OSError):
+    """
+    Raised when Enrichr answers with a 2xx status but a body that
+    is not the expected JSON, such as the HTML error page of a
+    proxy in front of it. Unlike a :py:class:`ValueError` it is
+    retried
+    """
+    pass
+
+
+def _get_retry_after(response):
+    """
+    Gets seconds from Retry-After header of `response` or ``None``
+    if it is missing or an HTTP date, which Enrichr does not send
+    """
+    try:
+        return max(float(response.headers.get('Retry-After')), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+class EnrichrClient(object):
+    """
+    Thread safe client of the Enrichr API that keeps a pool of up
+    to `pool_size` keep-alive connections, so queries do not pay for
+    a new connection and TLS handshake on every request as with
+    :py:mod:`gseapy`, and passes every request through `rate_limiter`
+    so a process stays under the quota of the server.
+
+    :py:mod:`requests` is imported and the session created on the
+    first request. A process forked after that, such as a batch
+    worker, gets its own session instead of sharing the sockets
+    """
+    def __init__(self, url=ENRICHR_URL, pool_size=DEFAULT_POOL_SIZE,
+                 rate_limiter=None, timeout=None):
+        """
+        Constructor
+
+        :param url: base URL of Enrichr or a service with the same API
+        :type url: str
+        :param pool_size: max number of connections kept open, requests
+                          beyond this wait for a free connection
+        :type pool_size: int
+        :param rate_limiter: limiter each request must get a token
+                             from, if ``None`` requests are not limited
+        :type rate_limiter: :py:class:`TokenBucket`
+        :param timeout: max seconds to connect or wait for data,
+                        ``None`` for no limit. Set it so a hung
+                        connection does not hold a pool slot forever
+                        after its try is abandoned
+        :type timeout: float
+        """
+        if not url.startswith('http://') and \
+                not url.startswith('https://'):
+            raise ValueError('URL must be http or https: ' + url)
+        self._url = url.rstrip('/')
+        self._pool_size = max(pool_size, 1)
+        if rate_limiter is None:
+            rate_limiter = TokenBucket(0)
+        self._rate_limiter = rate_limiter
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+
+    def _get_session(self):
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=self._pool_size,
+                                      pool_block=True, max_retries=0)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+                self._pid = os.getpid()
+            return self._session
+
+    def request(self, method, path, timeout=None, **kwargs):
+        """
+        Makes request once a token is available from the rate limiter.
+        If the server answers with HTTP 429 and a Retry-After header
+        the rate limiter is paused for that long so other threads
+        back off too
+
+        :param method: HTTP method
+        :type method: str
+        :param path: path under base URL
+        :type path: str
+        :param timeout: max seconds to connect or wait for data, if
+                        ``None`` the timeout of this client is used
+        :type timeout: float
+        :raises requests.HTTPError: if status is not 2xx, status is
+                                    in ``response.status_code``
+        :return: response
+        :rtype: :py:class:`requests.Response`
+        """
+        session = self._get_session()
+        self._rate_limiter.acquire()
+        if timeout is None:
+            timeout = self._timeout
+        response = session.request(method, self._url + path,
+                                   timeout=timeout, **kwargs)
+        if response.status_code == 429:
+            retry_after = _get_retry_after(response)
+            if retry_after is not None:
+                self._rate_limiter.defer(retry_after)
+        response.raise_for_status()
+        return response
+
+    def add_list(self, genes, description='cdenrichrgenestoterm',
+                 timeout=None):
+        """
+        Uploads `genes` to Enrichr
+
+        :param genes: genes
+        :type genes: list
+        :param description: description of list
+        :type description: str
+        :param timeout: see :py:meth:`request`
+        :type timeout: float
+        :raises EnrichrResponseError: if response holds no list id
+        :return: id of list to pass to :py:meth:`export`
+        :rtype: int
+        """
+        res = self.request('POST', '/addList', timeout=timeout,
+                           files={'list': (None, '\n'.join(genes)),
+                                  'description': (None, description)})
+        try:
+            return res.json()['userListId']
+        except (ValueError, TypeError, KeyError) as e:
+            raise EnrichrResponseError('No list id in response from ' +
+                                       res.url + ' with status ' +
+                                       str(res.status_code) + ': ' +
+                                       res.text[:100]) from e
+
+    def export(self, user_list_id, library, timeout=None):
+        """
+        Gets enrichment results of list `user_list_id` against
+        `library` in the tab delimited format of a gseapy report file
+
+        :param user_list_id: id from :py:meth:`add_list`
+        :type user_list_id: int
+        :param library: name of gene set library
+        :type library: str
+        :param timeout: see :py:meth:`request`
+        :type timeout: float
+        :return: results
+        :rtype: str
+        """
+        res = self.request('GET', '/export', timeout=timeout,
+                           params={'userListId': user_list_id,
+                                   'filename': 'enrichr',
+                                   'backgroundType': library})
+        return res.text
+
+    def close(self):
+        """
+        Closes pooled connections
+
+        :return: None
+        """
+        with self._lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+
+
+class EnrichrResult(object):
+    """
+    Results of :py:meth:`PooledEnrichr.enrichr`
+    """
+    def __init__(self, results):
+        self.results = results
+
+
+class PooledEnrichr(object):
+    """
+    Queries the Enrichr service with a shared
+    :py:class:`EnrichrClient`. Each gene list is uploaded once and
+    its id reused for every library it is enriched against, even
+    when the libraries are queried at once from several threads
+    """
+    results_in_memory = True
+    """
+    Results are returned in ``results`` attribute so no
+    report files need to be written
+    """
+
+    supports_timeout = True
+    """
+    Each request gives up after the `timeout` passed to
+    :py:meth:`enrichr` so a try can be limited without leaving
+    anything running
+    """
+
+    def __init__(self, client):
+        """
+        Constructor
+
+        :param client: client to query Enrichr with
+        :type client: :py:class:`EnrichrClient`
+        """
+        self._client = client
+        self._lock = threading.Lock()
+        self._list_ids = collections.OrderedDict()
+        self._uploads = SingleFlight(counter=None)
+
+    def _get_list_id(self, genes, timeout=None):
+        key = tuple(genes)
+        with self._lock:
+            if key in self._list_ids:
+                self._list_ids.move_to_end(key)
+                return self._list_ids[key]
+        list_id = self._uploads.do(key, self._client.add_list,
+                                   genes=list(genes), timeout=timeout)[0]
+        with self._lock:
+            self._list_ids[key] = list_id
+            while len(self._list_ids) > MAX_LIST_IDS:
+                self._list_ids.popitem(last=False)
+        return list_id
+
+    def enrichr(self, gene_list, gene_sets, timeout=None, **kwargs):
+        """
+        Enriches `gene_list` against `gene_sets`. Other arguments
+        of :py:func:`gseapy.enrichr`, such as `cutoff` and `outdir`,
+        are accepted and ignored since every result is returned
+
+        :param gene_list: genes
+        :type gene_list: list
+        :param gene_sets: comma delimited gene set library names
+        :type gene_sets: str
+        :param timeout: max seconds to connect or wait for data
+                        on each request, see :py:meth:`EnrichrClient.request`
+        :type timeout: float
+        :return: object with results in ``results`` attribute
+        :rtype: :py:class:`EnrichrResult`
+        """
+        import pandas
+        if isinstance(gene_sets, str):
+            gene_sets = [x.strip() for x in gene_sets.split(',')
+                         if len(x.strip()) > 0]
+        list_id = self._get_list_id(gene_list, timeout=timeout)
+        d_frames = []
+        for library in gene_sets:
+            report = self._client.export(list_id, library, timeout=timeout)
+            d_frames.append(read_export_report(report, library))
+        d_frames = [df for df in d_frames if df.shape[0] > 0]
+        if len(d_frames) == 0:
+            return EnrichrResult(pandas.DataFrame())
+        if len(d_frames) == 1:
+            return EnrichrResult(d_frames[0])
+        return EnrichrResult(pandas.concat(d_frames, ignore_index=True))
+
+
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def get_client(theargs):
+    """
+    Gets client for settings in `theargs`, creating it on first
+    use so every query in the process shares its connections and
+    rate limit
+
+    :param theargs: parsed command line arguments
+    :type theargs: :py:class:`argparse.Namespace`
+    :return: client
+    :rtype: :py:class:`EnrichrClient`
+    """
+    timeout = getattr(theargs, 'timeout', None)
+    if timeout is not None and timeout <= 0:
+        timeout = None
+    key = (getattr(theargs, 'url', ENRICHR_URL),
+           getattr(theargs, 'poolsize', DEFAULT_POOL_SIZE),
+           getattr(theargs, 'ratelimit', 0),
+           getattr(theargs, 'rateburst', 1), timeout)
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(key)
+        if client is None:
+            client = EnrichrClient(url=key[0], pool_size=key[1],
+                                   rate_limiter=TokenBucket(key[2],
+                                                            burst=key[3]),
+                                   timeout=timeout)
+            _CLIENTS[key] = client
+        return client
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from cdenrichrgenestoterm import metrics
+from cdenrichrgenestoterm import incremental
+
+
+def read_hierarchy_file(inputfile):
+    """
+    Reads a community hierarchy from JSON `inputfile` of form:
+
+    .. code-block::
+
+        {
+         "communities": [{"id": ID, "genes": GENES}, ...],
+         "edges": [[PARENT ID, CHILD ID], ...]
+        }
+
+    where GENES is a list or a comma delimited string and each
+    edge can also be a ``{"parent": ID, "child": ID}`` object
+
+    :param inputfile: path to hierarchy file
+    :type inputfile: str
+    :raises ValueError: if file is not a valid hierarchy
+    :return: (list of (id, genes) tuples with genes as returned by
+             :py:func:`~cdenrichrgenestoterm.cdenrichrgenestoterm.parse_genes`,
+             dict of parent id => list of child ids)
+    :rtype: tuple
+    """
+    from cdenrichrgenestoterm.cdenrichrgenestoterm import parse_genes
+    with open(inputfile, 'r') as f:
+        data = json.load(f)
+    if not isinstance(data, dict) or 'communities' not in data:
+        raise ValueError('Hierarchy must be a JSON object with communities')
+    communities = []
+    for community in data['communities']:
+        genes = community['genes']
+        if not isinstance(genes, str):
+            genes = ','.join(genes)
+        communities.append((community['id'], parse_genes(genes)))
+    children = {}
+    for edge in data.get('edges', []):
+        if isinstance(edge, dict):
+            parent, child = edge['parent'], edge['child']
+        else:
+            parent, child = edge
+        children.setdefault(parent, []).append(child)
+    return communities, children
+
+
+def get_enrichment_order(community_ids, children):
+    """
+    Orders `community_ids` so every community comes after all of
+    its children, keeping input order otherwise
+
+    :param community_ids: ids of communities
+    :type community_ids: list
+    :param children: parent id => list of child ids
+    :type children: dict
+    :raises ValueError: if an edge names an unknown community or
+                        the hierarchy has a cycle
+    :return: ordered ids
+    :rtype: list
+    """
+    known = set(community_ids)
+    for parent, child_ids in children.items():
+        for c_id in [parent] + list(child_ids):
+            if c_id not in known:
+                raise ValueError('Edge names unknown community ' +
+                                 str(c_id))
+    order = []
+    done = set()
+    in_progress = set()
+    for root in community_ids:
+        if root in done:
+            continue
+        # iterative depth first post order so deep hierarchies
+        # do not hit the recursion limit
+        stack = [(root, iter(children.get(root, [])))]
+        in_progress.add(root)
+        while len(stack) > 0:
+            node, child_iter = stack[-1]
+            child = next(child_iter, None)
+            if child is None:
+                stack.pop()
+                in_progress.discard(node)
+                done.add(node)
+                order.append(node)
+                continue
+            if child in done:
+                continue
+            if child in in_progress:
+                raise ValueError('Hierarchy has a cycle at community ' +
+                                 str(child))
+            in_progress.add(child)
+            stack.append((child, iter(children.get(child, []))))
+    return order
+
+
+class HierarchyEnricher(object):
+    """
+    Enriches every community of a hierarchy against local gene set
+    libraries in one pass. Parent communities in a hierarchy are
+    unions of their children so instead of enriching every community
+    from scratch, the state of its largest child, see
+    :py:class:`~cdenrichrgenestoterm.incremental.LibraryState`, is
+    updated with the genes the parent adds. Only the library rows of
+    those genes are read and only the terms holding one of them get
+    new hit genes, see
+    :py:func:`~cdenrichrgenestoterm.incremental.update_state`. States
+    of a community are dropped once all of its parents are done so
+    memory holds only the current frontier. Results are identical to
+    enriching each community on its own.
+    """
+    def __init__(self, enrichr, libraries):
+        """
+        Constructor
+
+        :param enrichr: local enrichment engine
+        :type enrichr: :py:class:`~cdenrichrgenestoterm.localenrichr.LocalEnrichr`
+        :param libraries: names of gene set libraries
+        :type libraries: list
+        """
+        self._enrichr = enrichr
+        self._libraries = libraries
+        self.num_reused = 0
+        """
+        Number of community and library pairs whose state
+        came from a child
+        """
+
+    def _get_state(self, library, gene_ids, child_states):
+        """
+        Gets state of `gene_ids`, updating the state of the largest
+        child in `child_states` that is a subset
+        """
+        import numpy
+        base = None
+        for c_state in child_states:
+            c_ids = c_state.gene_ids
+            if base is not None and len(c_ids) <= len(base.gene_ids):
+                continue
+            if len(c_ids) > 0 and numpy.all(numpy.isin(c_ids, gene_ids,
+                                                       assume_unique=True)):
+                base = c_state
+        if base is None:
+            return incremental.get_state(library, gene_ids)
+        self.num_reused += 1
+        return incremental.update_state(library, base, gene_ids)[0]
+
+    def enrich(self, communities, children):
+        """
+        Generator that enriches each of `communities`, children
+        before parents
+
+        :param communities: list of (id, genes) tuples
+        :type communities: list
+        :param children: parent id => list of child ids
+        :type children: dict
+        :raises ValueError: if hierarchy is invalid, see
+                            :py:func:`get_enrichment_order`
+        :return: (id, genes, results) for each community where
+                 results are all libraries combined in the format
+                 of :py:meth:`~cdenrichrgenestoterm.localenrichr.TermLibrary.enrich`
+        :rtype: tuple
+        """
+        import pandas
+        genes_by_id = dict(communities)
+        order = get_enrichment_order([x[0] for x in communities], children)
+        num_parents = {}
+        for child_ids in children.values():
+            for child in child_ids:
+                num_parents[child] = num_parents.get(child, 0) + 1
+        libraries = [self._enrichr.get_library(x) for x in self._libraries]
+        states = {}
+        for c_id in order:
+            genes = genes_by_id[c_id]
+            child_ids = children.get(c_id, [])
+            c_states = []
+            d_frames = []
+            for lib_idx, library in enumerate(libraries):
+                with metrics.get_metrics().time_stage('enrich',
+                                                      library=library.name):
+                    state = self._get_state(library,
+                                            library.get_gene_ids(genes),
+                                            [states[x][lib_idx]
+                                             for x in child_ids
+                                             if x in states])
+                    c_states.append(state)
+                    df = state.get_results(library)
+                if df.shape[0] > 0:
+                    d_frames.append(df)
+            if num_parents.get(c_id, 0) > 0:
+                states[c_id] = c_states
+            for child in child_ids:
+                num_parents[child] -= 1
+                if num_parents[child] == 0:
+                    states.pop(child, None)
+            if len(d_frames) == 0:
+                df_result = pandas.DataFrame()
+            else:
+                df_result = pandas.concat(d_frames)
+                df_result.reset_index(drop=True, inplace=True)
+            yield c_id, genes, df_result
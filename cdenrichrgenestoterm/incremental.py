@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import collections
+
+from cdenrichrgenestoterm import metrics
+
+
+STATE_SUFFIX = '.json'
+"""
+Suffix of files holding the state of a gene list
+"""
+
+DEFAULT_MAX_STATES = 10000
+"""
+Max number of gene list and library states kept in memory
+"""
+
+
+class LibraryState(object):
+    """
+    What enriching a gene list against one library left behind:
+    the query gene ids and, for each term that overlaps them, its
+    overlap count, P-value and hit genes. Enough to get the results
+    of a slightly different gene list without rescoring the library,
+    see :py:func:`update_state`. A state read from a file holds only
+    the gene ids and overlap counts, its P-values and hit genes are
+    ``None`` until they are computed from the library
+    """
+    def __init__(self, gene_ids, term_ids, overlaps, pvals, hits):
+        """
+        Constructor
+
+        :param gene_ids: sorted query gene ids
+        :type gene_ids: :py:class:`numpy.ndarray`
+        :param term_ids: sorted ids of terms that overlap the query
+        :type term_ids: :py:class:`numpy.ndarray`
+        :param overlaps: overlap count of each of `term_ids`
+        :type overlaps: :py:class:`numpy.ndarray`
+        :param pvals: P-value of each of `term_ids` or ``None``
+        :type pvals: :py:class:`numpy.ndarray`
+        :param hits: ``;`` delimited hit genes of each of `term_ids`
+                     or ``None``
+        :type hits: list
+        """
+        self.gene_ids = gene_ids
+        self.term_ids = term_ids
+        self.overlaps = overlaps
+        self.pvals = pvals
+        self.hits = hits
+
+    def get_results(self, library):
+        """
+        Gets enrichment results
+
+        :param library: library this state is for
+        :type library: :py:class:`~cdenrichrgenestoterm.localenrichr.TermLibrary`
+        :return: see :py:meth:`~cdenrichrgenestoterm.localenrichr.TermLibrary.enrich`
+        :rtype: :py:class:`pandas.DataFrame`
+        """
+        from cdenrichrgenestoterm.localenrichr import hypergeometric_sf
+        if self.pvals is None:
+            self.pvals = hypergeometric_sf(self.overlaps,
+                                           len(library.genes),
+                                           library.term_sizes[self.term_ids],
+                                           len(self.gene_ids))
+        if self.hits is None:
+            self.hits = library.get_hit_genes(self.gene_ids, self.term_ids)
+        return library.make_results(self.term_ids, self.overlaps,
+                                    self.pvals, self.hits)
+
+    def to_dict(self, library):
+        """
+        Gets JSON serializable form of this state for `library`.
+        Only the query gene ids and the ids and overlap counts of
+        the terms that overlap them are kept since P-values and hit
+        genes can be computed from those and would make up most of
+        its size
+
+        :return: state
+        :rtype: dict
+        """
+        return {'library': library.name,
+                'checksum': library.get_checksum(),
+                'gene_ids': self.gene_ids.tolist(),
+                'term_ids': self.term_ids.tolist(),
+                'overlaps': self.overlaps.tolist()}
+
+    @staticmethod
+    def from_dict(data, library):
+        """
+        Creates state from `data` made by :py:meth:`to_dict`
+
+        :param data: state
+        :type data: dict
+        :param library: library to use state with
+        :type library: :py:class:`~cdenrichrgenestoterm.localenrichr.TermLibrary`
+        :return: state without P-values and hit genes or ``None``
+                 if it was made for a different version of `library`,
+                 as told by its checksum
+        :rtype: :py:class:`LibraryState`
+        """
+        import numpy
+        if data.get('library') != library.name or \
+                data.get('checksum') != library.get_checksum():
+            return None
+        return LibraryState(numpy.array(data['gene_ids'], dtype=numpy.int64),
+                            numpy.array(data['term_ids'], dtype=numpy.int64),
+                            numpy.array(data['overlaps'], dtype=numpy.int64),
+                            None, None)
+
+
+def get_state(library, gene_ids):
+    """
+    Enriches `gene_ids` against `library` from scratch
+
+    :param library: library
+    :type library: :py:class:`~cdenrichrgenestoterm.localenrichr.TermLibrary`
+    :param gene_ids: as returned by
+                     :py:meth:`~cdenrichrgenestoterm.localenrichr.TermLibrary.get_gene_ids`
+    :type gene_ids: :py:class:`numpy.ndarray`
+    :return: state
+    :rtype: :py:class:`LibraryState`
+    """
+    import numpy
+    overlaps = library.get_overlaps(gene_ids)
+    term_ids = numpy.flatnonzero(overlaps).astype(numpy.int64)
+    return LibraryState(gene_ids, term_ids,
+                        overlaps[term_ids].astype(numpy.int64),
+                        library.get_pvalues(overlaps, term_ids,
+                                            len(gene_ids)),
+                        library.get_hit_genes(gene_ids, term_ids))
+
+
+def update_state(library, state, gene_ids):
+    """
+    Gets state of `gene_ids` from `state` of a previous gene list by
+    applying the genes added and removed. Overlap counts change only
+    for terms holding one of those genes, so only their rows of the
+    library are read and only those terms get new hit genes and
+    P-values. The number of query genes is part of every P-value so
+    if it changed all overlapping terms are rescored, which is still
+    far cheaper than counting overlaps over the whole library.
+    Results are identical to enriching `gene_ids` from scratch. If
+    `state` has no hit genes, as when read from a file, every
+    overlapping term gets them
+
+    :param library: library `state` is for
+    :type library: :py:class:`~cdenrichrgenestoterm.localenrichr.TermLibrary`
+    :param state: state of previous gene list
+    :type state: :py:class:`LibraryState`
+    :param gene_ids: as returned by
+                     :py:meth:`~cdenrichrgenestoterm.localenrichr.TermLibrary.get_gene_ids`
+    :type gene_ids: :py:class:`numpy.ndarray`
+    :return: (new state, number of terms rescored)
+    :rtype: tuple
+    """
+    import numpy
+    from cdenrichrgenestoterm.localenrichr import hypergeometric_sf
+    added = numpy.setdiff1d(gene_ids, state.gene_ids, assume_unique=True)
+    removed = numpy.setdiff1d(state.gene_ids, gene_ids, assume_unique=True)
+    if len(added) == 0 and len(removed) == 0 and state.hits is not None:
+        return state, 0
+    affected, delta = library.get_delta_overlaps(added, removed)
+    all_ids = numpy.union1d(state.term_ids, affected)
+    counts = numpy.zeros(len(all_ids), dtype=numpy.int64)
+    counts[numpy.searchsorted(all_ids, state.term_ids)] = state.overlaps
+    counts[numpy.searchsorted(all_ids, affected)] += delta
+    keep = counts > 0
+    term_ids = all_ids[keep]
+    counts = counts[keep]
+
+    # terms no delta gene is in keep their overlap and hit genes
+    if state.hits is None:
+        is_affected = numpy.ones(len(term_ids), dtype=bool)
+    else:
+        is_affected = numpy.isin(term_ids, affected, assume_unique=True)
+    old_pos = numpy.searchsorted(state.term_ids, term_ids)
+    if len(gene_ids) == len(state.gene_ids) and state.pvals is not None:
+        rescore = is_affected
+    else:
+        rescore = numpy.ones(len(term_ids), dtype=bool)
+    pvals = numpy.empty(len(term_ids), dtype=numpy.float64)
+    if state.pvals is not None:
+        pvals[~rescore] = state.pvals[old_pos[~rescore]]
+    pvals[rescore] = hypergeometric_sf(counts[rescore], len(library.genes),
+                                       library.term_sizes[term_ids[rescore]],
+                                       len(gene_ids))
+    if state.hits is None:
+        hits = library.get_hit_genes(gene_ids, term_ids)
+    else:
+        new_hits = iter(library.get_hit_genes(gene_ids,
+                                              term_ids[is_affected]))
+        hits = [next(new_hits) if affected_term else state.hits[pos]
+                for affected_term, pos in zip(is_affected.tolist(),
+                                              old_pos.tolist())]
+    return (LibraryState(gene_ids, term_ids, counts, pvals, hits),
+            int(numpy.count_nonzero(rescore)))
+
+
+class IncrementalEnricher(object):
+    """
+    Wraps a local engine so each gene list, named by an id, keeps
+    its per term overlap counts. When a gene list with the same id
+    is enriched again, such as a community that gained or lost a
+    few genes between runs of community detection, only the
+    change is applied, see :py:func:`update_state`.
+
+    States are kept in memory, up to `max_states` of them, and if
+    `statedir` is set also in one JSON file per gene list and
+    library so later runs can use them. Calls that do not name a
+    gene list, see :py:meth:`get_engine`, go to the wrapped engine
+    """
+    results_in_memory = True
+    """
+    Results are returned in ``results`` attribute so no
+    report files need to be written
+    """
+
+    def __init__(self, enrichr, statedir=None,
+                 max_states=DEFAULT_MAX_STATES):
+        """
+        Constructor
+
+        :param enrichr: local engine
+        :type enrichr: :py:class:`~cdenrichrgenestoterm.localenrichr.LocalEnrichr`
+        :param statedir: directory to keep states in, created if it
+                         does not exist, ``None`` to keep them in
+                         memory only
+        :type statedir: str
+        :param max_states: max number of states kept in memory
+        :type max_states: int
+        """
+        self._enrichr = enrichr
+        self._statedir = statedir
+        self._max_states = max(max_states, 1)
+        self._lock = threading.Lock()
+        self._states = collections.OrderedDict()
+        if statedir is not None:
+            os.makedirs(statedir, exist_ok=True)
+
+    def get_library(self, library):
+        """
+        Gets library from wrapped engine
+
+        :param library: name of library
+        :type library: str
+        :return: library
+        :rtype: :py:class:`~cdenrichrgenestoterm.localenrichr.TermLibrary`
+        """
+        return self._enrichr.get_library(library)
+
+    def enrichr(self, **kwargs):
+        """
+        Enriches with wrapped engine keeping no state
+        """
+        return self._enrichr.enrichr(**kwargs)
+
+    def get_engine(self, list_id):
+        """
+        Gets engine that enriches gene list `list_id` incrementally
+
+        :param list_id: id of gene list, JSON serializable
+        :return: engine with an ``enrichr()`` method
+        :rtype: :py:class:`IncrementalEngine`
+        """
+        return IncrementalEngine(self, list_id)
+
+    def _get_path(self, key):
+        digest = hashlib.sha256(json.dumps(key).encode('utf-8')).hexdigest()
+        return os.path.join(self._statedir, digest + STATE_SUFFIX)
+
+    def _load(self, key, library):
+        with self._lock:
+            if key in self._states:
+                self._states.move_to_end(key)
+                return self._states[key]
+        if self._statedir is None:
+            return None
+        try:
+            with open(self._get_path(key), 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get('key') != list(key):
+            return None
+        return LibraryState.from_dict(data, library)
+
+    def _store(self, key, library, state):
+        with self._lock:
+            self._states[key] = state
+            self._states.move_to_end(key)
+            while len(self._states) > self._max_states:
+                self._states.popitem(last=False)
+        if self._statedir is None:
+            return
+        data = state.to_dict(library)
+        data['key'] = list(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self._statedir,
+                                        suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, self._get_path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def enrich_library(self, list_id, gene_list, library):
+        """
+        Enriches gene list `list_id`, now holding `gene_list`,
+        against `library` starting from its previous state if any
+
+        :param list_id: id of gene list
+        :param gene_list: genes
+        :type gene_list: list
+        :param library: name of library
+        :type library: str
+        :return: see :py:meth:`~cdenrichrgenestoterm.localenrichr.TermLibrary.enrich`
+        :rtype: :py:class:`pandas.DataFrame`
+        """
+        term_library = self.get_library(library)
+        gene_ids = term_library.get_gene_ids(gene_list)
+        key = (list_id, library)
+        state = self._load(key, term_library)
+        if state is None:
+            state = get_state(term_library, gene_ids)
+        else:
+            state, num_rescored = update_state(term_library, state,
+                                               gene_ids)
+            recorder = metrics.get_metrics()
+            recorder.increment('incremental_updates')
+            recorder.increment('rescored_terms', num_rescored)
+        self._store(key, term_library, state)
+        return state.get_results(term_library)
+
+
+class IncrementalEngine(object):
+    """
+    Engine for one gene list of an :py:class:`IncrementalEnricher`
+    with the call signature of :py:func:`gseapy.enrichr`
+    """
+    results_in_memory = True
+    """
+    Results are returned in ``results`` attribute so no
+    report files need to be written
+    """
+
+    def __init__(self, enricher, list_id):
+        """
+        Constructor
+
+        :param enricher: enricher keeping states
+        :type enricher: :py:class:`IncrementalEnricher`
+        :param list_id: id of gene list
+        """
+        self._enricher = enricher
+        self._list_id = list_id
+
+    def enrichr(self, gene_list=None, gene_sets=None, **kwargs):
+        """
+        Enriches `gene_list` against `gene_sets`
+
+        :param gene_list: genes to enrich
+        :type gene_list: list
+        :param gene_sets: comma delimited library names
+        :type gene_sets: str
+        :return: results of all libraries combined
+        :rtype: :py:class:`~cdenrichrgenestoterm.localenrichr.LocalEnrichrResult`
+        """
+        import pandas
+        from cdenrichrgenestoterm.localenrichr import LocalEnrichrResult
+        d_frames = [self._enricher.enrich_library(self._list_id,
+                                                  gene_list,
+                                                  library.strip())
+                    for library in gene_sets.split(',')
+                    if len(library.strip()) > 0]
+        if len(d_frames) == 0:
+            return LocalEnrichrResult(pandas.DataFrame())
+        mega_df = pandas.concat(d_frames)
+        mega_df.reset_index(drop=True, inplace=True)
+        return LocalEnrichrResult(mega_df)
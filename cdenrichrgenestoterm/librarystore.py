@@ -0,0 +1,504 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import urllib.request
+from urllib.parse import quote
+
+
+ENRICHR_LIBRARY_URL = 'https://maayanlab.cloud/Enrichr/geneSetLibrary?' \
+                      'mode=text&libraryName={library}'
+"""
+Template of URL to download a gene set library in GMT format
+from, ``{library}`` is replaced by the library name
+"""
+
+MANIFEST_FILE = 'manifest.json'
+"""
+Name of file in each snapshot that lists its libraries
+and their checksums
+"""
+
+CURRENT_FILE = 'CURRENT'
+"""
+Name of file in store holding the name of the current snapshot
+"""
+
+CHUNK_SIZE = 1024 * 1024
+"""
+Bytes read at a time when downloading and checksumming
+"""
+
+DOWNLOAD_TIMEOUT = 60.0
+"""
+Seconds to wait to connect to, or for data from, a library
+download before giving up on that try
+"""
+
+
+def get_sha256(path):
+    """
+    Gets SHA-256 hex digest of file at `path`
+
+    :param path: path to file
+    :type path: str
+    :return: hex digest
+    :rtype: str
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _get_stat_keys(file_name):
+    """
+    Gets (library, size key, modification time key) under which the
+    stats of `file_name`, a ``<library>.gmt`` or ``<library>.tlib``
+    file, are kept in a manifest
+    """
+    from cdenrichrgenestoterm.compiledlibrary import COMPILED_SUFFIX
+    library, suffix = os.path.splitext(file_name)
+    prefix = 'compiled_' if suffix == COMPILED_SUFFIX else ''
+    return library, prefix + 'size', prefix + 'mtime_ns'
+
+
+def _set_stats(info, file_name, path):
+    """
+    Records size and modification time of `path` in manifest entry
+    `info` of its library
+
+    :return: ``True`` if they changed
+    :rtype: bool
+    """
+    _, size_key, mtime_key = _get_stat_keys(file_name)
+    stat = os.stat(path)
+    if info.get(size_key) == stat.st_size and \
+            info.get(mtime_key) == stat.st_mtime_ns:
+        return False
+    info[size_key] = stat.st_size
+    info[mtime_key] = stat.st_mtime_ns
+    return True
+
+
+class LibraryStore(object):
+    """
+    Versioned local store of gene set libraries so enrichment can
+    run offline against a fixed set of libraries. Each snapshot is
+    a directory under `storedir` holding ``<library>.gmt`` files,
+    optionally compiled ``<library>.tlib`` files, and a
+    ``manifest.json`` with the SHA-256 checksum, size, modification
+    time and source of each library and the same for its compiled
+    file. Checksums are computed when a snapshot is fetched and by
+    :py:meth:`verify`. Queries only compute the checksum of a file
+    they load if its size or modification time is not the one
+    recorded, see :py:meth:`get_checksums` and
+    :py:meth:`get_file_stats`. Snapshots are written to a temporary directory
+    and renamed into place so a snapshot is either complete or
+    absent. The ``CURRENT`` file names the snapshot used when no
+    version is given.
+    """
+    def __init__(self, storedir):
+        """
+        Constructor
+
+        :param storedir: directory holding snapshots
+        :type storedir: str
+        """
+        self._storedir = storedir
+
+    def get_snapshot_dir(self, version=None):
+        """
+        Gets directory of snapshot `version`
+
+        :param version: snapshot name, if ``None`` the current
+                        snapshot is used
+        :type version: str
+        :raises LookupError: if snapshot does not exist
+        :return: path to snapshot directory
+        :rtype: str
+        """
+        if version is None:
+            version = self.get_current_version()
+        snapshot_dir = os.path.join(self._storedir, version)
+        if not os.path.isfile(os.path.join(snapshot_dir, MANIFEST_FILE)):
+            raise LookupError('No library snapshot ' + version +
+                              ' in ' + self._storedir)
+        return snapshot_dir
+
+    def get_current_version(self):
+        """
+        Gets name of current snapshot
+
+        :raises LookupError: if store has no current snapshot
+        :return: snapshot name
+        :rtype: str
+        """
+        try:
+            with open(os.path.join(self._storedir, CURRENT_FILE), 'r') as f:
+                version = f.read().strip()
+        except OSError:
+            version = ''
+        if len(version) == 0:
+            raise LookupError('No current library snapshot in ' +
+                              self._storedir)
+        return version
+
+    def set_current_version(self, version):
+        """
+        Makes snapshot `version` the current one
+
+        :param version: snapshot name
+        :type version: str
+        :raises LookupError: if snapshot does not exist
+        :return: None
+        """
+        self.get_snapshot_dir(version)
+        fd, tmp_path = tempfile.mkstemp(dir=self._storedir, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(version + '\n')
+        os.replace(tmp_path, os.path.join(self._storedir, CURRENT_FILE))
+
+    def get_versions(self):
+        """
+        Gets names of all complete snapshots
+
+        :return: sorted snapshot names
+        :rtype: list
+        """
+        if not os.path.isdir(self._storedir):
+            return []
+        return sorted([x for x in os.listdir(self._storedir)
+                       if os.path.isfile(os.path.join(self._storedir, x,
+                                                      MANIFEST_FILE))])
+
+    def get_manifest(self, version=None):
+        """
+        Gets manifest of snapshot `version`
+
+        :param version: snapshot name, if ``None`` the current
+                        snapshot is used
+        :type version: str
+        :return: manifest of form ``{"version": VERSION, "created":
+                 SECONDS, "libraries": {LIBRARY: {"sha256": DIGEST,
+                 "size": BYTES, "mtime_ns": NANOSECONDS, "source":
+                 URL, "compiled_sha256": DIGEST, "compiled_size":
+                 BYTES, "compiled_mtime_ns": NANOSECONDS}}}`` where
+                 the ``compiled_`` fields are only set if the library
+                 was compiled
+        :rtype: dict
+        """
+        snapshot_dir = self.get_snapshot_dir(version)
+        with open(os.path.join(snapshot_dir, MANIFEST_FILE), 'r') as f:
+            return json.load(f)
+
+    def get_checksums(self, version=None):
+        """
+        Gets checksums of the files of snapshot `version`
+
+        :param version: snapshot name, if ``None`` the current
+                        snapshot is used
+        :type version: str
+        :return: file name, ie ``<library>.gmt`` or
+                 ``<library>.tlib``, => SHA-256 hex digest
+        :rtype: dict
+        """
+        from cdenrichrgenestoterm.localenrichr import GMT_SUFFIX
+        from cdenrichrgenestoterm.compiledlibrary import COMPILED_SUFFIX
+        checksums = {}
+        for library, info in self.get_manifest(version)['libraries'].items():
+            checksums[library + GMT_SUFFIX] = info['sha256']
+            if info.get('compiled_sha256') is not None:
+                checksums[library + COMPILED_SUFFIX] = \
+                    info['compiled_sha256']
+        return checksums
+
+    def get_file_stats(self, version=None):
+        """
+        Gets size and modification time the files of snapshot
+        `version` had when their checksums were last computed. A
+        file that still has them is taken to match its checksum
+        without reading it
+
+        :param version: snapshot name, if ``None`` the current
+                        snapshot is used
+        :type version: str
+        :return: file name, as in :py:meth:`get_checksums`, =>
+                 (size in bytes, modification time in nanoseconds).
+                 Files of snapshots fetched before these were
+                 recorded are left out
+        :rtype: dict
+        """
+        stats = {}
+        manifest = self.get_manifest(version)
+        for file_name in self.get_checksums(version):
+            library, size_key, mtime_key = _get_stat_keys(file_name)
+            info = manifest['libraries'][library]
+            if info.get(size_key) is not None and \
+                    info.get(mtime_key) is not None:
+                stats[file_name] = (info[size_key], info[mtime_key])
+        return stats
+
+    def verify(self, version=None):
+        """
+        Checks every library in snapshot `version`, and its
+        compiled file if it has one, matches the checksum in its
+        manifest. The size and modification time of each file that
+        matches are recorded, so a snapshot copied elsewhere, which
+        changes modification times, is not checksummed again on load
+
+        :param version: snapshot name, if ``None`` the current
+                        snapshot is used
+        :type version: str
+        :return: names of libraries that are missing or whose
+                 checksum does not match
+        :rtype: list
+        """
+        snapshot_dir = self.get_snapshot_dir(version)
+        manifest = self.get_manifest(version)
+        bad = set()
+        changed = False
+        for file_name, checksum in self.get_checksums(version).items():
+            library = _get_stat_keys(file_name)[0]
+            path = os.path.join(snapshot_dir, file_name)
+            if not os.path.isfile(path) or get_sha256(path) != checksum:
+                bad.add(library)
+                continue
+            if _set_stats(manifest['libraries'][library], file_name, path):
+                changed = True
+        if changed:
+            fd, tmp_path = tempfile.mkstemp(dir=snapshot_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+            os.replace(tmp_path, os.path.join(snapshot_dir, MANIFEST_FILE))
+        return sorted(bad)
+
+    def _download(self, url, path, timeout=DOWNLOAD_TIMEOUT):
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            with open(path, 'wb') as f:
+                shutil.copyfileobj(response, f, CHUNK_SIZE)
+
+    def fetch(self, libraries, version=None, url=ENRICHR_LIBRARY_URL,
+              compile_libraries=True, make_current=True,
+              retry_policy=None, timeout=DOWNLOAD_TIMEOUT):
+        """
+        Downloads `libraries` into a new snapshot
+
+        :param libraries: names of libraries
+        :type libraries: list
+        :param version: name of snapshot, if ``None`` the current UTC
+                        time ie ``20210309T120000Z`` is used
+        :type version: str
+        :param url: template of URL to download each library from,
+                    ``{library}`` is replaced with the URL quoted
+                    library name. ``file://`` URLs work too
+        :type url: str
+        :param compile_libraries: if ``True`` a compiled
+                                  ``<library>.tlib`` file is also
+                                  written for each library
+        :type compile_libraries: bool
+        :param make_current: if ``True`` new snapshot becomes the
+                             current one
+        :type make_current: bool
+        :param retry_policy: policy used to retry failed downloads,
+                             if ``None`` each is tried once
+        :type retry_policy: :py:class:`~cdenrichrgenestoterm.retrypolicy.RetryPolicy`
+        :param timeout: seconds to wait to connect to, or for data
+                        from, each download before the try fails
+        :type timeout: float
+        :raises ValueError: if snapshot `version` already exists or
+                            a downloaded library has no gene sets
+        :return: manifest of new snapshot
+        :rtype: dict
+        """
+        from cdenrichrgenestoterm.localenrichr import GMT_SUFFIX
+        from cdenrichrgenestoterm.localenrichr import read_gmt_file
+        if version is None:
+            version = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        if os.path.exists(os.path.join(self._storedir, version)):
+            raise ValueError('Library snapshot ' + version +
+                             ' already exists in ' + self._storedir)
+        os.makedirs(self._storedir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix='.' + version + '.',
+                                   dir=self._storedir)
+        try:
+            manifest = {'version': version, 'created': time.time(),
+                        'libraries': {}}
+            for library in libraries:
+                lib_url = url.format(library=quote(library))
+                gmtfile = os.path.join(tmp_dir, library + GMT_SUFFIX)
+                if retry_policy is None:
+                    self._download(lib_url, gmtfile, timeout=timeout)
+                else:
+                    retry_policy.call(self._download, url=lib_url,
+                                      path=gmtfile, timeout=timeout)
+                if len(read_gmt_file(gmtfile)) == 0:
+                    raise ValueError('No gene sets found in ' + library +
+                                     ' downloaded from ' + lib_url)
+                info = {'sha256': get_sha256(gmtfile), 'source': lib_url}
+                _set_stats(info, library + GMT_SUFFIX, gmtfile)
+                if compile_libraries is True:
+                    from cdenrichrgenestoterm import compiledlibrary
+                    compiledlibrary.compile_library(tmp_dir, library)
+                    compiled_file = compiledlibrary.get_compiled_file(
+                        tmp_dir, library)
+                    info['compiled_sha256'] = get_sha256(compiled_file)
+                    _set_stats(info, os.path.basename(compiled_file),
+                               compiled_file)
+                manifest['libraries'][library] = info
+            with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w') as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+            os.rename(tmp_dir, os.path.join(self._storedir, version))
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        if make_current is True:
+            self.set_current_version(version)
+        return manifest
+
+
+def get_library_version(theargs):
+    """
+    Gets name of library snapshot set by `theargs`, resolving
+    the current snapshot if `theargs.libraryversion` is not set
+
+    :param theargs: parsed command line arguments
+    :type theargs: :py:class:`argparse.Namespace`
+    :return: snapshot name or ``None`` if `theargs.librarydir`
+             is not set
+    :rtype: str
+    """
+    if getattr(theargs, 'librarydir', None) is None:
+        return None
+    if getattr(theargs, 'libraryversion', None) is not None:
+        return theargs.libraryversion
+    return LibraryStore(theargs.librarydir).get_current_version()
+
+
+class Formatter(argparse.ArgumentDefaultsHelpFormatter,
+                argparse.RawDescriptionHelpFormatter):
+    pass
+
+
+def _parse_arguments(desc, args):
+    """
+    Parses command line arguments
+    :param desc:
+    :param args:
+    :return:
+    """
+    from cdenrichrgenestoterm import cdenrichrgenestoterm
+    help_fm = Formatter
+    parser = argparse.ArgumentParser(description=desc,
+                                     formatter_class=help_fm)
+    parser.add_argument('--librarydir', required=True,
+                        help='Directory holding library snapshots')
+    subparsers = parser.add_subparsers(dest='action', required=True)
+    fetch = subparsers.add_parser('fetch', formatter_class=help_fm,
+                                  help='Downloads libraries into a new '
+                                       'snapshot')
+    fetch.add_argument('--genesets',
+                       default=cdenrichrgenestoterm.DEFAULT_GENESETS,
+                       help='Gene sets to download. '
+                            'Should be comma delimited')
+    fetch.add_argument('--libraryversion',
+                       help='Name of new snapshot, if unset current '
+                            'UTC time is used')
+    fetch.add_argument('--url', default=ENRICHR_LIBRARY_URL,
+                       help='Template of URL to download each library '
+                            'from, {library} is replaced by library name')
+    fetch.add_argument('--nocompile', action='store_true',
+                       help='If set, libraries are not compiled, see '
+                            'compile command')
+    fetch.add_argument('--notcurrent', action='store_true',
+                       help='If set, new snapshot does not become '
+                            'the current one')
+    fetch.add_argument('--retries', type=int, default=3,
+                       help='Max number of times to try each download')
+    fetch.add_argument('--timeout', type=float, default=DOWNLOAD_TIMEOUT,
+                       help='Seconds to wait to connect to, or for data '
+                            'from, each download before trying again')
+    subparsers.add_parser('list', formatter_class=help_fm,
+                          help='Lists snapshots, current one is '
+                               'marked with *')
+    verify = subparsers.add_parser('verify', formatter_class=help_fm,
+                                   help='Checks checksums of libraries '
+                                        'in a snapshot')
+    verify.add_argument('--libraryversion',
+                        help='Snapshot to verify, if unset current '
+                             'snapshot is used')
+    use = subparsers.add_parser('use', formatter_class=help_fm,
+                                help='Makes a snapshot the current one')
+    use.add_argument('libraryversion', help='Snapshot to make current')
+    return parser.parse_args(args)
+
+
+def main(args):
+    """
+    Main entry point for library command
+
+    :param args: command line arguments with first argument being
+                 :py:const:`~cdenrichrgenestoterm.cdenrichrgenestoterm.LIBRARY_COMMAND`
+    :return: 0 for success otherwise failure
+    :rtype: int
+    """
+    desc = """
+        Manages versioned offline snapshots of gene set libraries
+        downloaded from Enrichr. Pass --librarydir (and optionally
+        --libraryversion) to the command line tool or server to
+        enrich locally against a snapshot without network access.
+
+        Actions:
+
+        fetch   - downloads libraries into a new snapshot
+        list    - lists snapshots
+        verify  - checks checksums of libraries in a snapshot.
+                  On load a library is only checksummed if its
+                  size or modification time changed since it was
+                  fetched or last verified
+        use     - makes a snapshot the current one
+    """
+    theargs = _parse_arguments(desc, args[1:])
+    try:
+        store = LibraryStore(theargs.librarydir)
+        if theargs.action == 'fetch':
+            from cdenrichrgenestoterm import cdenrichrgenestoterm
+            from cdenrichrgenestoterm.retrypolicy import RetryPolicy
+            manifest = store.fetch(
+                cdenrichrgenestoterm.get_libraries(theargs.genesets),
+                version=theargs.libraryversion, url=theargs.url,
+                compile_libraries=not theargs.nocompile,
+                make_current=not theargs.notcurrent,
+                retry_policy=RetryPolicy(max_tries=theargs.retries),
+                timeout=theargs.timeout)
+            sys.stdout.write(manifest['version'] + '\n')
+        elif theargs.action == 'list':
+            try:
+                current = store.get_current_version()
+            except LookupError:
+                current = None
+            for version in store.get_versions():
+                marker = '*' if version == current else ' '
+                sys.stdout.write(marker + ' ' + version + '\n')
+        elif theargs.action == 'verify':
+            bad = store.verify(theargs.libraryversion)
+            if len(bad) > 0:
+                sys.stderr.write('Checksum mismatch or missing: ' +
+                                 ','.join(bad) + '\n')
+                return 1
+        elif theargs.action == 'use':
+            store.set_current_version(theargs.libraryversion)
+        return 0
+    except Exception as e:
+        sys.stderr.write('Caught exception: ' + str(e))
+        return 2
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
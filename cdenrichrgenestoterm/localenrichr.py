@@ -0,0 +1,630 @@
+# -*- coding: utf-8 -*-
+
+import os
+import hashlib
+import threading
+import numpy
+import pandas
+from scipy.sparse import csr_matrix
+from scipy.special import gammaln
+
+from cdenrichrgenestoterm import metrics
+from cdenrichrgenestoterm.correction import benjamini_hochberg
+
+
+GMT_SUFFIX = '.gmt'
+"""
+Suffix expected on gene set library files
+"""
+
+ORGANISM = 'human'
+"""
+Organism used in name of report files, matches what gseapy writes
+"""
+
+
+def read_gmt_file(gmtfile):
+    """
+    Parses a GMT file where each line is a term name followed by
+    an (often empty) description and then the genes in the term,
+    all separated by tabs.
+
+    :param gmtfile: path to GMT file
+    :type gmtfile: str
+    :return: term name => list of upper cased genes (duplicates removed)
+    :rtype: dict
+    """
+    terms = {}
+    with open(gmtfile, 'r') as f:
+        for line in f:
+            split_line = line.rstrip('\r\n').split('\t')
+            if len(split_line) < 3 or len(split_line[0]) == 0:
+                continue
+            genes = []
+            seen = set()
+            for gene in split_line[2:]:
+                # Enrichr libraries sometimes append a weight ie GENE,1.0
+                gene = gene.split(',')[0].strip().upper()
+                if len(gene) == 0 or gene in seen:
+                    continue
+                seen.add(gene)
+                genes.append(gene)
+            if len(genes) == 0:
+                continue
+            terms[split_line[0]] = genes
+    return terms
+
+
+def get_gmt_file(gmtdir, library):
+    """
+    Gets path to GMT file for `library` in `gmtdir`
+
+    :param gmtdir: directory containing ``<library>.gmt`` files
+    :type gmtdir: str
+    :param library: name of library ie GO_Biological_Process_2018
+    :type library: str
+    :raises LookupError: if no GMT file exists for `library`
+    :return: path to GMT file
+    :rtype: str
+    """
+    gmtfile = os.path.join(gmtdir, library + GMT_SUFFIX)
+    if not os.path.isfile(gmtfile):
+        raise LookupError('No gene set library ' + library +
+                          ' found in ' + gmtdir)
+    return gmtfile
+
+
+def _hypergeometric_logpmf(x, total, successes, draws):
+    """
+    Log of hypergeometric probability mass function
+
+    :return: log of probability of `x` successes
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    return (gammaln(successes + 1) - gammaln(x + 1) -
+            gammaln(successes - x + 1) +
+            gammaln(total - successes + 1) - gammaln(draws - x + 1) -
+            gammaln(total - successes - draws + x + 1) -
+            gammaln(total + 1) + gammaln(draws + 1) +
+            gammaln(total - draws + 1))
+
+
+def hypergeometric_sf(overlaps, total, successes, draws):
+    """
+    Hypergeometric upper tail probability P(X >= `overlaps`) computed
+    for many terms at once. This is the one sided Fisher exact test
+    Enrichr uses and matches
+    ``scipy.stats.hypergeom.sf(overlaps - 1, total, successes, draws)``
+    but is much faster on large arrays. Point masses are summed with
+    the ratio of successive ones, one vectorized step at a time,
+    starting from one computed with :py:func:`scipy.special.gammaln`.
+    Above the mode the upper tail is summed directly. Below it the
+    point mass at `overlaps` can underflow to 0 while the tail is
+    near 1, so the lower tail is summed downwards from
+    `overlaps` - 1 instead and subtracted from 1. For a single
+    query, with `draws` a number, the P-value only depends on the
+    overlap and term size and many terms share those, so each
+    distinct pair is computed once.
+
+    :param overlaps: overlap counts, must be at least 1
+    :type overlaps: :py:class:`numpy.ndarray`
+    :param total: number of genes in background
+    :type total: int
+    :param successes: size of each term
+    :type successes: :py:class:`numpy.ndarray`
+    :param draws: number of query genes
+    :type draws: int or :py:class:`numpy.ndarray`
+    :return: P-values
+    :rtype: :py:class:`numpy.ndarray`
+    """
+    if numpy.ndim(draws) == 0 and numpy.size(overlaps) > 1:
+        overlaps = numpy.asarray(overlaps, dtype=numpy.int64)
+        successes = numpy.asarray(successes, dtype=numpy.int64)
+        keys = overlaps * (int(successes.max()) + 1) + successes
+        _, first, inverse = numpy.unique(keys, return_index=True,
+                                         return_inverse=True)
+        return _hypergeometric_sf(overlaps[first], total,
+                                  successes[first], draws)[inverse]
+    return _hypergeometric_sf(overlaps, total, successes, draws)
+
+
+def _hypergeometric_sf(overlaps, total, successes, draws):
+    """
+    Computes :py:func:`hypergeometric_sf` for every term
+    """
+    successes = numpy.asarray(successes, dtype=numpy.float64)
+    draws = numpy.broadcast_to(numpy.asarray(draws, dtype=numpy.float64),
+                               successes.shape)
+    total = float(total)
+    # below the support of the distribution the tail is everything
+    lowest = numpy.maximum(successes + draws - total, 0.0)
+    x = numpy.maximum(numpy.asarray(overlaps, dtype=numpy.float64), lowest)
+    upper = numpy.minimum(successes, draws)
+    mode = numpy.floor((successes + 1) * (draws + 1) / (total + 2))
+    tail = numpy.ones(successes.shape, dtype=numpy.float64)
+    above = numpy.flatnonzero(x >= mode)
+    tail[above] = _sum_upper_tail(x[above], total, successes[above],
+                                  draws[above], upper[above], mode[above])
+    below = numpy.flatnonzero((x < mode) & (x > lowest))
+    tail[below] = 1.0 - _sum_lower_tail(x[below] - 1, total,
+                                        successes[below], draws[below],
+                                        lowest[below])
+    return numpy.clip(tail, 0.0, 1.0)
+
+
+def _sum_upper_tail(x, total, successes, draws, upper, mode):
+    """
+    Sums point masses from `x` up to `upper`, stopping once
+    past `mode` and the terms no longer change the sum
+    """
+    x = x.copy()
+    term = numpy.exp(_hypergeometric_logpmf(x, total, successes, draws))
+    tail = term.copy()
+    active = numpy.flatnonzero(x < upper)
+    while active.shape[0] > 0:
+        x_a = x[active]
+        s_a = successes[active]
+        d_a = draws[active]
+        term[active] *= ((s_a - x_a) * (d_a - x_a) /
+                         ((x_a + 1) * (total - s_a - d_a + x_a + 1)))
+        x[active] = x_a + 1
+        tail[active] += term[active]
+        keep = ((x[active] < upper[active]) &
+                ((x[active] <= mode[active]) |
+                 (term[active] > tail[active] * 1e-17)))
+        active = active[keep]
+    return tail
+
+
+def _sum_lower_tail(x, total, successes, draws, lowest):
+    """
+    Sums point masses from `x`, which is below the mode, down to
+    `lowest`. Point masses only shrink going down so summing stops
+    once they no longer change the sum
+    """
+    x = x.copy()
+    term = numpy.exp(_hypergeometric_logpmf(x, total, successes, draws))
+    tail = term.copy()
+    active = numpy.flatnonzero((x > lowest) & (term > 0))
+    while active.shape[0] > 0:
+        x_a = x[active]
+        s_a = successes[active]
+        d_a = draws[active]
+        term[active] *= (x_a * (total - s_a - d_a + x_a) /
+                         ((s_a - x_a + 1) * (d_a - x_a + 1)))
+        x[active] = x_a - 1
+        tail[active] += term[active]
+        keep = ((x[active] > lowest[active]) &
+                (term[active] > tail[active] * 1e-17))
+        active = active[keep]
+    return tail
+
+
+class TermLibrary(object):
+    """
+    Gene set library stored as a sparse CSR gene by term incidence
+    matrix. Genes are interned to integer ids in sorted order and
+    terms are kept in sorted order so all the term overlaps for a
+    query come from a single sparse matrix-vector product.
+    """
+    def __init__(self, name, genes, terms, matrix):
+        """
+        Constructor
+
+        :param name: name of library
+        :type name: str
+        :param genes: gene symbols, index is the gene id
+        :type genes: list
+        :param terms: term names, index is the term id
+        :type terms: list
+        :param matrix: gene by term incidence matrix
+        :type matrix: :py:class:`scipy.sparse.csr_matrix`
+        """
+        self.name = name
+        self.genes = genes
+        self.terms = terms
+        self._matrix = matrix
+        self._gene_ids = {gene: idx for idx, gene in enumerate(genes)}
+        self.term_sizes = numpy.bincount(matrix.indices,
+                                         minlength=len(terms))
+        self._checksum = None
+
+    @staticmethod
+    def from_terms(name, terms):
+        """
+        Creates :py:class:`TermLibrary` from a term => genes dict
+
+        :param name: name of library
+        :type name: str
+        :param terms: term name => list of genes as returned by
+                      :py:func:`read_gmt_file`
+        :type terms: dict
+        :return: library
+        :rtype: :py:class:`TermLibrary`
+        """
+        term_names = sorted(terms.keys())
+        genes = set()
+        for term_genes in terms.values():
+            genes.update(term_genes)
+        genes = sorted(genes)
+        gene_ids = {gene: idx for idx, gene in enumerate(genes)}
+        rows = []
+        cols = []
+        for term_id, term in enumerate(term_names):
+            for gene in terms[term]:
+                rows.append(gene_ids[gene])
+                cols.append(term_id)
+        matrix = csr_matrix((numpy.ones(len(rows), dtype=numpy.int32),
+                             (numpy.array(rows, dtype=numpy.int32),
+                              numpy.array(cols, dtype=numpy.int32))),
+                            shape=(len(genes), len(term_names)))
+        return TermLibrary(name, genes, term_names, matrix)
+
+    @staticmethod
+    def from_gmt_file(name, gmtfile):
+        """
+        Creates :py:class:`TermLibrary` from a GMT file
+
+        :param name: name of library
+        :type name: str
+        :param gmtfile: path to GMT file
+        :type gmtfile: str
+        :return: library
+        :rtype: :py:class:`TermLibrary`
+        """
+        return TermLibrary.from_terms(name, read_gmt_file(gmtfile))
+
+    def get_checksum(self):
+        """
+        Gets SHA-256 hex digest of the genes, terms and incidence
+        matrix of this library, computed the first time it is asked
+        for. It is the same whether the library was parsed from a
+        GMT file or loaded compiled, and changes if a term is edited
+        even when the number of genes and terms stays the same
+
+        :return: hex digest
+        :rtype: str
+        """
+        if self._checksum is None:
+            digest = hashlib.sha256()
+            for strings in (self.genes, self.terms):
+                digest.update(str(len(strings)).encode('utf-8') + b'\n')
+                for string in strings:
+                    digest.update(string.encode('utf-8') + b'\n')
+            matrix = self._matrix
+            if not matrix.has_sorted_indices:
+                matrix = matrix.sorted_indices()
+            for array in (matrix.indptr, matrix.indices):
+                digest.update(numpy.asarray(array, dtype='<i8').tobytes())
+            self._checksum = digest.hexdigest()
+        return self._checksum
+
+    def get_gene_ids(self, gene_list):
+        """
+        Maps `gene_list` to sorted unique gene ids, genes not in
+        this library are dropped
+
+        :param gene_list: gene symbols
+        :type gene_list: list
+        :return: gene ids
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        ids = {self._gene_ids[g] for g in gene_list if g in self._gene_ids}
+        return numpy.array(sorted(ids), dtype=numpy.int64)
+
+    def get_overlaps(self, gene_ids):
+        """
+        Counts genes in `gene_ids` that are in each term
+
+        :param gene_ids: gene ids as returned by :py:meth:`get_gene_ids`
+        :type gene_ids: :py:class:`numpy.ndarray`
+        :return: overlap count for every term indexed by term id
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        query = numpy.zeros(len(self.genes), dtype=numpy.int32)
+        query[gene_ids] = 1
+        return self._matrix.T.dot(query)
+
+    def get_delta_overlaps(self, added_ids, removed_ids):
+        """
+        Gets how overlap counts change when `added_ids` join a query
+        and `removed_ids` leave it. Only the rows of those genes are
+        read, not the whole library
+
+        :param added_ids: sorted ids of genes added
+        :type added_ids: :py:class:`numpy.ndarray`
+        :param removed_ids: sorted ids of genes removed
+        :type removed_ids: :py:class:`numpy.ndarray`
+        :return: (sorted ids of terms holding any of those genes,
+                  change of overlap count of each of those terms)
+        :rtype: tuple
+        """
+        added = self._matrix[added_ids].indices
+        removed = self._matrix[removed_ids].indices
+        term_ids = numpy.union1d(added, removed).astype(numpy.int64)
+        delta = numpy.zeros(len(term_ids), dtype=numpy.int64)
+        numpy.add.at(delta, numpy.searchsorted(term_ids, added), 1)
+        numpy.subtract.at(delta, numpy.searchsorted(term_ids, removed), 1)
+        return term_ids, delta
+
+    def get_pvalues(self, overlaps, term_ids, num_query_genes):
+        """
+        Hypergeometric upper tail P-values for `term_ids`, computed
+        over all the terms at once
+
+        :param overlaps: overlap counts indexed by term id
+        :type overlaps: :py:class:`numpy.ndarray`
+        :param term_ids: ids of terms to score
+        :type term_ids: :py:class:`numpy.ndarray`
+        :param num_query_genes: number of query genes in library
+        :type num_query_genes: int
+        :return: P-values in same order as `term_ids`
+        :rtype: :py:class:`numpy.ndarray`
+        """
+        return hypergeometric_sf(overlaps[term_ids], len(self.genes),
+                                 self.term_sizes[term_ids], num_query_genes)
+
+    def get_hit_genes(self, gene_ids, term_ids):
+        """
+        Gets genes from `gene_ids` that are in each term of `term_ids`.
+        The columns of `term_ids` are sliced from the rows of `gene_ids`
+        in one go, all the hits are joined into one string and each
+        term gets a slice of it, so there is no per term array work
+
+        :param gene_ids: gene ids as returned by :py:meth:`get_gene_ids`
+        :type gene_ids: :py:class:`numpy.ndarray`
+        :param term_ids: ids of terms
+        :type term_ids: :py:class:`numpy.ndarray`
+        :return: ``;`` delimited sorted gene symbols for each term
+        :rtype: list
+        """
+        if len(term_ids) == 0:
+            return []
+        sub_matrix = self._matrix[gene_ids][:, term_ids].tocsc()
+        sub_matrix.sort_indices()
+        symbols = numpy.array([self.genes[x] for x in gene_ids.tolist()],
+                              dtype=object)
+        lengths = numpy.array([len(x) for x in symbols], dtype=numpy.int64)
+        text = ';'.join(symbols[sub_matrix.indices].tolist())
+        ends = numpy.zeros(sub_matrix.nnz + 1, dtype=numpy.int64)
+        numpy.cumsum(lengths[sub_matrix.indices] + 1, out=ends[1:])
+        starts = ends[sub_matrix.indptr[:-1]].tolist()
+        stops = (ends[sub_matrix.indptr[1:]] - 1).tolist()
+        return [text[x:y] for x, y in zip(starts, stops)]
+
+    def enrich(self, gene_list):
+        """
+        Runs enrichment of `gene_list` against this library
+
+        :param gene_list: genes to enrich
+        :type gene_list: list
+        :return: one row per term that overlaps `gene_list` with
+                 columns `Gene_set`, `Term`, `Overlap`, `P-value`,
+                 `Adjusted P-value` and `Genes`
+        :rtype: :py:class:`pandas.DataFrame`
+        """
+        gene_ids = self.get_gene_ids(gene_list)
+        return self.get_results(gene_ids, self.get_overlaps(gene_ids))
+
+    def get_results(self, gene_ids, overlaps):
+        """
+        Gets enrichment results for query `gene_ids` whose overlap
+        counts were already computed. This lets callers that derive
+        `overlaps` some other way, such as from a nested gene list,
+        skip :py:meth:`get_overlaps`
+
+        :param gene_ids: gene ids as returned by :py:meth:`get_gene_ids`
+        :type gene_ids: :py:class:`numpy.ndarray`
+        :param overlaps: overlap counts of `gene_ids` for every term
+                         as returned by :py:meth:`get_overlaps`
+        :type overlaps: :py:class:`numpy.ndarray`
+        :return: see :py:meth:`enrich`
+        :rtype: :py:class:`pandas.DataFrame`
+        """
+        term_ids = numpy.flatnonzero(overlaps)
+        return self.make_results(term_ids, overlaps[term_ids],
+                                 self.get_pvalues(overlaps, term_ids,
+                                                  len(gene_ids)),
+                                 self.get_hit_genes(gene_ids, term_ids))
+
+    def make_results(self, term_ids, overlaps, pvals, hits):
+        """
+        Builds enrichment results from values already computed for
+        each term, adjusting `pvals` over all of `term_ids`
+
+        :param term_ids: ids of terms that overlap the query, sorted
+        :type term_ids: :py:class:`numpy.ndarray`
+        :param overlaps: overlap count of each of `term_ids`
+        :type overlaps: :py:class:`numpy.ndarray`
+        :param pvals: P-value of each of `term_ids`
+        :type pvals: :py:class:`numpy.ndarray`
+        :param hits: as returned by :py:meth:`get_hit_genes` for
+                     `term_ids`
+        :type hits: list
+        :return: see :py:meth:`enrich`
+        :rtype: :py:class:`pandas.DataFrame`
+        """
+        overlap_col = [str(o) + '/' + str(t) for o, t in
+                       zip(numpy.asarray(overlaps).tolist(),
+                           self.term_sizes[term_ids].tolist())]
+        return pandas.DataFrame({'Gene_set': self.name,
+                                 'Term': [self.terms[x] for x in
+                                          numpy.asarray(term_ids).tolist()],
+                                 'Overlap': overlap_col,
+                                 'P-value': pvals,
+                                 'Adjusted P-value':
+                                     benjamini_hochberg(pvals),
+                                 'Genes': hits},
+                                columns=['Gene_set', 'Term', 'Overlap',
+                                         'P-value', 'Adjusted P-value',
+                                         'Genes'])
+
+
+class LocalEnrichrResult(object):
+    """
+    Holds results of a :py:class:`LocalEnrichr` query in the
+    ``results`` attribute just like the object returned by
+    :py:func:`gseapy.enrichr`
+    """
+    def __init__(self, results):
+        """
+        Constructor
+
+        :param results: enrichment results
+        :type results: :py:class:`pandas.DataFrame`
+        """
+        self.results = results
+
+
+class LocalEnrichr(object):
+    """
+    Runs enrichment in process against GMT gene set libraries
+    stored on disk. P-values are computed with the Fisher exact
+    test (hypergeometric upper tail) and adjusted per library
+    with Benjamini-Hochberg, the same way Enrichr does it.
+    Libraries are loaded once into a :py:class:`TermLibrary`
+    and kept for later queries.
+
+    Instances can be passed as the `enrichr` parameter of
+    :py:func:`~cdenrichrgenestoterm.cdenrichrgenestoterm.run_enrichr`
+    in place of :py:mod:`gseapy`
+    """
+    results_in_memory = True
+    """
+    Results are returned in ``results`` attribute so no
+    report files need to be written
+    """
+
+    def __init__(self, gmtdir, checksums=None, file_stats=None):
+        """
+        Constructor
+
+        :param gmtdir: directory containing ``<library>.gmt`` files
+        :type gmtdir: str
+        :param checksums: if set, file name => SHA-256 hex digest,
+                          see :py:meth:`~cdenrichrgenestoterm.librarystore.LibraryStore.get_checksums`.
+                          Each file is checked against it when loaded
+                          and compiled files not in it are ignored
+        :type checksums: dict
+        :param file_stats: file name => (size, modification time in
+                           nanoseconds) the file had when its checksum
+                           was computed, see :py:meth:`~cdenrichrgenestoterm.librarystore.LibraryStore.get_file_stats`.
+                           A file that still has them is not read to
+                           check its checksum
+        :type file_stats: dict
+        """
+        self._gmtdir = gmtdir
+        self._checksums = checksums
+        self._file_stats = file_stats or {}
+        self._libraries = {}
+        self._lock = threading.Lock()
+
+    def get_library(self, library):
+        """
+        Gets gene set library, loading it from disk the first
+        time it is requested. If a compiled ``<library>.tlib`` file,
+        see :py:mod:`~cdenrichrgenestoterm.compiledlibrary`, is in
+        the directory and is not older then ``<library>.gmt`` it is
+        memory mapped instead of parsing the GMT file
+
+        :param library: name of library
+        :type library: str
+        :raises ValueError: if file loaded does not match its checksum
+        :return: library
+        :rtype: :py:class:`TermLibrary`
+        """
+        with self._lock:
+            if library not in self._libraries:
+                with metrics.get_metrics().time_stage('library_load',
+                                                      library=library):
+                    self._libraries[library] = self._load_library(library)
+            return self._libraries[library]
+
+    def _load_library(self, library):
+        from cdenrichrgenestoterm import compiledlibrary
+        compiled_file = compiledlibrary.get_compiled_file(self._gmtdir,
+                                                          library)
+        gmtfile = os.path.join(self._gmtdir, library + GMT_SUFFIX)
+        if os.path.isfile(compiled_file) and \
+                (self._checksums is None or
+                 os.path.basename(compiled_file) in self._checksums):
+            if not os.path.isfile(gmtfile) or \
+                    os.path.getmtime(compiled_file) >= \
+                    os.path.getmtime(gmtfile):
+                self._check(compiled_file)
+                return compiledlibrary.load_compiled_library(compiled_file)
+        gmtfile = get_gmt_file(self._gmtdir, library)
+        self._check(gmtfile)
+        return TermLibrary.from_gmt_file(library, gmtfile)
+
+    def _check(self, path):
+        """
+        Checks file at `path` matches its checksum if checksums
+        were given. The file is only read to compute its checksum
+        if its size or modification time is not the one recorded
+        in the file stats given to the constructor
+
+        :raises ValueError: if it does not or has no checksum
+        """
+        if self._checksums is None:
+            return
+        from cdenrichrgenestoterm.librarystore import get_sha256
+        file_name = os.path.basename(path)
+        checksum = self._checksums.get(file_name)
+        if checksum is None:
+            raise ValueError('Checksum mismatch for ' + path)
+        stat = os.stat(path)
+        if self._file_stats.get(file_name) == (stat.st_size,
+                                               stat.st_mtime_ns):
+            return
+        if get_sha256(path) != checksum:
+            raise ValueError('Checksum mismatch for ' + path)
+
+    def enrich_library(self, gene_list, library):
+        """
+        Runs enrichment of `gene_list` against `library`
+
+        :param gene_list: genes to enrich
+        :type gene_list: list
+        :param library: name of library
+        :type library: str
+        :return: see :py:meth:`TermLibrary.enrich`
+        :rtype: :py:class:`pandas.DataFrame`
+        """
+        return self.get_library(library).enrich(gene_list)
+
+    def enrichr(self, gene_list=None, gene_sets=None, cutoff=0.05,
+                no_plot=True, outdir=None, **kwargs):
+        """
+        Runs enrichment with the same call signature as
+        :py:func:`gseapy.enrichr`. If `outdir` is set a
+        ``<library>.human.enrichr.reports.txt`` file is written for
+        each library just like :py:mod:`gseapy` does.
+
+        :param gene_list: genes to enrich
+        :type gene_list: list
+        :param gene_sets: comma delimited library names
+        :type gene_sets: str
+        :param cutoff: unused, kept for compatibility
+        :param no_plot: unused, kept for compatibility
+        :param outdir: directory to write report files to or ``None``
+        :type outdir: str
+        :return: results of all libraries combined
+        :rtype: :py:class:`LocalEnrichrResult`
+        """
+        d_frames = []
+        for library in gene_sets.split(','):
+            library = library.strip()
+            if len(library) == 0:
+                continue
+            df = self.enrich_library(gene_list, library)
+            if outdir is not None:
+                df.to_csv(os.path.join(outdir, library + '.' + ORGANISM +
+                                       '.enrichr.reports.txt'),
+                          index=False, encoding='utf-8', sep='\t')
+            d_frames.append(df)
+        if len(d_frames) == 0:
+            return LocalEnrichrResult(pandas.DataFrame())
+        mega_df = pandas.concat(d_frames)
+        mega_df.reset_index(drop=True, inplace=True)
+        return LocalEnrichrResult(mega_df)
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import json
+import time
+import threading
+import contextlib
+
+
+PROMETHEUS_PREFIX = 'cdenrichrgenestoterm'
+"""
+Prefix of metric names in Prometheus text format output
+"""
+
+
+class NullMetrics(object):
+    """
+    Metrics recorder that records nothing, used when metrics
+    are not enabled so instrumented code costs next to nothing
+    """
+    enabled = False
+
+    def time_stage(self, stage, library=None):
+        """
+        Context manager that times the code it wraps as `stage`,
+        see :py:meth:`StageMetrics.time_stage`
+        """
+        return contextlib.nullcontext()
+
+    def record(self, stage, seconds, library=None):
+        """
+        Does nothing, see :py:meth:`StageMetrics.record`
+        """
+        pass
+
+    def increment(self, counter, value=1):
+        """
+        Does nothing, see :py:meth:`StageMetrics.increment`
+        """
+        pass
+
+
+class StageMetrics(NullMetrics):
+    """
+    Thread safe recorder of wall clock time spent in each stage
+    of a run, such as importing gseapy, enriching a library or
+    serializing output, along with counters such as cache hits.
+    Time spent in a stage is kept per library where one is given
+    """
+    enabled = True
+
+    def __init__(self, clock=time.perf_counter):
+        """
+        Constructor
+
+        :param clock: function returning current time in seconds
+        """
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._counters = {}
+
+    @contextlib.contextmanager
+    def time_stage(self, stage, library=None):
+        """
+        Context manager that records time spent in the code it
+        wraps as `stage`, even if that code raises an error
+
+        :param stage: name of stage
+        :type stage: str
+        :param library: gene set library the stage is for, if any
+        :type library: str
+        """
+        start = self._clock()
+        try:
+            yield
+        finally:
+            self.record(stage, self._clock() - start, library=library)
+
+    def record(self, stage, seconds, library=None):
+        """
+        Records `seconds` spent in `stage`
+
+        :param stage: name of stage
+        :type stage: str
+        :param seconds: time spent
+        :type seconds: float
+        :param library: gene set library the stage is for, if any
+        :type library: str
+        :return: None
+        """
+        with self._lock:
+            self._add(self._stages, (stage, library), 1, seconds, seconds)
+
+    @staticmethod
+    def _add(stages, key, count, seconds, max_seconds):
+        cur = stages.get(key)
+        if cur is None:
+            stages[key] = [count, seconds, max_seconds]
+            return
+        cur[0] += count
+        cur[1] += seconds
+        cur[2] = max(cur[2], max_seconds)
+
+    def increment(self, counter, value=1):
+        """
+        Adds `value` to `counter`
+
+        :param counter: name of counter
+        :type counter: str
+        :param value: amount to add
+        :type value: int
+        :return: None
+        """
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + value
+
+    def get_record(self):
+        """
+        Gets everything recorded so far as a JSON serializable dict
+        of form:
+
+        .. code-block::
+
+            {
+             "stages": {STAGE: {"count": N, "seconds": S,
+                                "max_seconds": M,
+                                "libraries": {LIBRARY: {"count": ...}}}},
+             "counters": {COUNTER: N}
+            }
+
+        where ``libraries`` is only set for stages timed per library
+        and the values of a stage are summed over its libraries
+
+        :return: record
+        :rtype: dict
+        """
+        with self._lock:
+            items = sorted(self._stages.items(),
+                           key=lambda x: (x[0][0], x[0][1] or ''))
+            counters = dict(self._counters)
+        totals = {}
+        libraries = {}
+        for (stage, library), vals in items:
+            self._add(totals, stage, vals[0], vals[1], vals[2])
+            if library is not None:
+                libraries.setdefault(stage, {})[library] = \
+                    self._to_dict(vals)
+        stages = {}
+        for stage, vals in totals.items():
+            stages[stage] = self._to_dict(vals)
+            if stage in libraries:
+                stages[stage]['libraries'] = libraries[stage]
+        return {'stages': stages, 'counters': counters}
+
+    @staticmethod
+    def _to_dict(vals):
+        return {'count': vals[0], 'seconds': round(vals[1], 6),
+                'max_seconds': round(vals[2], 6)}
+
+    def merge(self, record):
+        """
+        Adds `record` from :py:meth:`get_record`, such as one from
+        another process, to this recorder
+
+        :param record: record to add
+        :type record: dict
+        :return: None
+        """
+        with self._lock:
+            for stage, vals in record.get('stages', {}).items():
+                count = vals['count']
+                seconds = vals['seconds']
+                for library, lib_vals in vals.get('libraries', {}).items():
+                    self._add(self._stages, (stage, library),
+                              lib_vals['count'], lib_vals['seconds'],
+                              lib_vals['max_seconds'])
+                    count -= lib_vals['count']
+                    seconds -= lib_vals['seconds']
+                # whatever the libraries do not account for was
+                # recorded without a library
+                if count > 0:
+                    self._add(self._stages, (stage, None), count,
+                              max(seconds, 0.0), vals['max_seconds'])
+            for counter, value in record.get('counters', {}).items():
+                self._counters[counter] = self._counters.get(counter,
+                                                             0) + value
+
+    def to_prometheus(self, prefix=PROMETHEUS_PREFIX):
+        """
+        Gets everything recorded so far in Prometheus text format
+
+        :param prefix: prefix of metric names
+        :type prefix: str
+        :return: metrics
+        :rtype: str
+        """
+        with self._lock:
+            items = sorted(self._stages.items(),
+                           key=lambda x: (x[0][0], x[0][1] or ''))
+            counters = sorted(self._counters.items())
+        lines = []
+        for suffix, idx, kind, desc in [
+                ('stage_seconds_total', 1, 'counter',
+                 'Wall clock seconds spent in stage'),
+                ('stage_count_total', 0, 'counter',
+                 'Number of times stage ran'),
+                ('stage_max_seconds', 2, 'gauge',
+                 'Longest single run of stage in seconds')]:
+            name = prefix + '_' + suffix
+            lines.append('# HELP ' + name + ' ' + desc)
+            lines.append('# TYPE ' + name + ' ' + kind)
+            for (stage, library), vals in items:
+                labels = 'stage="' + _escape_label(stage) + '"'
+                if library is not None:
+                    labels += ',library="' + _escape_label(library) + '"'
+                lines.append(name + '{' + labels + '} ' + repr(vals[idx]))
+        for counter, value in counters:
+            name = prefix + '_' + counter + '_total'
+            lines.append('# TYPE ' + name + ' counter')
+            lines.append(name + ' ' + str(value))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').\
+        replace('\n', '\\n')
+
+
+_METRICS = NullMetrics()
+_METRICS_LOCK = threading.Lock()
+
+
+def get_metrics():
+    """
+    Gets metrics recorder in use by this process
+
+    :return: recorder, a :py:class:`NullMetrics` unless
+             :py:func:`set_metrics` was called
+    :rtype: :py:class:`NullMetrics`
+    """
+    return _METRICS
+
+
+def set_metrics(metrics):
+    """
+    Sets metrics recorder in use by this process
+
+    :param metrics: recorder or ``None`` to stop recording
+    :type metrics: :py:class:`NullMetrics`
+    :return: previous recorder
+    :rtype: :py:class:`NullMetrics`
+    """
+    global _METRICS
+    if metrics is None:
+        metrics = NullMetrics()
+    with _METRICS_LOCK:
+        prev = _METRICS
+        _METRICS = metrics
+    return prev
+
+
+def is_requested(theargs):
+    """
+    Checks if `theargs` asks for metrics
+
+    :param theargs: parsed command line arguments
+    :type theargs: :py:class:`argparse.Namespace`
+    :return: ``True`` if any metrics output is set
+    :rtype: bool
+    """
+    return getattr(theargs, 'metrics', False) is True or \
+        getattr(theargs, 'metricsfile', None) is not None or \
+        getattr(theargs, 'prometheusfile', None) is not None
+
+
+def write_metrics(theargs, metrics):
+    """
+    Writes `metrics` as set by `theargs`. The JSON record,
+    ``{"metrics": RECORD}`` with RECORD as returned by
+    :py:meth:`StageMetrics.get_record`, is appended as one line to
+    `theargs.metricsfile` if set, otherwise written to
+    :py:const:`sys.stderr` if `theargs.metrics` is set. If
+    `theargs.prometheusfile` is set it is overwritten with
+    the metrics in Prometheus text format
+
+    :param theargs: parsed command line arguments
+    :type theargs: :py:class:`argparse.Namespace`
+    :param metrics: recorder
+    :type metrics: :py:class:`StageMetrics`
+    :return: None
+    """
+    line = json.dumps({'metrics': metrics.get_record()},
+                      sort_keys=True) + '\n'
+    if getattr(theargs, 'metricsfile', None) is not None:
+        with open(theargs.metricsfile, 'a') as f:
+            f.write(line)
+    elif getattr(theargs, 'metrics', False) is True:
+        sys.stderr.write('\n' + line)
+    if getattr(theargs, 'prometheusfile', None) is not None:
+        with open(theargs.prometheusfile, 'w') as f:
+            f.write(metrics.to_prometheus())
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+
+
+CACHE_SUFFIX = '.json'
+"""
+Suffix of files holding cached results
+"""
+
+
+class ResultCache(object):
+    """
+    On disk cache of enrichment results. Each result is stored
+    as a JSON file named by its key under a sub directory named
+    by the first two characters of the key. Entries older than
+    `ttl` seconds are ignored and once there are more than
+    `max_entries` the least recently used entries are removed.
+    Files are written to a temporary name and renamed into place
+    so several processes can share one cache directory. The cache
+    directory is only scanned, to count entries, on the first
+    :py:meth:`store` and when evicting, so constructing a cache and
+    looking up entries stays cheap however many entries it holds.
+    """
+    def __init__(self, cachedir, max_entries=100000, ttl=None):
+        """
+        Constructor
+
+        :param cachedir: directory to store cache in, created if
+                         it does not exist
+        :type cachedir: str
+        :param max_entries: max number of entries to keep
+        :type max_entries: int
+        :param ttl: seconds an entry is valid for, ``None`` means
+                    entries never expire
+        :type ttl: float
+        """
+        self._cachedir = cachedir
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(cachedir, exist_ok=True)
+        self._num_entries = None
+
+    @staticmethod
+    def make_key(genes, params):
+        """
+        Makes key for `genes` and `params`. Genes are upper cased
+        and sorted so order and case do not matter
+
+        :param genes: genes
+        :type genes: list
+        :param params: other values that change the result, must
+                       be JSON serializable
+        :type params: dict
+        :return: SHA-256 hex digest
+        :rtype: str
+        """
+        norm_genes = sorted([g.strip().upper() for g in genes])
+        data = json.dumps({'genes': norm_genes, 'params': params},
+                          sort_keys=True)
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def _get_path(self, key):
+        return os.path.join(self._cachedir, key[:2], key + CACHE_SUFFIX)
+
+    def _get_entry_paths(self):
+        paths = []
+        for entry in os.listdir(self._cachedir):
+            subdir = os.path.join(self._cachedir, entry)
+            if not os.path.isdir(subdir):
+                continue
+            for cache_file in os.listdir(subdir):
+                if cache_file.endswith(CACHE_SUFFIX):
+                    paths.append(os.path.join(subdir, cache_file))
+        return paths
+
+    def lookup(self, key):
+        """
+        Looks up result for `key`. On a hit the entry is marked
+        as most recently used
+
+        :param key: key from :py:meth:`make_key`
+        :type key: str
+        :return: (``True``, result) on hit otherwise (``False``, ``None``)
+        :rtype: tuple
+        """
+        path = self._get_path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return False, None
+        if self._ttl is not None and time.time() - entry['created'] > \
+                self._ttl:
+            self._remove(path)
+            return False, None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return True, entry['result']
+
+    def store(self, key, result):
+        """
+        Stores `result` under `key`, evicting least recently used
+        entries if cache is over its max number of entries. Errors
+        writing to the cache are ignored
+
+        :param key: key from :py:meth:`make_key`
+        :type key: str
+        :param result: JSON serializable result, can be ``None``
+        :return: None
+        """
+        path = self._get_path(key)
+        with self._lock:
+            if self._num_entries is None:
+                self._num_entries = len(self._get_entry_paths())
+        try:
+            is_new = not os.path.isfile(path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                            suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'created': time.time(), 'result': result}, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+        if not is_new:
+            return
+        with self._lock:
+            self._num_entries += 1
+            if self._num_entries > self._max_entries:
+                self._evict()
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        """
+        Removes least recently used entries until cache holds 90%
+        of its max number of entries. Doing it in bulk means the
+        cache directory is only scanned every so often
+        """
+        entries = []
+        for path in self._get_entry_paths():
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                continue
+        entries.sort()
+        keep = int(self._max_entries * 0.9)
+        num_to_remove = max(len(entries) - keep, 0)
+        for mtime, path in entries[:num_to_remove]:
+            self._remove(path)
+        self._num_entries = len(entries) - num_to_remove
+
+    def clear(self):
+        """
+        Removes all entries
+
+        :return: None
+        """
+        with self._lock:
+            for entry in os.listdir(self._cachedir):
+                subdir = os.path.join(self._cachedir, entry)
+                if os.path.isdir(subdir):
+                    shutil.rmtree(subdir, ignore_errors=True)
+            self._num_entries = 0
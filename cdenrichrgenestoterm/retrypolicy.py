@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import time
+import random
+
+from cdenrichrgenestoterm import metrics
+
+
+NON_RETRYABLE_ERRORS = (LookupError, ValueError, TypeError,
+                        NotImplementedError)
+"""
+Errors that will not go away by trying again, such as a
+missing gene set library or an invalid query
+"""
+
+RETRYABLE_STATUS_CODES = (408, 429)
+"""
+HTTP status codes below 500 that are worth retrying,
+namely request timeout and too many requests
+"""
+
+
+class AttemptTimeoutError(OSError):
+    """
+    Raised when a single try takes longer than its timeout
+    """
+    pass
+
+
+class DeadlineExceededError(OSError):
+    """
+    Raised when the overall deadline passes before a try succeeds
+    """
+    pass
+
+
+def is_retryable(error):
+    """
+    Decides if `error` is worth retrying. Errors in
+    :py:const:`NON_RETRYABLE_ERRORS` are not. HTTP errors, be they
+    from requests (status in ``response.status_code``) or urllib
+    (status in ``code``), are retried only for 5xx status codes
+    and those in :py:const:`RETRYABLE_STATUS_CODES`.
+    Everything else, including connection errors, timeouts and
+    the generic errors gseapy raises when Enrichr is busy, is
+    retried
+
+    :param error: error raised by a try
+    :type error: Exception
+    :return: ``True`` if another try could succeed
+    :rtype: bool
+    """
+    if isinstance(error, NON_RETRYABLE_ERRORS):
+        return False
+    status_code = getattr(getattr(error, 'response', None),
+                          'status_code', None)
+    if status_code is None:
+        status_code = getattr(error, 'code', None)
+    if isinstance(status_code, int):
+        return status_code >= 500 or status_code in RETRYABLE_STATUS_CODES
+    return True
+
+
+class RetryPolicy(object):
+    """
+    Calls a function until it succeeds, waiting between tries
+    with exponential backoff and full jitter, i.e. a random
+    delay between 0 and ``min(max_backoff, backoff * 2^(try - 1))``
+    so clients that failed together do not retry together.
+
+    Each try can be limited to `timeout` seconds and all tries
+    together to `deadline` seconds. Tries run in the calling thread
+    and are never abandoned while still running, so the function
+    must enforce the limit itself: the timeout of each try, the
+    lesser of `timeout` and what is left of `deadline`, is passed
+    to it as keyword argument `timeout_arg`, e.g. as the timeout of
+    a :py:mod:`requests` call. If `timeout_arg` is ``None`` tries
+    are not limited and `deadline` is only checked between them.
+    """
+    def __init__(self, max_tries=2, backoff=1.0, max_backoff=30.0,
+                 timeout=None, deadline=None, timeout_arg=None,
+                 retryable=is_retryable,
+                 sleep=time.sleep, clock=time.monotonic,
+                 rand=random.random):
+        """
+        Constructor
+
+        :param max_tries: max number of tries
+        :type max_tries: int
+        :param backoff: base delay in seconds before the second try,
+                        doubled for each try after that
+        :type backoff: float
+        :param max_backoff: max delay in seconds between tries
+        :type max_backoff: float
+        :param timeout: max seconds for a single try, ``None`` or
+                        0 or less means no limit
+        :type timeout: float
+        :param deadline: max seconds for all tries including delays
+                         between them, ``None`` or 0 or less means
+                         no limit
+        :type deadline: float
+        :param timeout_arg: name of keyword argument through which
+                            each try is given its timeout in seconds
+        :type timeout_arg: str
+        :param retryable: function that is passed the error raised
+                          by a try and returns ``True`` if it should
+                          be retried
+        :type retryable: function
+        :param sleep: function used to wait between tries
+        :param clock: function returning current time in seconds
+        :param rand: function returning random float in [0, 1)
+        """
+        self._max_tries = max_tries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._timeout = timeout if timeout is not None and \
+            timeout > 0 else None
+        self._deadline = deadline if deadline is not None and \
+            deadline > 0 else None
+        self._timeout_arg = timeout_arg
+        self._retryable = retryable
+        self._sleep = sleep
+        self._clock = clock
+        self._rand = rand
+
+    def get_delay(self, cur_try):
+        """
+        Gets random delay before the try after `cur_try`
+
+        :param cur_try: number of the try that just failed starting at 1
+        :type cur_try: int
+        :return: delay in seconds
+        :rtype: float
+        """
+        cap = min(self._max_backoff, self._backoff * (2 ** (cur_try - 1)))
+        return max(cap, 0.0) * self._rand()
+
+    def _call_with_timeout(self, func, timeout, kwargs):
+        if timeout is not None and self._timeout_arg is not None:
+            kwargs = dict(kwargs)
+            kwargs[self._timeout_arg] = timeout
+        return func(**kwargs)
+
+    def _get_try_timeout(self, start):
+        """
+        Gets timeout for next try, which is the lesser of `timeout`
+        and what is left of the deadline
+
+        :raises DeadlineExceededError: if deadline has passed
+        """
+        timeout = self._timeout
+        if self._deadline is not None:
+            remaining = self._deadline - (self._clock() - start)
+            if remaining <= 0:
+                raise DeadlineExceededError('Deadline of ' +
+                                            str(self._deadline) +
+                                            ' seconds exceeded')
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+        return timeout
+
+    def _get_retry_delay(self, error, cur_try, start, try_start):
+        """
+        Records failed try `cur_try` that raised `error` and gets
+        delay before the next try
+
+        :raises Exception: `error` if it should not be retried
+        :raises DeadlineExceededError: if delay would pass deadline
+        """
+        recorder = metrics.get_metrics()
+        recorder.record('failed_try', self._clock() - try_start)
+        sys.stderr.write('Try # ' + str(cur_try) +
+                         ' caught exception: ' + str(error) + '\n')
+        if not self._retryable(error):
+            raise error
+        if cur_try >= self._max_tries:
+            raise error
+        delay = self.get_delay(cur_try)
+        if self._deadline is not None and \
+                self._clock() - start + delay >= self._deadline:
+            raise DeadlineExceededError('Deadline of ' +
+                                        str(self._deadline) +
+                                        ' seconds exceeded')
+        recorder.increment('retries')
+        return delay
+
+    def call(self, func, **kwargs):
+        """
+        Calls `func` with `kwargs` until it succeeds, it raises
+        an error that is not retryable, `max_tries` is reached
+        or the deadline passes
+
+        :param func: function to call
+        :raises DeadlineExceededError: if deadline passes
+        :raises Exception: last error raised by `func`
+        :return: whatever `func` returns
+        """
+        start = self._clock()
+        cur_try = 1
+        while True:
+            timeout = self._get_try_timeout(start)
+            try_start = self._clock()
+            try:
+                return self._call_with_timeout(func, timeout, kwargs)
+            except Exception as e:
+                delay = self._get_retry_delay(e, cur_try, start, try_start)
+            with metrics.get_metrics().time_stage('retry_wait'):
+                self._sleep(delay)
+            cur_try += 1
+
+    async def call_async(self, func, **kwargs):
+        """
+        Same as :py:meth:`call` for coroutine function `func` except
+        a try that times out is also cancelled, as is the try in
+        flight or the wait between tries when the task running this
+        is cancelled
+
+        :param func: coroutine function to call
+        :raises DeadlineExceededError: if deadline passes
+        :raises Exception: last error raised by `func`
+        :return: whatever `func` returns
+        """
+        import asyncio
+        start = self._clock()
+        cur_try = 1
+        while True:
+            timeout = self._get_try_timeout(start)
+            try_start = self._clock()
+            try:
+                try:
+                    if timeout is not None and \
+                            self._timeout_arg is not None:
+                        kwargs[self._timeout_arg] = timeout
+                    return await asyncio.wait_for(func(**kwargs), timeout)
+                except asyncio.TimeoutError:
+                    raise AttemptTimeoutError('Try timed out after ' +
+                                              str(round(timeout, 3)) +
+                                              ' seconds')
+            except Exception as e:
+                delay = self._get_retry_delay(e, cur_try, start, try_start)
+            with metrics.get_metrics().time_stage('retry_wait'):
+                await asyncio.sleep(delay)
+            cur_try += 1
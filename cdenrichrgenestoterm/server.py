@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import copy
+import json
+import argparse
+import socketserver
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+from cdenrichrgenestoterm import cdenrichrgenestoterm
+from cdenrichrgenestoterm import metrics
+from cdenrichrgenestoterm.singleflight import SingleFlight
+
+
+ENRICH_PATHS = ('/', '/enrich')
+"""
+Paths that accept POST of a query
+"""
+
+STATUS_PATH = '/status'
+"""
+Path that returns status of server on GET
+"""
+
+METRICS_PATH = '/metrics'
+"""
+Path that returns metrics in Prometheus text format on GET
+when metrics are enabled
+"""
+
+
+class Formatter(argparse.ArgumentDefaultsHelpFormatter,
+                argparse.RawDescriptionHelpFormatter):
+    pass
+
+
+def _parse_arguments(desc, args):
+    """
+    Parses command line arguments
+    :param desc:
+    :param args:
+    :return:
+    """
+    help_fm = Formatter
+    parser = argparse.ArgumentParser(description=desc,
+                                     formatter_class=help_fm)
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Host/address to listen on')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='Port to listen on')
+    parser.add_argument('--unixsocket',
+                        help='If set, listen on this Unix socket path '
+                             'instead of --host/--port')
+    cdenrichrgenestoterm.add_enrichment_arguments(parser)
+    return parser.parse_args(args)
+
+
+def _get_number(query, key, convert):
+    """
+    Gets value of `key` in `query` converted by `convert`
+
+    :param query: query
+    :type query: dict
+    :param key: key of value in `query`
+    :type key: str
+    :param convert: :py:class:`int` or :py:class:`float`
+    :raises ValueError: if value cannot be converted, including when
+                        it is a list or an object
+    :return: converted value
+    """
+    try:
+        return convert(query[key])
+    except (TypeError, ValueError):
+        raise ValueError(key + ' must be a number not ' +
+                         json.dumps(query[key]))
+
+
+class EnrichmentService(object):
+    """
+    Runs queries for the server. The enrichment engine, and with
+    --gmtdir the loaded gene set libraries, are created once and
+    kept warm in memory between queries. Identical queries that
+    arrive while one is running wait for and share its result
+    instead of each being enriched
+    """
+    def __init__(self, theargs, enrichr=None, retry_count=2):
+        """
+        Constructor
+
+        :param theargs: parsed command line arguments used as
+                        defaults for every query
+        :type theargs: :py:class:`argparse.Namespace`
+        :param enrichr: enrichment engine, if ``None`` one is picked via
+                        :py:func:`~cdenrichrgenestoterm.cdenrichrgenestoterm.get_enrichr`
+        :param retry_count: number of times to try enrichment
+        :type retry_count: int
+        """
+        self._theargs = theargs
+        if enrichr is None:
+            enrichr = cdenrichrgenestoterm.get_enrichr(theargs)
+        self._enrichr = enrichr
+        self._retry_count = retry_count
+        self._cache = cdenrichrgenestoterm.get_result_cache(theargs)
+        self._single_flight = SingleFlight()
+
+    def warm(self):
+        """
+        Loads default gene set libraries if enrichment is run locally
+        so the first query does not pay for it
+
+        :return: None
+        """
+        if not hasattr(self._enrichr, 'get_library'):
+            return
+        for library in self._theargs.genesets.split(','):
+            self._enrichr.get_library(library.strip())
+
+    def get_query_args(self, query):
+        """
+        Gets arguments for `query` which are the defaults passed
+        to the constructor with `maxpval`, `genesets`, `topk`,
+        `allterms`, `offset`, `limit` and `correction` from `query`
+        if set
+
+        :param query: query
+        :type query: dict
+        :raises ValueError: if any of those are invalid
+        :return: arguments for query
+        :rtype: :py:class:`argparse.Namespace`
+        """
+        theargs = copy.copy(self._theargs)
+        if query.get('maxpval') is not None:
+            theargs.maxpval = _get_number(query, 'maxpval', float)
+        if query.get('genesets') is not None:
+            if not isinstance(query['genesets'], str):
+                raise ValueError('genesets must be a comma delimited string')
+            theargs.genesets = query['genesets']
+        if query.get('topk') is not None:
+            theargs.topk = _get_number(query, 'topk', int)
+        if query.get('allterms') is not None:
+            theargs.allterms = bool(query['allterms'])
+        if query.get('offset') is not None:
+            theargs.offset = _get_number(query, 'offset', int)
+        if query.get('limit') is not None:
+            theargs.limit = _get_number(query, 'limit', int)
+        if query.get('correction') is not None:
+            if query['correction'] not in cdenrichrgenestoterm.CORRECTIONS:
+                raise ValueError('correction must be one of ' +
+                                 ', '.join(cdenrichrgenestoterm.CORRECTIONS))
+            theargs.correction = query['correction']
+        return theargs
+
+    def enrich(self, query):
+        """
+        Runs enrichment for `query`
+
+        :param query: query of form ``{"genes": GENES, "maxpval": PVAL,
+                      "genesets": GENESETS, "topk": TOPK, "allterms":
+                      BOOL, "offset": OFFSET, "limit": LIMIT,
+                      "correction": CORRECTION}`` where
+                      GENES is a list or comma delimited string and the
+                      other fields are optional
+        :type query: dict
+        :raises ValueError: if `query` is invalid
+        :return: best term, list of terms or ``None`` if none found
+        :rtype: dict or list
+        """
+        if not isinstance(query, dict) or 'genes' not in query:
+            raise ValueError('Query must be a JSON object with genes')
+        genes = query['genes']
+        if not isinstance(genes, str):
+            genes = ','.join(genes)
+        theargs = self.get_query_args(query)
+        theres = cdenrichrgenestoterm.run_enrichr_on_genes(
+            cdenrichrgenestoterm.parse_genes(genes), theargs,
+            enrichr=self._enrichr, retry_count=self._retry_count,
+            cache=self._cache, single_flight=self._single_flight)
+        if theres is None or isinstance(theres, (dict, list)):
+            return theres
+        return list(theres)
+
+
+class EnrichmentRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles requests. POST a JSON query (see
+    :py:meth:`EnrichmentService.enrich`) to ``/enrich`` and
+    the response holds the same JSON the command line tool
+    outputs or is 204 No Content if no term was found
+    """
+    def address_string(self):
+        """
+        Unix socket clients do not have an address so return
+        the socket path for them
+        """
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return str(self.server.server_address)
+
+    def _send_json(self, code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        recorder = metrics.get_metrics()
+        if self.path == METRICS_PATH and recorder.enabled:
+            body = recorder.to_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path != STATUS_PATH:
+            self._send_json(404, {'error': 'Not found'})
+            return
+        self._send_json(200, {'status': 'ok'})
+
+    def do_POST(self):
+        if self.path not in ENRICH_PATHS:
+            self._send_json(404, {'error': 'Not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            query = json.loads(self.rfile.read(length).decode('utf-8'))
+        except ValueError as ve:
+            self._send_json(400, {'error': 'Invalid JSON: ' + str(ve)})
+            return
+        try:
+            theres = self.server.service.enrich(query)
+        except ValueError as ve:
+            self._send_json(400, {'error': str(ve)})
+            return
+        except Exception as e:
+            sys.stderr.write('Caught exception: ' + str(e) + '\n')
+            self._send_json(500, {'error': str(e)})
+            return
+        if theres is None:
+            self.send_response(204)
+            self.end_headers()
+            return
+        self._send_json(200, theres)
+
+
+class EnrichmentHTTPServer(ThreadingHTTPServer):
+    """
+    HTTP server that answers queries with `service`
+    """
+    def __init__(self, server_address, service):
+        """
+        Constructor
+
+        :param server_address: (host, port) to listen on
+        :type server_address: tuple
+        :param service: runs the queries
+        :type service: :py:class:`EnrichmentService`
+        """
+        super(EnrichmentHTTPServer, self).__init__(server_address,
+                                                   EnrichmentRequestHandler)
+        self.service = service
+
+
+class EnrichmentUnixServer(socketserver.ThreadingMixIn,
+                           socketserver.UnixStreamServer):
+    """
+    HTTP over Unix socket server that answers queries with `service`
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, service):
+        """
+        Constructor
+
+        :param socket_path: path of Unix socket to listen on
+        :type socket_path: str
+        :param service: runs the queries
+        :type service: :py:class:`EnrichmentService`
+        """
+        super(EnrichmentUnixServer, self).__init__(socket_path,
+                                                   EnrichmentRequestHandler)
+        self.service = service
+
+
+def create_server(theargs, service):
+    """
+    Creates server as set by `theargs`
+
+    :param theargs: parsed command line arguments
+    :type theargs: :py:class:`argparse.Namespace`
+    :param service: runs the queries
+    :type service: :py:class:`EnrichmentService`
+    :return: server
+    """
+    if theargs.unixsocket is not None:
+        if os.path.exists(theargs.unixsocket):
+            os.unlink(theargs.unixsocket)
+        return EnrichmentUnixServer(theargs.unixsocket, service)
+    return EnrichmentHTTPServer((theargs.host, theargs.port), service)
+
+
+def main(args):
+    """
+    Main entry point for server
+
+    :param args: command line arguments with first argument being
+                 :py:const:`~cdenrichrgenestoterm.cdenrichrgenestoterm.SERVE_COMMAND`
+    :return: 0 for success otherwise failure
+    :rtype: int
+    """
+    desc = """
+        Runs persistent server that answers enrichment queries
+        keeping imports and, if --gmtdir is set, gene set
+        libraries loaded in memory between queries.
+
+        POST a JSON query to /enrich:
+
+        {
+         "genes": ["GENE1", "GENE2"] or "GENE1,GENE2",
+         "maxpval": OPTIONAL MAX P VALUE,
+         "genesets": "OPTIONAL COMMA DELIMITED GENE SETS",
+         "topk": OPTIONAL NUMBER OF BEST TERMS TO RETURN,
+         "allterms": OPTIONAL true TO RETURN ALL TERMS UNDER MAXPVAL,
+         "offset": OPTIONAL NUMBER OF TERMS TO SKIP WITH allterms,
+         "limit": OPTIONAL MAX NUMBER OF TERMS WITH allterms,
+         "correction": OPTIONAL "library", "bh" OR "bonferroni"
+        }
+
+        Response is the same JSON output by the command line tool
+        or 204 No Content if no term was found. GET /status can be
+        used as a health check. If --metrics, --metricsfile or
+        --prometheusfile is set GET /metrics returns time spent in
+        each stage of all queries so far in Prometheus text format
+        and they are also written out as set when the server stops.
+    """
+    theargs = _parse_arguments(desc, args[1:])
+    recorder = None
+    if metrics.is_requested(theargs):
+        recorder = metrics.StageMetrics()
+        metrics.set_metrics(recorder)
+    try:
+        service = EnrichmentService(theargs,
+                                    retry_count=theargs.retries)
+        service.warm()
+        server = create_server(theargs, service)
+        sys.stderr.write('Listening on ' + str(server.server_address) +
+                         '\n')
+        sys.stderr.flush()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if theargs.unixsocket is not None:
+                os.unlink(theargs.unixsocket)
+        return 0
+    except Exception as e:
+        sys.stderr.write('Caught exception: ' + str(e))
+        return 2
+    finally:
+        if recorder is not None:
+            metrics.set_metrics(None)
+            try:
+                metrics.write_metrics(theargs, recorder)
+            except OSError as e:
+                sys.stderr.write('Unable to write metrics: ' + str(e) + '\n')
+        sys.stderr.flush()
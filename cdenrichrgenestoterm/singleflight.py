@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+from cdenrichrgenestoterm import metrics
+
+
+class _Call(object):
+    """
+    Call in flight, see :py:class:`SingleFlight`
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces identical calls made from several threads at once.
+    The first caller for a key runs the call and every caller that
+    arrives with the same key while it is in flight waits for it and
+    gets the same result, or error, instead of making its own call.
+    Nothing is kept once the call is done so, unlike a cache, later
+    callers always get a fresh result. The result is shared, not
+    copied, so callers must not modify it
+    """
+    def __init__(self, counter='coalesced'):
+        """
+        Constructor
+
+        :param counter: metrics counter incremented each time a call
+                        is coalesced, ``None`` for no counter
+        :type counter: str
+        """
+        self._counter = counter
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, **kwargs):
+        """
+        Calls `func` with `kwargs` unless a call for `key` is already
+        in flight in which case its outcome is waited for
+
+        :param key: identifies calls that have the same outcome
+        :type key: str
+        :param func: function to call
+        :raises Exception: error raised by `func`
+        :return: (what `func` returned, ``True`` if it came from
+                 a call made by another caller)
+        :rtype: tuple
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+        if not leader:
+            if self._counter is not None:
+                metrics.get_metrics().increment(self._counter)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = func(**kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def get_num_in_flight(self):
+        """
+        Gets number of calls in flight
+
+        :return: number of distinct keys being called
+        :rtype: int
+        """
+        with self._lock:
+            return len(self._calls)
+
+
+class AsyncSingleFlight(object):
+    """
+    Same as :py:class:`SingleFlight` for coroutines on one event
+    loop. The shared call runs in its own task so a caller being
+    cancelled does not cancel it for the others. It is only
+    cancelled once every caller waiting for it has been
+    """
+    def __init__(self):
+        """
+        Constructor
+        """
+        self._calls = {}
+
+    async def do(self, key, func, **kwargs):
+        """
+        Awaits coroutine function `func` with `kwargs` unless a
+        call for `key` is already in flight in which case its
+        outcome is awaited
+
+        :param key: identifies calls that have the same outcome
+        :param func: coroutine function to call
+        :raises Exception: error raised by `func`
+        :return: (what `func` returned, ``True`` if it came from
+                 a call made by another caller)
+        :rtype: tuple
+        """
+        import asyncio
+        entry = self._calls.get(key)
+        shared = entry is not None
+        if shared:
+            metrics.get_metrics().increment('coalesced')
+        else:
+            task = asyncio.ensure_future(func(**kwargs))
+            entry = [task, 0]
+            self._calls[key] = entry
+            task.add_done_callback(lambda t: self._remove(key, t))
+        entry[1] += 1
+        try:
+            return await asyncio.shield(entry[0]), shared
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and not entry[0].done():
+                entry[0].cancel()
+
+    def _remove(self, key, task):
+        entry = self._calls.get(key)
+        if entry is not None and entry[0] is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # retrieve error so it is not logged as never retrieved
+            task.exception()
+
+    def get_num_in_flight(self):
+        """
+        Gets number of calls in flight
+
+        :return: number of distinct keys being called
+        :rtype: int
+        """
+        return len(self._calls)
@@ -18,7 +18,10 @@ with open('HISTORY.rst') as history_file:
 
 requirements = [
     'gseapy',
-    'pandas'
+    'numpy',
+    'pandas',
+    'requests',
+    'scipy'
 ]
 
 test_requirements = [
@@ -40,6 +43,7 @@ setup(
                  'cdenrichrgenestoterm'},
     include_package_data=True,
     install_requires=requirements,
+    python_requires='>=3.7',
     license="BSD license",
     zip_safe=False,
     keywords='cdenrichrgenestoterm',
@@ -48,13 +52,19 @@ setup(
         'Intended Audience :: Developers',
         'License :: OSI Approved :: BSD License',
         'Natural Language :: English',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
     ],
-    scripts=['cdenrichrgenestoterm/cdenrichrgenestoterm.py'],
+    entry_points={
+        'console_scripts': [
+            'cdenrichrgenestoterm.py='
+            'cdenrichrgenestoterm.cdenrichrgenestoterm:console_main'
+        ]
+    },
     test_suite='tests',
     tests_require=test_requirements
 )
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_aliasindex
+----------------------------------
+
+Tests for `aliasindex` module.
+"""
+
+import os
+import io
+import json
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from cdenrichrgenestoterm import aliasindex
+from cdenrichrgenestoterm import cdenrichrgenestoterm
+
+
+class TestAliasIndex(unittest.TestCase):
+
+    def write_hgnc(self, temp_dir):
+        hgncfile = os.path.join(temp_dir, 'hgnc.txt')
+        with open(hgncfile, 'w') as f:
+            f.write('hgnc_id\tsymbol\tname\talias_symbol\tprev_symbol\n')
+            f.write('HGNC:1\tTP53\ttumor protein\tp53|LFS1\t\n')
+            f.write('HGNC:2\tMTOR\tmtor\tFRAP|RAFT1\t"FRAP1|FRAP2"\n')
+            # SHARED is an alias of two symbols so is left out
+            f.write('HGNC:3\tGENEA\ta\tSHARED\t\n')
+            f.write('HGNC:4\tGENEB\tb\tSHARED|TP53\tOLDB\n')
+            # previous symbol wins over alias of another gene
+            f.write('HGNC:5\tGENEC\tc\tOLDB\t\n')
+            f.write('\n')
+        return hgncfile
+
+    def test_read_hgnc_file(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            res = aliasindex.read_hgnc_file(self.write_hgnc(temp_dir))
+            self.assertEqual('TP53', res['TP53'])
+            self.assertEqual('TP53', res['P53'])
+            self.assertEqual('MTOR', res['FRAP1'])
+            self.assertEqual('MTOR', res['FRAP'])
+            self.assertEqual('GENEB', res['OLDB'])
+            self.assertFalse('SHARED' in res)
+
+            # custom download headers and comma delimited symbols
+            hgncfile = os.path.join(temp_dir, 'custom.txt')
+            with open(hgncfile, 'w') as f:
+                f.write('Approved symbol\tPrevious symbols\tAlias symbols\n')
+                f.write('MTOR\tFRAP1, FRAP2\tRAFT1\n')
+            self.assertEqual({'MTOR': 'MTOR', 'FRAP1': 'MTOR',
+                              'FRAP2': 'MTOR', 'RAFT1': 'MTOR'},
+                             aliasindex.read_hgnc_file(hgncfile))
+
+            with open(hgncfile, 'w') as f:
+                f.write('foo\tbar\n')
+            with self.assertRaises(ValueError):
+                aliasindex.read_hgnc_file(hgncfile)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_resolve(self):
+        index = aliasindex.AliasIndex.from_dict({'P53': 'TP53',
+                                                 'TP53': 'TP53',
+                                                 'FRAP1': 'MTOR',
+                                                 'MTOR': 'MTOR'})
+        self.assertEqual(4, len(index))
+        self.assertEqual(['TP53', None, 'MTOR', 'TP53', None],
+                         index.resolve(['P53', 'ZZZ', 'FRAP1', 'TP53',
+                                        'AVERYLONGSYMBOL']))
+        self.assertEqual([], index.resolve([]))
+        self.assertEqual([None], aliasindex.AliasIndex.from_dict({}).
+                         resolve(['TP53']))
+
+    def test_build_and_load(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'hgnc' +
+                                aliasindex.ALIAS_INDEX_SUFFIX)
+            count = aliasindex.build_alias_index(self.write_hgnc(temp_dir),
+                                                 path)
+            index = aliasindex.load_alias_index(path)
+            self.assertEqual(count, len(index))
+            self.assertEqual(['MTOR', 'TP53', None],
+                             index.resolve(['FRAP2', 'LFS1', 'SHARED']))
+
+            with open(path, 'wb') as f:
+                f.write(b'not an index')
+            with self.assertRaises(ValueError):
+                aliasindex.load_alias_index(path)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_main(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            hgncfile = self.write_hgnc(temp_dir)
+            path = os.path.join(temp_dir, 'hgnc.aidx')
+            with patch('sys.stderr', new_callable=io.StringIO) as err:
+                self.assertEqual(0, cdenrichrgenestoterm.main(
+                    ['prog', cdenrichrgenestoterm.ALIASES_COMMAND,
+                     hgncfile, path]))
+                self.assertTrue('Wrote' in err.getvalue())
+                self.assertEqual(2, aliasindex.main(
+                    ['aliases', os.path.join(temp_dir, 'nope'), path]))
+
+            gmtdir = os.path.join(temp_dir, 'gmt')
+            os.makedirs(gmtdir)
+            with open(os.path.join(gmtdir, 'lib1.gmt'), 'w') as f:
+                f.write('term1\t\tTP53\tMTOR\tGENEA\n')
+                f.write('term2\t\tGENEB\tGENEC\tX\tY\tZ\n')
+            tfile = os.path.join(temp_dir, 'genes')
+            with open(tfile, 'w') as f:
+                f.write('p53,frap1,notagene,TP53')
+            with patch('sys.stdout', new_callable=io.StringIO) as out, \
+                    patch('sys.stderr', new_callable=io.StringIO) as err:
+                self.assertEqual(0, cdenrichrgenestoterm.main(
+                    ['prog', tfile, '--gmtdir', gmtdir, '--genesets',
+                     'lib1', '--maxpval', '1.0', '--aliasindex', path]))
+                res = json.loads(out.getvalue())
+                self.assertTrue('P53 -> TP53' in err.getvalue())
+                self.assertTrue('NOTAGENE' in err.getvalue())
+            self.assertEqual('term1', res['name'])
+            self.assertEqual(['MTOR', 'TP53'], sorted(res['intersections']))
+            self.assertEqual(1.0, res['jaccard'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
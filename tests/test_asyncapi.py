@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_asyncapi
+----------------------------------
+
+Tests for `asyncapi` module.
+"""
+
+import os
+import io
+import sys
+import time
+import json
+import asyncio
+import threading
+import unittest
+import urllib.parse
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from unittest.mock import patch
+
+from cdenrichrgenestoterm import asyncapi
+from cdenrichrgenestoterm.asyncapi import EnrichmentOptions
+from cdenrichrgenestoterm.enrichrclient import TokenBucket
+from cdenrichrgenestoterm.enrichrclient import read_export_report
+
+LIBRARY_DIR = os.path.join(os.path.dirname(__file__), 'data', 'libraries')
+
+TERMS = {'lib1': [('term1', ['A', 'B', 'C']),
+                  ('term2', ['D', 'E', 'F', 'G'])],
+         'lib2': [('other', ['X', 'Y', 'Z'])]}
+
+
+class StubEnrichrHandler(BaseHTTPRequestHandler):
+    """
+    Stub of the Enrichr API. Gene lists posted to ``/addList`` are
+    kept in ``server.lists`` and ``/export`` answers with a report
+    of the terms in :py:const:`TERMS` that overlap the list. Each
+    request first pops the next (status, delay) pair from
+    ``server.responses`` if any are left
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super(StubEnrichrHandler, self).setup()
+        self.server.num_connections += 1
+
+    def _get_status(self):
+        self.server.num_requests += 1
+        if len(self.server.responses) > 0:
+            status, delay = self.server.responses.pop(0)
+            time.sleep(delay)
+            return status
+        return 200
+
+    def _send(self, status, body):
+        try:
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        status = self._get_status()
+        if status != 200:
+            self._send(status, b'{}')
+            return
+        text = body.decode('utf-8')
+        genes = text.split('name="list"\r\n\r\n')[1].split('\r\n')[0]
+        self.server.lists.append(genes.split('\n'))
+        self._send(200, json.dumps({'userListId': len(self.server.lists),
+                                    'shortId': 'x'}).encode('utf-8'))
+
+    def do_GET(self):
+        status = self._get_status()
+        if status != 200:
+            self._send(status, b'{}')
+            return
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        genes = set(self.server.lists[int(query['userListId'][0]) - 1])
+        lines = ['Term\tOverlap\tP-value\tAdjusted P-value\t'
+                 'Old P-value\tOld Adjusted P-value\tOdds Ratio\t'
+                 'Combined Score\tGenes']
+        for name, term_genes in TERMS[query['backgroundType'][0]]:
+            hits = sorted(genes.intersection(term_genes))
+            if len(hits) == 0:
+                continue
+            pval = 0.1 / len(hits)
+            lines.append('\t'.join([name, str(len(hits)) + '/' +
+                                    str(len(term_genes)), str(pval),
+                                    str(pval), '0', '0', '1', '1',
+                                    ';'.join(hits)]))
+        self._send(200, ('\n'.join(lines) + '\n').encode('utf-8'))
+
+
+class StubEnrichrServer(ThreadingHTTPServer):
+    # every query of test_many_in_flight connects at once
+    request_queue_size = 128
+
+
+class TestAsyncApi(unittest.TestCase):
+
+    def setUp(self):
+        self._server = StubEnrichrServer(('127.0.0.1', 0),
+                                         StubEnrichrHandler)
+        self._server.daemon_threads = True
+        self._server.lists = []
+        self._server.responses = []
+        self._server.num_requests = 0
+        self._server.num_connections = 0
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        self._url = 'http://127.0.0.1:' + \
+                    str(self._server.server_address[1])
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def get_options(self, **kwargs):
+        params = {'genesets': 'lib1,lib2', 'maxpval': 1.0,
+                  'url': self._url, 'retrybackoff': 0.0}
+        params.update(kwargs)
+        return EnrichmentOptions(**params)
+
+    def test_options(self):
+        options = EnrichmentOptions()
+        theargs = options.to_args()
+        self.assertEqual(0.05, theargs.maxpval)
+        self.assertEqual(asyncapi.ENRICHR_URL, theargs.url)
+        self.assertEqual(None, theargs.cachedir)
+        theargs = EnrichmentOptions(topk=3, allterms=True,
+                                    limit=4).to_args()
+        self.assertEqual((3, True, 4), (theargs.topk, theargs.allterms,
+                                        theargs.limit))
+        for kwargs, error in [({'maxpval': '0.1'}, TypeError),
+                              ({'topk': True}, TypeError),
+                              ({'topk': 0}, ValueError),
+                              ({'genesets': ','}, ValueError),
+                              ({'offset': -1}, ValueError),
+                              ({'correction': 'foo'}, ValueError)]:
+            with self.assertRaises(error):
+                EnrichmentOptions(**kwargs)
+        with self.assertRaises(AttributeError):
+            options.foo = 1
+        with self.assertRaises(ValueError):
+            asyncapi.AsyncEnrichrClient('ftp://foo')
+
+    def test_enrich_genes(self):
+        res = asyncio.run(asyncapi.enrich_genes(' a,b,a ,x',
+                                                self.get_options()))
+        self.assertEqual('term1', res['name'])
+        self.assertEqual('lib1', res['source'])
+        self.assertEqual(['A', 'B'], res['intersections'])
+        self.assertEqual(0.667, res['jaccard'])
+        self.assertEqual([['A', 'B', 'X']], self._server.lists)
+        # one upload plus one export per library
+        self.assertEqual(3, self._server.num_requests)
+
+        res = asyncio.run(asyncapi.enrich_genes(['a', 'b', 'x', 'y'],
+                                                self.get_options(topk=3)))
+        self.assertEqual(['term1', 'other'], [x['name'] for x in res])
+
+        with patch('sys.stderr', new_callable=io.StringIO):
+            self.assertEqual(None, asyncio.run(asyncapi.enrich_genes(
+                ['q'], self.get_options())))
+            self.assertEqual(None, asyncio.run(asyncapi.enrich_genes(
+                [' '], self.get_options())))
+
+    def test_many_in_flight(self):
+        async def run_all():
+            client = asyncapi.AsyncEnrichrClient(self._url)
+            # distinct lists so none are coalesced
+            return await asyncio.gather(*[asyncapi.enrich_genes(
+                ['A', 'B', 'Q' + str(x)] if x % 2 == 0 else
+                ['X', 'Y', 'Q' + str(x)],
+                self.get_options(), client=client) for x in range(40)])
+        res = asyncio.run(run_all())
+        self.assertEqual(['term1', 'other'] * 20, [x['name'] for x in res])
+        self.assertEqual(120, self._server.num_requests)
+        # requests share the keep-alive connections of the pool
+        self.assertTrue(self._server.num_connections <=
+                        asyncapi.DEFAULT_POOL_SIZE)
+
+    def test_parsing_off_event_loop(self):
+        threads = []
+
+        def read_report(report, library):
+            threads.append(threading.current_thread())
+            return read_export_report(report, library)
+
+        with patch('cdenrichrgenestoterm.asyncapi.read_export_report',
+                   side_effect=read_report):
+            res = asyncio.run(asyncapi.enrich_genes(['a', 'b'],
+                                                    self.get_options()))
+        self.assertEqual('term1', res['name'])
+        self.assertEqual(2, len(threads))
+        self.assertTrue(threading.current_thread() not in threads)
+
+    def test_identical_queries_coalesced(self):
+        self._server.responses = [(200, 0.3)]
+
+        async def run_all():
+            return await asyncio.gather(*[asyncapi.enrich_genes(
+                ['a', 'b'] if x % 2 == 0 else ['B', 'A', 'a'],
+                self.get_options()) for x in range(10)])
+        res = asyncio.run(run_all())
+        self.assertEqual(['term1'] * 10, [x['name'] for x in res])
+        self.assertEqual(3, self._server.num_requests)
+
+        async def cancel_one():
+            first = asyncio.ensure_future(asyncapi.enrich_genes(
+                ['a', 'b'], self.get_options()))
+            second = asyncio.ensure_future(asyncapi.enrich_genes(
+                ['a', 'b'], self.get_options()))
+            await asyncio.sleep(0.1)
+            first.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await first
+            return await second
+        self._server.responses = [(200, 0.3)]
+        self.assertEqual('term1', asyncio.run(cancel_one())['name'])
+        self.assertEqual(6, self._server.num_requests)
+
+    def test_rate_limiter(self):
+        async def run_all():
+            client = asyncapi.AsyncEnrichrClient(
+                self._url, rate_limiter=TokenBucket(10))
+            return await asyncio.gather(*[client.add_list(['A', str(x)])
+                                          for x in range(5)])
+        start = time.monotonic()
+        self.assertEqual([1, 2, 3, 4, 5], sorted(asyncio.run(run_all())))
+        self.assertTrue(time.monotonic() - start >= 0.4)
+
+    def test_retries_and_errors(self):
+        self._server.responses = [(503, 0), (200, 0), (429, 0)]
+        with patch('sys.stderr', new_callable=io.StringIO):
+            res = asyncio.run(asyncapi.enrich_genes(['a', 'b'],
+                                                    self.get_options()))
+        self.assertEqual('term1', res['name'])
+        self.assertEqual(5, self._server.num_requests)
+
+        self._server.responses = [(400, 0)]
+        with patch('sys.stderr', new_callable=io.StringIO) as err:
+            self.assertEqual(None, asyncio.run(asyncapi.enrich_genes(
+                ['a', 'b'], self.get_options())))
+            self.assertTrue('400 Client Error' in err.getvalue())
+
+    def test_timeout(self):
+        self._server.responses = [(200, 2.0)]
+        start = time.monotonic()
+        with patch('sys.stderr', new_callable=io.StringIO) as err:
+            self.assertEqual(None, asyncio.run(asyncapi.enrich_genes(
+                ['a', 'b'], self.get_options(timeout=0.2, retries=1))))
+            self.assertTrue('timed out' in err.getvalue())
+        self.assertTrue(time.monotonic() - start < 1.5)
+
+    def test_cancel(self):
+        self._server.responses = [(200, 2.0)]
+
+        async def run_and_cancel():
+            task = asyncio.ensure_future(asyncapi.enrich_genes(
+                ['a', 'b'], self.get_options()))
+            await asyncio.sleep(0.2)
+            task.cancel()
+            await task
+
+        start = time.monotonic()
+        with self.assertRaises(asyncio.CancelledError):
+            asyncio.run(run_and_cancel())
+        self.assertTrue(time.monotonic() - start < 1.5)
+
+    def test_enrich_genes_local(self):
+        options = EnrichmentOptions(gmtdir=LIBRARY_DIR,
+                                    genesets='Fixture_Process',
+                                    maxpval=1.0)
+        res = asyncio.run(asyncapi.enrich_genes(['CDK1', 'CCNB1', 'CDC20'],
+                                                options))
+        self.assertEqual('Fixture_Process', res['source'])
+        self.assertEqual('cell cycle', res['name'])
+
+    def test_concurrent_local_queries_keep_stdout(self):
+        options = EnrichmentOptions(gmtdir=LIBRARY_DIR,
+                                    genesets='Fixture_Process,'
+                                             'Fixture_Component',
+                                    maxpval=1.0, allterms=True)
+        genes = ['CDK1', 'CCNB1', 'CDC20', 'CASP3', 'CASP8', 'HSF1']
+
+        async def run_all():
+            return await asyncio.gather(*[
+                asyncapi.enrich_genes(genes[:2 + x % 5] + ['G' + str(x)],
+                                      options)
+                for x in range(100)])
+
+        stdout = sys.stdout
+        res = asyncio.run(run_all())
+        self.assertTrue(sys.stdout is stdout)
+        self.assertEqual(100, len(res))
+        self.assertTrue(all(len(x) > 0 for x in res))
+
+
+if __name__ == '__main__':
+    unittest.main()
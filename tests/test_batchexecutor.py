@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_batchexecutor
+----------------------------------
+
+Tests for `batchexecutor` module.
+"""
+
+import os
+import io
+import json
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from cdenrichrgenestoterm import metrics
+from cdenrichrgenestoterm import batchexecutor
+from cdenrichrgenestoterm import cdenrichrgenestoterm
+
+LIBRARY_DIR = os.path.join(os.path.dirname(__file__), 'data', 'libraries')
+
+
+class TestBatchExecutor(unittest.TestCase):
+
+    def write_batch(self, tfile, num_lists):
+        gene_lists = [['HSPA1A', 'HSPA1B', 'DNAJB1'],
+                      ['CDK1', 'CCNB1', 'CDC20', 'PLK1'],
+                      ['CASP3', 'CASP8'],
+                      ['NOTAGENE']]
+        with open(tfile, 'w') as f:
+            for idx in range(num_lists):
+                f.write(json.dumps({'id': 'l' + str(idx),
+                                    'genes': gene_lists[idx %
+                                                        len(gene_lists)]}) +
+                        '\n')
+
+    def test_get_chunks(self):
+        self.assertEqual([[1, 2], [3, 4], [5]],
+                         list(batchexecutor._get_chunks(iter(range(1, 6)),
+                                                        2)))
+        self.assertEqual([], list(batchexecutor._get_chunks([], 2)))
+
+    def test_run_matches_serial(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            tfile = os.path.join(temp_dir, 'batch')
+            self.write_batch(tfile, 21)
+            theargs = cdenrichrgenestoterm._parse_arguments(
+                'desc', [tfile, '--batch', '--gmtdir', LIBRARY_DIR,
+                         '--genesets', 'Fixture_Process,Fixture_Component',
+                         '--maxpval', '1.0', '--topk', '2'])
+            serial_out = io.StringIO()
+            self.assertEqual(21, cdenrichrgenestoterm.run_enrichr_batch(
+                tfile, theargs, out=serial_out))
+
+            executor = batchexecutor.BatchExecutor(theargs, 3,
+                                                   chunk_size=2,
+                                                   max_pending=1)
+            out = io.StringIO()
+            count = executor.run(
+                cdenrichrgenestoterm.read_batch_inputfile(tfile), out)
+            self.assertEqual(21, count)
+            self.assertEqual(serial_out.getvalue(), out.getvalue())
+            res = [json.loads(x) for x in out.getvalue().strip().split('\n')]
+            self.assertEqual(['l' + str(x) for x in range(21)],
+                             [x['id'] for x in res])
+            self.assertEqual(None, res[3]['result'])
+            self.assertEqual({}, batchexecutor._WORKER_STATE)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_run_coalesces_identical_lists_in_flight(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            tfile = os.path.join(temp_dir, 'batch')
+            self.write_batch(tfile, 21)
+            theargs = cdenrichrgenestoterm._parse_arguments(
+                'desc', [tfile, '--batch', '--gmtdir', LIBRARY_DIR,
+                         '--genesets', 'Fixture_Process',
+                         '--maxpval', '1.0'])
+            serial_out = io.StringIO()
+            cdenrichrgenestoterm.run_enrichr_batch(tfile, theargs,
+                                                   out=serial_out)
+            recorder = metrics.StageMetrics()
+            prev = metrics.set_metrics(recorder)
+            try:
+                executor = batchexecutor.BatchExecutor(theargs, 2,
+                                                       chunk_size=8,
+                                                       max_pending=2)
+                out = io.StringIO()
+                self.assertEqual(21, executor.run(
+                    cdenrichrgenestoterm.read_batch_inputfile(tfile), out))
+            finally:
+                metrics.set_metrics(prev)
+            self.assertEqual(serial_out.getvalue(), out.getvalue())
+            # first chunk sends 4 of its 8 lists, second chunk is all
+            # repeats of those and third is sent once the first is done
+            self.assertEqual(13, recorder.get_record()['counters'][
+                'coalesced'])
+            self.assertEqual(8, recorder.get_record()['stages'][
+                'select']['count'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_main_with_workers_and_cache(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            tfile = os.path.join(temp_dir, 'batch')
+            self.write_batch(tfile, 9)
+            myargs = ['prog', tfile, '--batch', '--gmtdir', LIBRARY_DIR,
+                      '--genesets', 'Fixture_Process',
+                      '--maxpval', '1.0',
+                      '--cachedir', os.path.join(temp_dir, 'cache')]
+            with patch('sys.stdout', new_callable=io.StringIO) as out:
+                self.assertEqual(0, cdenrichrgenestoterm.main(myargs))
+                expected = out.getvalue()
+            self.assertEqual(9, len(expected.strip().split('\n')))
+            for x in range(2):
+                with patch('sys.stdout', new_callable=io.StringIO) as out:
+                    self.assertEqual(0, cdenrichrgenestoterm.main(
+                        myargs + ['--workers', '2']))
+                    self.assertEqual(expected, out.getvalue())
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,15 +9,20 @@ Tests for `cdenrichrgenestoterm` module.
 """
 
 import os
+import io
 import sys
+import json
 import unittest
 import tempfile
 import shutil
-from unittest.mock import MagicMock, call
+from unittest.mock import MagicMock, call, patch, ANY
 import pandas as pd
 
 
 from cdenrichrgenestoterm import cdenrichrgenestoterm
+from cdenrichrgenestoterm.localenrichr import LocalEnrichr
+from cdenrichrgenestoterm.enrichrclient import PooledEnrichr
+from cdenrichrgenestoterm.resultcache import ResultCache
 
 
 class TestCdenrichrgenestoterm(unittest.TestCase):
@@ -28,6 +33,44 @@ class TestCdenrichrgenestoterm(unittest.TestCase):
     def tearDown(self):
         pass
 
+    def get_enrichr_mock(self, d_frames=None):
+        """
+        Gets mock enrichr that writes `d_frames` as report files
+        into the output directory it is passed and records that
+        directory in `outdirs` attribute
+        """
+        enrichr = MagicMock()
+        enrichr.outdirs = []
+
+        def write_reports(**kwargs):
+            enrichr.outdirs.append(kwargs['outdir'])
+            for idx, df in enumerate(d_frames or []):
+                txt_file = os.path.join(kwargs['outdir'],
+                                        kwargs['gene_sets'] + str(idx) +
+                                        '.txt')
+                df.to_csv(txt_file, index=False, sep='\t',
+                          encoding='utf-8')
+            return enrichr
+
+        enrichr.enrichr = MagicMock(side_effect=write_reports)
+        return enrichr
+
+    def assert_called_per_library(self, enrichr, outdir=ANY):
+        """
+        Asserts `enrichr` was called once for each default library
+        """
+        calls = [call(gene_list=['A', 'B', 'C'], cutoff=0.05,
+                      gene_sets=gs, no_plot=True, outdir=outdir)
+                 for gs in self.get_default_genesets().split(',')]
+        enrichr.enrichr.assert_has_calls(calls, any_order=True)
+        self.assertEqual(len(calls), enrichr.enrichr.call_count)
+
+    def assert_outdirs_removed(self, enrichr, temp_dir):
+        self.assertTrue(len(enrichr.outdirs) > 0)
+        for outdir in enrichr.outdirs:
+            self.assertEqual(temp_dir, os.path.dirname(outdir))
+            self.assertFalse(os.path.exists(outdir))
+
     def get_default_genesets(self):
         return 'GO_Biological_Process_2018,' \
                'GO_Cellular_Component_2018,' \
@@ -55,6 +98,23 @@ class TestCdenrichrgenestoterm(unittest.TestCase):
                          'GO_Cellular_Component_2018,' +
                          'GO_Molecular_Function_2018',
                          res.genesets)
+        self.assertEqual(None, res.gmtdir)
+        self.assertFalse(res.batch)
+        self.assertEqual(1, res.topk)
+        self.assertEqual(None, res.cachedir)
+        self.assertEqual(100000, res.cachemaxentries)
+        self.assertEqual(604800, res.cachettl)
+        self.assertFalse(res.nocache)
+        self.assertFalse(res.clearcache)
+        self.assertEqual(4, res.concurrency)
+        self.assertEqual(2, res.retries)
+        self.assertEqual(1.0, res.retrybackoff)
+        self.assertEqual(30.0, res.retrymaxbackoff)
+        self.assertEqual(120.0, res.timeout)
+        self.assertEqual(300.0, res.deadline)
+        self.assertFalse(res.allterms)
+        self.assertEqual(0, res.offset)
+        self.assertEqual(None, res.limit)
 
     def test_run_gprofiler_no_file(self):
         temp_dir = tempfile.mkdtemp()
@@ -89,8 +149,7 @@ class TestCdenrichrgenestoterm(unittest.TestCase):
     def test_run_with_empty_result(self):
         temp_dir = tempfile.mkdtemp()
         try:
-            enrichr = MagicMock()
-            enrichr.enrichr = MagicMock(return_value=enrichr)
+            enrichr = self.get_enrichr_mock()
             tfile = os.path.join(temp_dir, 'foo')
             with open(tfile, 'w') as f:
                 f.write('a,b,c')
@@ -100,13 +159,10 @@ class TestCdenrichrgenestoterm(unittest.TestCase):
             res = cdenrichrgenestoterm.run_enrichr(tfile,
                                                    theargs,
                                                    enrichr=enrichr)
-            gs = self.get_default_genesets()
             self.assertEqual(None, res)
-            enrichr.enrichr.assert_called_once_with(gene_list=['A', 'B', 'C'],
-                                                    cutoff=0.05,
-                                                    gene_sets=gs,
-                                                    no_plot=True,
-                                                    outdir=temp_dir)
+            self.assert_called_per_library(enrichr,
+                                           outdir=enrichr.outdirs[0])
+            self.assert_outdirs_removed(enrichr, temp_dir)
         finally:
             shutil.rmtree(temp_dir)
 
@@ -119,29 +175,32 @@ class TestCdenrichrgenestoterm(unittest.TestCase):
             tfile = os.path.join(temp_dir, 'foo')
             with open(tfile, 'w') as f:
                 f.write('a,b,c')
-            myargs = [tfile, '--tmpdir', temp_dir]
+            myargs = [tfile, '--tmpdir', temp_dir, '--retrybackoff', '0']
             theargs = cdenrichrgenestoterm._parse_arguments('desc',
                                                             myargs)
             res = cdenrichrgenestoterm.run_enrichr(tfile,
                                                    theargs,
                                                    enrichr=enrichr)
-            gs = self.get_default_genesets()
             self.assertEqual(None, res)
-            the_call = call(gene_list=['A', 'B', 'C'],
-                            cutoff=0.05,
-                            gene_sets=gs,
-                            no_plot=True,
-                            outdir=temp_dir)
-
-            enrichr.enrichr.assert_has_calls([the_call, the_call])
+            # each library is tried twice
+            calls = []
+            for gs in self.get_default_genesets().split(','):
+                the_call = call(gene_list=['A', 'B', 'C'],
+                                cutoff=0.05,
+                                gene_sets=gs,
+                                no_plot=True,
+                                outdir=ANY)
+                calls.extend([the_call, the_call])
+            enrichr.enrichr.assert_has_calls(calls, any_order=True)
+            self.assertEqual(6, enrichr.enrichr.call_count)
+            self.assertEqual(['foo'], os.listdir(temp_dir))
         finally:
             shutil.rmtree(temp_dir)
 
     def test_run_with_valid_no_result_from_query(self):
         temp_dir = tempfile.mkdtemp()
         try:
-            enrichr = MagicMock()
-            enrichr.enrichr = MagicMock(return_value=enrichr)
+            enrichr = self.get_enrichr_mock()
             tfile = os.path.join(temp_dir, 'foo')
             with open(tfile, 'w') as f:
                 f.write('a,b,c')
@@ -151,21 +210,16 @@ class TestCdenrichrgenestoterm(unittest.TestCase):
             res = cdenrichrgenestoterm.run_enrichr(tfile,
                                                    theargs,
                                                    enrichr=enrichr)
-            gs = self.get_default_genesets()
             self.assertEqual(None, res)
-            enrichr.enrichr.assert_called_once_with(gene_list=['A', 'B', 'C'],
-                                                    cutoff=0.05,
-                                                    gene_sets=gs,
-                                                    no_plot=True,
-                                                    outdir=temp_dir)
+            self.assert_called_per_library(enrichr,
+                                           outdir=enrichr.outdirs[0])
+            self.assert_outdirs_removed(enrichr, temp_dir)
         finally:
             shutil.rmtree(temp_dir)
 
     def test_run_with_pvalue_exceeded(self):
         temp_dir = tempfile.mkdtemp()
         try:
-            enrichr = MagicMock()
-
             df = pd.DataFrame(columns=['Term',
                                        'Gene_set',
                                        'P-value',
@@ -177,10 +231,7 @@ class TestCdenrichrgenestoterm(unittest.TestCase):
                                     ['term2', 'set2', 1.6,
                                      0.7, 'A;C', '7/9']])
 
-            txt_file = os.path.join(temp_dir, 'data.txt')
-            df.to_csv(txt_file, index=False, sep='\t', encoding='utf-8')
-
-            enrichr.enrichr = MagicMock(return_value=enrichr)
+            enrichr = self.get_enrichr_mock([df])
             tfile = os.path.join(temp_dir, 'foo')
             with open(tfile, 'w') as f:
                 f.write('a,b,c')
@@ -190,20 +241,16 @@ class TestCdenrichrgenestoterm(unittest.TestCase):
             res = cdenrichrgenestoterm.run_enrichr(tfile,
                                                    theargs,
                                                    enrichr=enrichr)
-            gs = self.get_default_genesets()
             self.assertEqual(None, res)
-            enrichr.enrichr.assert_called_once_with(gene_list=['A', 'B', 'C'],
-                                                    cutoff=0.05,
-                                                    gene_sets=gs,
-                                                    no_plot=True,
-                                                    outdir=temp_dir)
+            self.assert_called_per_library(enrichr,
+                                           outdir=enrichr.outdirs[0])
+            self.assert_outdirs_removed(enrichr, temp_dir)
         finally:
             shutil.rmtree(temp_dir)
 
     def test_run_with_valid_result(self):
         temp_dir = tempfile.mkdtemp()
         try:
-            enrichr = MagicMock()
             df = pd.DataFrame(columns=['Term',
                                        'Gene_set',
                                        'P-value',
@@ -214,9 +261,7 @@ class TestCdenrichrgenestoterm(unittest.TestCase):
                                      'B;C', '2/25'],
                                     ['term2', 'set2', 0.5,
                                      0.03, 'A;C', '7/9']])
-            enrichr.enrichr = MagicMock(return_value=enrichr)
-            txt_file = os.path.join(temp_dir, 'data.txt')
-            df.to_csv(txt_file, index=False, sep='\t', encoding='utf-8')
+            enrichr = self.get_enrichr_mock([df])
             tfile = os.path.join(temp_dir, 'foo')
             with open(tfile, 'w') as f:
                 f.write('a,b,c')
@@ -226,25 +271,21 @@ class TestCdenrichrgenestoterm(unittest.TestCase):
             res = cdenrichrgenestoterm.run_enrichr(tfile,
                                                    theargs,
                                                    enrichr=enrichr)
-            gs = self.get_default_genesets()
             self.assertEqual('term2', res['name'])
             self.assertEqual('set2', res['source'])
             self.assertEqual(0.03, res['p_value'])
             self.assertEqual('', res['description'])
             self.assertEqual(['A', 'C'], res['intersections'])
             self.assertEqual(9, res['term_size'])
-            enrichr.enrichr.assert_called_once_with(gene_list=['A', 'B', 'C'],
-                                                    cutoff=0.05,
-                                                    gene_sets=gs,
-                                                    no_plot=True,
-                                                    outdir=temp_dir)
+            self.assert_called_per_library(enrichr,
+                                           outdir=enrichr.outdirs[0])
+            self.assert_outdirs_removed(enrichr, temp_dir)
         finally:
             shutil.rmtree(temp_dir)
 
     def test_run_with_valid_result_from_multiple_genesets(self):
         temp_dir = tempfile.mkdtemp()
         try:
-            enrichr = MagicMock()
             df = pd.DataFrame(columns=['Term',
                                        'Gene_set',
                                        'P-value',
@@ -256,27 +297,37 @@ class TestCdenrichrgenestoterm(unittest.TestCase):
                                     ['term2', 'set2', 0.5,
                                      0.03, 'A;C', '7/9']])
 
-            txt_file = os.path.join(temp_dir, 'data.txt')
-            df.to_csv(txt_file, index=False, sep='\t', encoding='utf-8')
+            df_two = pd.DataFrame(columns=['Term',
+                                           'Gene_set',
+                                           'P-value',
+                                           'Adjusted P-value',
+                                           'Genes', 'Overlap'],
+                                  data=[['term5', 'set1', 0.6,
+                                         0.01,
+                                         'B;C', '2/25'],
+                                        ['term6', 'set2', 0.5,
+                                         0.03, 'X;Y', '7/8']])
 
-            df = pd.DataFrame(columns=['Term',
-                                       'Gene_set',
-                                       'P-value',
-                                       'Adjusted P-value',
-                                       'Genes', 'Overlap'],
-                              data=[['term5', 'set1', 0.6,
-                                     0.01,
-                                     'B;C', '2/25'],
-                                    ['term6', 'set2', 0.5,
-                                     0.03, 'X;Y', '7/8']])
-
-            txt_file = os.path.join(temp_dir, 'data2.txt')
-            df.to_csv(txt_file, index=False, sep='\t', encoding='utf-8')
+            enrichr = self.get_enrichr_mock([df, df_two])
 
             # make a directory with .txt ending just for fun
-            os.makedirs(os.path.join(temp_dir, 'haha.txt'), mode=0o755)
+            orig_side_effect = enrichr.enrichr.side_effect
 
-            enrichr.enrichr = MagicMock(return_value=enrichr)
+            def add_txt_dir(**kwargs):
+                os.makedirs(os.path.join(kwargs['outdir'], 'haha.txt'),
+                            mode=0o755, exist_ok=True)
+                return orig_side_effect(**kwargs)
+
+            enrichr.enrichr.side_effect = add_txt_dir
+
+            # stale report in shared tmpdir should be ignored
+            stale_df = pd.DataFrame(columns=['Term', 'Gene_set',
+                                             'P-value', 'Adjusted P-value',
+                                             'Genes', 'Overlap'],
+                                    data=[['stale', 'set1', 0.001, 0.001,
+                                           'B;C', '2/25']])
+            stale_df.to_csv(os.path.join(temp_dir, 'stale.txt'),
+                            index=False, sep='\t', encoding='utf-8')
             tfile = os.path.join(temp_dir, 'foo')
             with open(tfile, 'w') as f:
                 f.write('a,b,c')
@@ -286,18 +337,667 @@ class TestCdenrichrgenestoterm(unittest.TestCase):
             res = cdenrichrgenestoterm.run_enrichr(tfile,
                                                    theargs,
                                                    enrichr=enrichr)
-            gs = self.get_default_genesets()
             self.assertEqual('term5', res['name'])
             self.assertEqual('set1', res['source'])
             self.assertEqual(0.01, res['p_value'])
             self.assertEqual('', res['description'])
             self.assertEqual(['B', 'C'], res['intersections'])
             self.assertEqual(25, res['term_size'])
-            enrichr.enrichr.assert_called_once_with(gene_list=['A', 'B', 'C'],
+            self.assert_called_per_library(enrichr,
+                                           outdir=enrichr.outdirs[0])
+            self.assert_outdirs_removed(enrichr, temp_dir)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_get_retry_policy(self):
+        theargs = cdenrichrgenestoterm._parse_arguments('desc', ['foo'])
+        theargs.retrybackoff = 0
+        theargs.timeout = 0
+        policy = cdenrichrgenestoterm.get_retry_policy(theargs,
+                                                       retry_count=3)
+        enrichr = MagicMock(side_effect=[OSError('busy'), OSError('busy'),
+                                         'ok'])
+        self.assertEqual('ok', policy.call(enrichr, gene_list=['A']))
+        self.assertEqual(3, enrichr.call_count)
+
+    def test_run_with_nonretryable_error(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            enrichr = MagicMock()
+            enrichr.results_in_memory = True
+            enrichr.enrichr = MagicMock(side_effect=LookupError('no lib'))
+            myargs = ['foo', '--tmpdir', temp_dir, '--genesets', 'lib1']
+            theargs = cdenrichrgenestoterm._parse_arguments('desc',
+                                                            myargs)
+            res = cdenrichrgenestoterm.query_enrichr(['A'], theargs,
+                                                     enrichr, retry_count=5)
+            self.assertEqual(None, res)
+            self.assertEqual(1, enrichr.enrichr.call_count)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_get_libraries(self):
+        self.assertEqual(['a', 'b', 'c'],
+                         cdenrichrgenestoterm.get_libraries(' a,b ,,c'))
+        self.assertEqual([], cdenrichrgenestoterm.get_libraries(''))
+
+    def test_run_with_concurrency(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            enrichr = MagicMock()
+            enrichr.results_in_memory = True
+
+            def get_result(**kwargs):
+                res = MagicMock()
+                lib = kwargs['gene_sets']
+                if lib == 'lib2':
+                    pval = 0.01
+                else:
+                    pval = 0.04
+                res.results = pd.DataFrame(columns=['Term', 'Gene_set',
+                                                    'P-value',
+                                                    'Adjusted P-value',
+                                                    'Genes', 'Overlap'],
+                                           data=[[lib + 'term', lib, pval,
+                                                  pval, 'A', '1/5']])
+                return res
+
+            enrichr.enrichr = MagicMock(side_effect=get_result)
+            myargs = ['foo', '--tmpdir', temp_dir,
+                      '--genesets', 'lib1,lib2,lib3', '--concurrency', '2',
+                      '--topk', '3']
+            theargs = cdenrichrgenestoterm._parse_arguments('desc',
+                                                            myargs)
+            res = cdenrichrgenestoterm.query_enrichr(['A'], theargs,
+                                                     enrichr)
+            self.assertEqual(3, res.shape[0])
+            self.assertEqual(['lib1', 'lib2', 'lib3'],
+                             sorted(res['Gene_set']))
+            self.assertEqual(['lib1', 'lib2', 'lib3'],
+                             sorted([x[1]['gene_sets'] for x in
+                                     enrichr.enrichr.call_args_list]))
+            res = cdenrichrgenestoterm.get_best_term(res, ['A'], theargs)
+            self.assertEqual('lib2term', res[0]['name'])
+
+            # only rows that could be picked are kept
+            theargs.topk = 1
+            res = cdenrichrgenestoterm.query_enrichr(['A'], theargs,
+                                                     enrichr)
+            self.assertEqual(['lib2term'], list(res['Term']))
+
+            # concurrency of 1 passes all libraries in one query
+            enrichr.enrichr.reset_mock()
+            theargs.concurrency = 1
+            res = cdenrichrgenestoterm.query_enrichr(['A'], theargs,
+                                                     enrichr)
+            self.assertEqual(1, res.shape[0])
+            enrichr.enrichr.assert_called_once_with(gene_list=['A'],
+                                                    gene_sets='lib1,lib2,'
+                                                              'lib3',
                                                     cutoff=0.05,
-                                                    gene_sets=gs,
                                                     no_plot=True,
-                                                    outdir=temp_dir)
+                                                    outdir=None)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_load_data_frame_from_outputfiles(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            columns = ['Gene_set', 'Term', 'Overlap', 'P-value',
+                       'Adjusted P-value', 'Old P-value', 'Odds Ratio',
+                       'Combined Score', 'Genes']
+            df = pd.DataFrame(columns=columns,
+                              data=[['set1', 'term' + str(x), '1/5',
+                                     0.5 / (x + 1), 0.9 / (x + 1), 0,
+                                     1.5, 2.5, 'A'] for x in range(10)])
+            df.to_csv(os.path.join(temp_dir, 'a.txt'), index=False,
+                      sep='\t')
+            df_two = pd.DataFrame(columns=columns,
+                                  data=[['set2', '123', '2/9', 0.01, 0.01,
+                                         0, 1.5, 2.5, 'A;B'],
+                                        ['set2', 'x', '2/9', 0.02, 0.5, 0,
+                                         1.5, 2.5, 'A;B']])
+            df_two.to_csv(os.path.join(temp_dir, 'b.txt'), index=False,
+                          sep='\t')
+            res = cdenrichrgenestoterm.load_data_frame_from_outputfiles(
+                temp_dir)
+            self.assertEqual(12, res.shape[0])
+            self.assertEqual(sorted(['Gene_set', 'Term', 'Overlap',
+                                     'P-value', 'Adjusted P-value',
+                                     'Genes']), sorted(res.columns))
+
+            res = cdenrichrgenestoterm.load_data_frame_from_outputfiles(
+                temp_dir, keep=3, chunksize=2)
+            self.assertEqual(3, res.shape[0])
+            self.assertEqual(['123', 'term9', 'term8'],
+                             list(res.sort_values('Adjusted P-value')[
+                                 'Term']))
+            # term names are not converted to numbers
+            self.assertTrue(all(isinstance(x, str) for x in res['Term']))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_get_best_term_topk(self):
+        df = pd.DataFrame(columns=['Term', 'Gene_set', 'P-value',
+                                   'Adjusted P-value', 'Genes', 'Overlap'],
+                          data=[['term1', 'set1', 0.01, 0.04, 'A', '1/5'],
+                                ['term2', 'set1', 0.02, 0.03, 'A;B', '2/9'],
+                                ['term3', 'set2', 0.01, 0.03, 'B', '1/3'],
+                                ['term4', 'set2', 0.01, 0.5, 'C', '1/3']])
+        theargs = cdenrichrgenestoterm._parse_arguments('desc', ['foo'])
+        genes = ['A', 'B', 'C', 'D']
+        res = cdenrichrgenestoterm.get_best_term(df, genes, theargs)
+        self.assertEqual('term3', res['name'])
+        self.assertEqual(3, res['term_size'])
+        self.assertEqual(0.25, res['jaccard'])
+
+        theargs.topk = 2
+        res = cdenrichrgenestoterm.get_best_term(df, genes, theargs)
+        self.assertEqual(['term3', 'term2'], [x['name'] for x in res])
+        self.assertEqual(['A', 'B'], res[1]['intersections'])
+        self.assertEqual(0.5, res[1]['jaccard'])
+
+        theargs.topk = 10
+        res = cdenrichrgenestoterm.get_best_term(df, genes, theargs)
+        self.assertEqual(['term3', 'term2', 'term1'],
+                         [x['name'] for x in res])
+        self.assertEqual(4, df.shape[0])
+
+    def test_get_num_rows_to_keep(self):
+        theargs = cdenrichrgenestoterm._parse_arguments('desc', ['foo'])
+        self.assertEqual(1, cdenrichrgenestoterm.get_num_rows_to_keep(
+            theargs))
+        theargs.topk = 5
+        self.assertEqual(5, cdenrichrgenestoterm.get_num_rows_to_keep(
+            theargs))
+        theargs.allterms = True
+        self.assertEqual(None, cdenrichrgenestoterm.get_num_rows_to_keep(
+            theargs))
+        theargs.offset = 10
+        theargs.limit = 20
+        self.assertEqual(30, cdenrichrgenestoterm.get_num_rows_to_keep(
+            theargs))
+
+    def test_get_ranked_terms(self):
+        df = pd.DataFrame(columns=['Term', 'Gene_set', 'P-value',
+                                   'Adjusted P-value', 'Genes', 'Overlap'],
+                          data=[['term1', 'set1', 0.01, 0.04, 'A', '1/5'],
+                                ['term2', 'set1', 0.02, 0.03, 'A;B', '2/9'],
+                                ['term3', 'set2', 0.01, 0.03, 'B', '1/3'],
+                                ['term4', 'set2', 0.01, 0.5, 'C', '1/3'],
+                                ['term5', 'set2', 0.001, 0.001, 'D', '1/2']])
+        theargs = cdenrichrgenestoterm._parse_arguments('desc',
+                                                        ['foo',
+                                                         '--allterms'])
+        genes = ['A', 'B', 'C', 'D']
+        res = cdenrichrgenestoterm.get_ranked_terms(df, genes, theargs)
+        self.assertFalse(isinstance(res, list))
+        res = list(res)
+        self.assertEqual(['term5', 'term3', 'term2', 'term1'],
+                         [x['name'] for x in res])
+        self.assertEqual(0.25, res[0]['jaccard'])
+        self.assertEqual(2, res[0]['term_size'])
+
+        theargs.offset = 1
+        theargs.limit = 2
+        res = cdenrichrgenestoterm.get_ranked_terms(df, genes, theargs)
+        self.assertEqual(['term3', 'term2'], [x['name'] for x in res])
+
+        theargs.offset = 10
+        res = cdenrichrgenestoterm.get_ranked_terms(df, genes, theargs)
+        self.assertEqual([], list(res))
+
+        theargs.maxpval = 0.0001
+        self.assertEqual(None, cdenrichrgenestoterm.get_ranked_terms(
+            df, genes, theargs))
+        self.assertEqual(None, cdenrichrgenestoterm.get_ranked_terms(
+            pd.DataFrame(), genes, theargs))
+
+    def test_write_result(self):
+        out = io.StringIO()
+        cdenrichrgenestoterm.write_result(None, out)
+        self.assertEqual('null', out.getvalue())
+        out = io.StringIO()
+        cdenrichrgenestoterm.write_result({'name': 'x'}, out)
+        self.assertEqual({'name': 'x'}, json.loads(out.getvalue()))
+        out = io.StringIO()
+        cdenrichrgenestoterm.write_result(iter([{'a': 1}, {'b': 2}]), out)
+        self.assertEqual([{'a': 1}, {'b': 2}], json.loads(out.getvalue()))
+        out = io.StringIO()
+        cdenrichrgenestoterm.write_result(iter([]), out)
+        self.assertEqual([], json.loads(out.getvalue()))
+
+    def test_main_allterms(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            gmtdir = os.path.join(temp_dir, 'gmt')
+            os.makedirs(gmtdir)
+            with open(os.path.join(gmtdir, 'lib1.gmt'), 'w') as f:
+                f.write('term1\t\tA\tB\tC\n')
+                f.write('term2\t\tA\tB\tE\tF\tG\tH\n')
+                f.write('term3\t\tA\tJ\tK\tL\tM\tN\n')
+            tfile = os.path.join(temp_dir, 'foo')
+            with open(tfile, 'w') as f:
+                f.write('a,b,c')
+            myargs = ['prog', tfile, '--gmtdir', gmtdir, '--genesets',
+                      'lib1', '--maxpval', '1.0', '--allterms']
+            with patch('sys.stdout', new_callable=io.StringIO) as out:
+                self.assertEqual(0, cdenrichrgenestoterm.main(myargs))
+                res = json.loads(out.getvalue())
+            self.assertEqual(['term1', 'term2', 'term3'],
+                             [x['name'] for x in res])
+            self.assertEqual(['A', 'B'], res[1]['intersections'])
+
+            with patch('sys.stdout', new_callable=io.StringIO) as out:
+                self.assertEqual(0, cdenrichrgenestoterm.main(
+                    myargs + ['--offset', '1', '--limit', '1']))
+                res = json.loads(out.getvalue())
+            self.assertEqual(['term2'], [x['name'] for x in res])
+
+            # batch with cache
+            with open(tfile, 'w') as f:
+                f.write('{"id": "c1", "genes": "a,b,c"}\n')
+                f.write('{"id": "c2", "genes": "x"}\n')
+            for x in range(2):
+                with patch('sys.stdout', new_callable=io.StringIO) as out:
+                    self.assertEqual(0, cdenrichrgenestoterm.main(
+                        myargs + ['--batch', '--cachedir',
+                                  os.path.join(temp_dir, 'cache')]))
+                    res = [json.loads(x) for x in
+                           out.getvalue().strip().split('\n')]
+                self.assertEqual('c1', res[0]['id'])
+                self.assertEqual(['term1', 'term2', 'term3'],
+                                 [x['name'] for x in res[0]['result']])
+                self.assertEqual({'id': 'c2', 'result': None}, res[1])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_get_enrichr(self):
+        theargs = cdenrichrgenestoterm._parse_arguments('desc', ['foo'])
+        res = cdenrichrgenestoterm.get_enrichr(theargs)
+        self.assertTrue(isinstance(res, PooledEnrichr))
+        theargs.gseapy = True
+        res = cdenrichrgenestoterm.get_enrichr(theargs)
+        self.assertTrue(isinstance(res, cdenrichrgenestoterm.GseapyEnrichr))
+        theargs.gmtdir = '/somedir'
+        res = cdenrichrgenestoterm.get_enrichr(theargs)
+        self.assertTrue(isinstance(res, LocalEnrichr))
+
+    def test_run_with_gmtdir(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            gmtdir = os.path.join(temp_dir, 'gmt')
+            os.makedirs(gmtdir)
+            with open(os.path.join(gmtdir, 'lib1.gmt'), 'w') as f:
+                f.write('term1\t\tA\tB\tC\n')
+                f.write('term2\t\tD\tE\tF\tG\tH\n')
+                f.write('term3\t\tI\tJ\tK\tL\tM\tN\n')
+            tfile = os.path.join(temp_dir, 'foo')
+            with open(tfile, 'w') as f:
+                f.write('a,b,c')
+            myargs = [tfile, '--tmpdir', temp_dir, '--gmtdir', gmtdir,
+                      '--genesets', 'lib1']
+            theargs = cdenrichrgenestoterm._parse_arguments('desc',
+                                                            myargs)
+            res = cdenrichrgenestoterm.run_enrichr(tfile, theargs)
+            self.assertEqual('term1', res['name'])
+            self.assertEqual('lib1', res['source'])
+            self.assertEqual(3, res['term_size'])
+            self.assertEqual(['A', 'B', 'C'], res['intersections'])
+            self.assertEqual(1.0, res['jaccard'])
+            self.assertTrue(res['p_value'] < 0.05)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_parse_genes(self):
+        self.assertEqual(['A', 'B', 'C'],
+                         cdenrichrgenestoterm.parse_genes(',a,b,c\n'))
+        self.assertEqual([''], cdenrichrgenestoterm.parse_genes(''))
+
+    def test_normalize_genes(self):
+        with patch('sys.stderr', new_callable=io.StringIO) as err:
+            res = cdenrichrgenestoterm.normalize_genes([' a', 'B ', '', 'a',
+                                                        'c', ' '])
+            self.assertEqual((['A', 'B', 'C'], ['A'], []), res)
+            self.assertTrue('Dropped 1 unknown or duplicate genes: A' in
+                            err.getvalue())
+            self.assertEqual(([], [], []),
+                             cdenrichrgenestoterm.normalize_genes(['']))
+
+        alias_index = MagicMock()
+        alias_index.resolve = MagicMock(side_effect=lambda x:
+                                        [{'OLD': 'NEW'}.get(g, g)
+                                         if g != 'BAD' else None
+                                         for g in x])
+        with patch('sys.stderr', new_callable=io.StringIO) as err:
+            res = cdenrichrgenestoterm.normalize_genes(
+                ['old', 'bad', 'new', 'x'], alias_index=alias_index)
+            self.assertEqual((['NEW', 'X'], ['BAD', 'NEW'],
+                              [('OLD', 'NEW')]), res)
+            self.assertTrue('Mapped 1 genes to approved symbols: '
+                            'OLD -> NEW' in err.getvalue())
+
+    def test_run_enrichr_on_genes_normalizes(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            gmtdir = os.path.join(temp_dir, 'gmt')
+            os.makedirs(gmtdir)
+            with open(os.path.join(gmtdir, 'lib1.gmt'), 'w') as f:
+                f.write('term1\t\tA\tB\tC\n')
+                f.write('term2\t\tD\tE\tF\tG\tH\n')
+            theargs = cdenrichrgenestoterm._parse_arguments(
+                'desc', ['foo', '--gmtdir', gmtdir, '--genesets', 'lib1',
+                         '--maxpval', '1.0'])
+            with patch('sys.stderr', new_callable=io.StringIO):
+                res = cdenrichrgenestoterm.run_enrichr_on_genes(
+                    [' A', 'B', 'A', 'B', ''], theargs)
+                self.assertEqual(1.0, res['jaccard'])
+                enrichr = MagicMock()
+                self.assertEqual(None, cdenrichrgenestoterm.
+                                 run_enrichr_on_genes([' ', ''], theargs,
+                                                      enrichr=enrichr))
+                enrichr.enrichr.assert_not_called()
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_read_batch_inputfile(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            tfile = os.path.join(temp_dir, 'foo')
+            with open(tfile, 'w') as f:
+                f.write('a,b,c\n')
+                f.write('\n')
+                f.write('{"id": "comm1", "genes": ["x", "Y"]}\n')
+                f.write('{"id": 5, "genes": "d,e"}\n')
+                f.write('{"genes": "f"}\n')
+                f.write('{"id": "bad", genes: ["x"]}\n')
+                f.write('{"id": "nogenes"}\n')
+                f.write('{"id": "nulls", "genes": [null]}\n')
+                f.write('g\n')
+            with patch('sys.stderr', new_callable=io.StringIO) as err:
+                res = list(cdenrichrgenestoterm.read_batch_inputfile(
+                    tfile))
+                for line_num in [6, 7, 8]:
+                    self.assertTrue('line ' + str(line_num) + ':' in
+                                    err.getvalue())
+            self.assertEqual([(1, ['A', 'B', 'C']),
+                              ('comm1', ['X', 'Y']),
+                              (5, ['D', 'E']),
+                              (5, ['F']),
+                              (6, None),
+                              ('nogenes', None),
+                              ('nulls', None),
+                              (9, ['G'])], res)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_run_enrichr_batch(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            gmtdir = os.path.join(temp_dir, 'gmt')
+            os.makedirs(gmtdir)
+            with open(os.path.join(gmtdir, 'lib1.gmt'), 'w') as f:
+                f.write('term1\t\tA\tB\tC\n')
+                f.write('term2\t\tD\tE\tF\tG\tH\n')
+                f.write('term3\t\tI\tJ\tK\tL\tM\tN\n')
+            tfile = os.path.join(temp_dir, 'foo')
+            with open(tfile, 'w') as f:
+                f.write('{"id": "c1", "genes": ["a", "b", "c"]}\n')
+                f.write('{"id": "c2", "genes": ["z"]}\n')
+                f.write('{"id": "c3", "genes": ["a", "b"\n')
+                f.write('d,e,f,g\n')
+            myargs = [tfile, '--tmpdir', temp_dir, '--gmtdir', gmtdir,
+                      '--genesets', 'lib1', '--batch']
+            theargs = cdenrichrgenestoterm._parse_arguments('desc',
+                                                            myargs)
+            for workers in [1, 2]:
+                theargs.workers = workers
+                out = io.StringIO()
+                with patch('sys.stderr', new_callable=io.StringIO) as err:
+                    res = cdenrichrgenestoterm.run_enrichr_batch(
+                        tfile, theargs, out=out)
+                    self.assertTrue('line 3:' in err.getvalue())
+                self.assertEqual(4, res)
+                records = [json.loads(x) for x in
+                           out.getvalue().strip().split('\n')]
+                self.assertEqual(['c1', 'c2', 3, 4],
+                                 [x['id'] for x in records])
+                self.assertEqual('term1', records[0]['result']['name'])
+                self.assertEqual(None, records[1]['result'])
+                self.assertEqual(None, records[2]['result'])
+                self.assertEqual('term2', records[3]['result']['name'])
+                self.assertEqual(['D', 'E', 'F', 'G'],
+                                 records[3]['result']['intersections'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_run_enrichr_batch_with_exception(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            enrichr = MagicMock()
+            enrichr.enrichr = MagicMock()
+            enrichr.enrichr.side_effect = Exception('Some exception')
+            tfile = os.path.join(temp_dir, 'foo')
+            with open(tfile, 'w') as f:
+                f.write('a,b,c\n')
+            myargs = [tfile, '--tmpdir', temp_dir, '--batch']
+            theargs = cdenrichrgenestoterm._parse_arguments('desc',
+                                                            myargs)
+            out = io.StringIO()
+            res = cdenrichrgenestoterm.run_enrichr_batch(tfile, theargs,
+                                                         out=out,
+                                                         enrichr=enrichr,
+                                                         retry_count=1)
+            self.assertEqual(1, res)
+            self.assertEqual({'id': 1, 'result': None},
+                             json.loads(out.getvalue()))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_run_enrichr_batch_creates_engine_on_cache_miss(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            gmtdir = os.path.join(temp_dir, 'gmt')
+            os.makedirs(gmtdir)
+            with open(os.path.join(gmtdir, 'lib1.gmt'), 'w') as f:
+                f.write('term1\t\tA\tB\tC\n')
+                f.write('term2\t\tD\tE\tF\tG\tH\n')
+            tfile = os.path.join(temp_dir, 'foo')
+            with open(tfile, 'w') as f:
+                f.write('a,b,c\nd,e,f,g\n')
+            myargs = [tfile, '--tmpdir', temp_dir, '--gmtdir', gmtdir,
+                      '--genesets', 'lib1', '--batch',
+                      '--cachedir', os.path.join(temp_dir, 'cache')]
+            theargs = cdenrichrgenestoterm._parse_arguments('desc',
+                                                            myargs)
+            get_enrichr = cdenrichrgenestoterm.get_enrichr
+            with patch('cdenrichrgenestoterm.cdenrichrgenestoterm.'
+                       'get_enrichr', wraps=get_enrichr) as mock_get:
+                first = io.StringIO()
+                cdenrichrgenestoterm.run_enrichr_batch(tfile, theargs,
+                                                       out=first)
+                self.assertEqual(1, mock_get.call_count)
+
+                # every gene list is in cache so no engine is made
+                second = io.StringIO()
+                cdenrichrgenestoterm.run_enrichr_batch(tfile, theargs,
+                                                       out=second)
+                self.assertEqual(1, mock_get.call_count)
+                self.assertEqual(first.getvalue(), second.getvalue())
+
+                with open(tfile, 'a') as f:
+                    f.write('a,b\nd,e\n')
+                cdenrichrgenestoterm.run_enrichr_batch(tfile, theargs,
+                                                       out=io.StringIO())
+                self.assertEqual(2, mock_get.call_count)
+
+            theargs.incremental = os.path.join(temp_dir, 'state')
+            theargs.gmtdir = None
+            with self.assertRaises(ValueError):
+                cdenrichrgenestoterm.run_enrichr_batch(tfile, theargs,
+                                                       out=io.StringIO())
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_main_serve_invalid_socket(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            sock = os.path.join(temp_dir, 'nodir', 'sock')
+            myargs = ['prog', cdenrichrgenestoterm.SERVE_COMMAND,
+                      '--unixsocket', sock]
+            res = cdenrichrgenestoterm.main(myargs)
+            self.assertEqual(2, res)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_run_with_results_in_memory(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            enrichr = MagicMock()
+            enrichr.results_in_memory = True
+            enrichr.results = pd.DataFrame(columns=['Term',
+                                                    'Gene_set',
+                                                    'P-value',
+                                                    'Adjusted P-value',
+                                                    'Genes', 'Overlap'],
+                                           data=[['term1', 'set1', 0.6,
+                                                  0.05,
+                                                  'B;C', '2/25'],
+                                                 ['term2', 'set2', 0.5,
+                                                  0.03, 'A;C', '7/9']])
+            enrichr.enrichr = MagicMock(return_value=enrichr)
+            # should be ignored
+            df = pd.DataFrame(columns=['Term', 'Gene_set', 'P-value',
+                                       'Adjusted P-value', 'Genes',
+                                       'Overlap'],
+                              data=[['term5', 'set1', 0.001, 0.001,
+                                     'B;C', '2/25']])
+            df.to_csv(os.path.join(temp_dir, 'data.txt'), index=False,
+                      sep='\t', encoding='utf-8')
+            tfile = os.path.join(temp_dir, 'foo')
+            with open(tfile, 'w') as f:
+                f.write('a,b,c')
+            myargs = [tfile, '--tmpdir', temp_dir]
+            theargs = cdenrichrgenestoterm._parse_arguments('desc',
+                                                            myargs)
+            res = cdenrichrgenestoterm.run_enrichr(tfile,
+                                                   theargs,
+                                                   enrichr=enrichr)
+            self.assertEqual('term2', res['name'])
+            self.assertEqual(9, res['term_size'])
+            self.assert_called_per_library(enrichr, outdir=None)
+            # results that are not a data frame mean no results
+            enrichr.results = None
+            res = cdenrichrgenestoterm.run_enrichr(tfile,
+                                                   theargs,
+                                                   enrichr=enrichr)
+            self.assertEqual(None, res)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_gseapy_enrichr(self):
+        mock_gseapy = MagicMock()
+        mock_gseapy.enrichr = MagicMock(return_value='hi')
+        with patch.dict(sys.modules, {'gseapy': mock_gseapy}):
+            engine = cdenrichrgenestoterm.GseapyEnrichr()
+            self.assertTrue(engine.results_in_memory)
+            self.assertEqual('hi', engine.enrichr(gene_list=['A'],
+                                                  outdir=None))
+        mock_gseapy.enrichr.assert_called_once_with(gene_list=['A'],
+                                                    outdir=None)
+
+    def test_get_result_cache(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            cachedir = os.path.join(temp_dir, 'cache')
+            theargs = cdenrichrgenestoterm._parse_arguments('desc', ['foo'])
+            self.assertEqual(None,
+                             cdenrichrgenestoterm.get_result_cache(theargs))
+            theargs.cachedir = cachedir
+            cache = cdenrichrgenestoterm.get_result_cache(theargs)
+            self.assertTrue(isinstance(cache, ResultCache))
+            cache.store('abcd', {'name': 'x'})
+            theargs.nocache = True
+            self.assertEqual(None,
+                             cdenrichrgenestoterm.get_result_cache(theargs))
+            self.assertEqual((True, {'name': 'x'}), cache.lookup('abcd'))
+            theargs.nocache = False
+            theargs.clearcache = True
+            cdenrichrgenestoterm.get_result_cache(theargs)
+            self.assertEqual((False, None), cache.lookup('abcd'))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_get_cache_key(self):
+        theargs = cdenrichrgenestoterm._parse_arguments('desc', ['foo'])
+        key = cdenrichrgenestoterm.get_cache_key(['A', 'B'], theargs)
+        self.assertEqual(key, cdenrichrgenestoterm.get_cache_key(['b', 'a'],
+                                                                 theargs))
+        theargs.maxpval = 0.01
+        self.assertNotEqual(key,
+                            cdenrichrgenestoterm.get_cache_key(['A', 'B'],
+                                                               theargs))
+
+        # results of different engines are not shared
+        keys = set()
+        for args in [[], ['--gseapy'], ['--url', 'http://localhost:1'],
+                     ['--gmtdir', '/foo']]:
+            theargs = cdenrichrgenestoterm._parse_arguments('desc',
+                                                            ['foo'] + args)
+            keys.add(cdenrichrgenestoterm.get_cache_key(['A'], theargs))
+        self.assertEqual(4, len(keys))
+
+    def test_run_with_cache(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            df = pd.DataFrame(columns=['Term',
+                                       'Gene_set',
+                                       'P-value',
+                                       'Adjusted P-value',
+                                       'Genes', 'Overlap'],
+                              data=[['term1', 'set1', 0.6,
+                                     0.05,
+                                     'B;C', '2/25']])
+            enrichr = self.get_enrichr_mock([df])
+            orig_side_effect = enrichr.enrichr.side_effect
+            tfile = os.path.join(temp_dir, 'foo')
+            with open(tfile, 'w') as f:
+                f.write('a,b,c')
+            myargs = [tfile, '--tmpdir', temp_dir, '--retrybackoff', '0',
+                      '--cachedir', os.path.join(temp_dir, 'cache')]
+            theargs = cdenrichrgenestoterm._parse_arguments('desc',
+                                                            myargs)
+            res = cdenrichrgenestoterm.run_enrichr(tfile, theargs,
+                                                   enrichr=enrichr)
+            self.assertEqual('term1', res['name'])
+            self.assertEqual(3, enrichr.enrichr.call_count)
+
+            # cache hit so enrichr is not called again
+            with open(tfile, 'w') as f:
+                f.write('C,B,a')
+            res = cdenrichrgenestoterm.run_enrichr(tfile, theargs,
+                                                   enrichr=enrichr)
+            self.assertEqual('term1', res['name'])
+            self.assertEqual(3, enrichr.enrichr.call_count)
+
+            # failures are not cached
+            enrichr.enrichr.side_effect = Exception('Some exception')
+            theargs.maxpval = 0.01
+            res = cdenrichrgenestoterm.run_enrichr(tfile, theargs,
+                                                   enrichr=enrichr)
+            self.assertEqual(None, res)
+            self.assertEqual(9, enrichr.enrichr.call_count)
+            enrichr.enrichr.side_effect = orig_side_effect
+            res = cdenrichrgenestoterm.run_enrichr(tfile, theargs,
+                                                   enrichr=enrichr)
+            self.assertEqual(None, res)
+            self.assertEqual(12, enrichr.enrichr.call_count)
+
+            # no term found is cached
+            res = cdenrichrgenestoterm.run_enrichr(tfile, theargs,
+                                                   enrichr=enrichr)
+            self.assertEqual(None, res)
+            self.assertEqual(12, enrichr.enrichr.call_count)
         finally:
             shutil.rmtree(temp_dir)
 
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_compiledlibrary
+----------------------------------
+
+Tests for `compiledlibrary` module.
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from cdenrichrgenestoterm import compiledlibrary
+from cdenrichrgenestoterm import cdenrichrgenestoterm
+from cdenrichrgenestoterm.localenrichr import TermLibrary
+from cdenrichrgenestoterm.localenrichr import LocalEnrichr
+
+
+class TestCompiledLibrary(unittest.TestCase):
+
+    def write_gmt(self, gmtdir, name='lib1'):
+        gmtfile = os.path.join(gmtdir, name + '.gmt')
+        with open(gmtfile, 'w') as f:
+            f.write('term1\t\tA\tB\tC\n')
+            f.write('term2\tdesc\tC\tD\tE\tF\tG\tH\n')
+            f.write('térm3\t\tI\tJ\tK\tLONGGENENAME\tM\tN\n')
+        return gmtfile
+
+    def test_string_tables(self):
+        table = compiledlibrary.StringTable(numpy.array([0, 1, 1, 4]),
+                                            numpy.frombuffer(b'abcd',
+                                                             dtype=numpy.uint8))
+        self.assertEqual(3, len(table))
+        self.assertEqual(['a', '', 'bcd'], list(table))
+        self.assertEqual('bcd', table[-1])
+
+        table = compiledlibrary.FixedWidthStringTable(
+            numpy.array([b'A', b'BB', b'D'], dtype='S2'))
+        self.assertEqual('BB', table[1])
+        self.assertEqual([0, 2], list(table.get_ids(['D', 'A', 'A',
+                                                     'C', 'Z', 'BBB'])))
+        self.assertEqual([], list(table.get_ids([])))
+
+    def test_write_and_load(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            gmtfile = self.write_gmt(temp_dir)
+            library = TermLibrary.from_gmt_file('lib1', gmtfile)
+            path = os.path.join(temp_dir, 'lib1.tlib')
+            compiledlibrary.write_compiled_library(library, path)
+            self.assertEqual(['lib1.gmt', 'lib1.tlib'],
+                             sorted(os.listdir(temp_dir)))
+            loaded = compiledlibrary.load_compiled_library(path)
+            self.assertTrue(isinstance(loaded,
+                                       compiledlibrary.CompiledTermLibrary))
+            self.assertEqual('lib1', loaded.name)
+            self.assertEqual(list(library.genes), list(loaded.genes))
+            self.assertEqual(list(library.terms), list(loaded.terms))
+            self.assertEqual(list(library.term_sizes),
+                             list(loaded.term_sizes))
+            query = ['A', 'C', 'D', 'LONGGENENAME', 'ZZZ']
+            self.assertEqual(list(library.get_gene_ids(query)),
+                             list(loaded.get_gene_ids(query)))
+            expected = library.enrich(query)
+            res = loaded.enrich(query)
+            self.assertEqual(expected.to_dict('records'),
+                             res.to_dict('records'))
+            self.assertEqual('térm3', res['Term'][2])
+            self.assertEqual('K;LONGGENENAME', loaded.enrich(
+                ['K', 'LONGGENENAME'])['Genes'][0])
+            # checksum is read from the header, not computed on load
+            self.assertEqual(library.get_checksum(), loaded._checksum)
+            loaded._checksum = None
+            self.assertEqual(library.get_checksum(), loaded.get_checksum())
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_load_invalid_file(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'lib1.tlib')
+            with open(path, 'w') as f:
+                f.write('term1\t\tA\tB\tC\n')
+            try:
+                compiledlibrary.load_compiled_library(path)
+                self.fail('Expected ValueError')
+            except ValueError as ve:
+                self.assertTrue('not a compiled' in str(ve))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_empty_library(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'empty.tlib')
+            compiledlibrary.write_compiled_library(
+                TermLibrary.from_terms('empty', {}), path)
+            loaded = compiledlibrary.load_compiled_library(path)
+            self.assertEqual(0, len(loaded.terms))
+            self.assertEqual(0, loaded.enrich(['A']).shape[0])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_local_enrichr_uses_compiled(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            gmtfile = self.write_gmt(temp_dir)
+            path = compiledlibrary.compile_library(temp_dir, 'lib1')
+            engine = LocalEnrichr(temp_dir)
+            self.assertTrue(isinstance(engine.get_library('lib1'),
+                                       compiledlibrary.CompiledTermLibrary))
+
+            # gmt file newer then compiled file is used instead
+            newer = os.path.getmtime(path) + 10
+            os.utime(gmtfile, (newer, newer))
+            engine = LocalEnrichr(temp_dir)
+            self.assertFalse(isinstance(engine.get_library('lib1'),
+                                        compiledlibrary.CompiledTermLibrary))
+
+            # compiled file alone is enough
+            os.unlink(gmtfile)
+            engine = LocalEnrichr(temp_dir)
+            res = engine.enrichr(gene_list=['A', 'B', 'C'], gene_sets='lib1')
+            self.assertEqual('term1', res.results['Term'][0])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_main_compile(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            gmtdir = os.path.join(temp_dir, 'gmt')
+            outdir = os.path.join(temp_dir, 'out')
+            os.makedirs(gmtdir)
+            os.makedirs(outdir)
+            self.write_gmt(gmtdir, name='lib1')
+            self.write_gmt(gmtdir, name='lib2')
+            res = cdenrichrgenestoterm.main(['prog',
+                                             cdenrichrgenestoterm.
+                                             COMPILE_COMMAND,
+                                             '--gmtdir', gmtdir,
+                                             '--genesets', 'lib1,lib2',
+                                             '--outdir', outdir])
+            self.assertEqual(0, res)
+            self.assertEqual(['lib1.tlib', 'lib2.tlib'],
+                             sorted(os.listdir(outdir)))
+
+            # missing library
+            res = cdenrichrgenestoterm.main(['prog',
+                                             cdenrichrgenestoterm.
+                                             COMPILE_COMMAND,
+                                             '--gmtdir', gmtdir,
+                                             '--genesets', 'nope'])
+            self.assertEqual(2, res)
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    sys.exit(unittest.main())
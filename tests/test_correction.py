@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_correction
+----------------------------------
+
+Tests for `correction` module.
+"""
+
+import os
+import io
+import json
+import random
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import numpy
+
+from cdenrichrgenestoterm import correction
+from cdenrichrgenestoterm import cdenrichrgenestoterm
+from cdenrichrgenestoterm.localenrichr import LocalEnrichr
+
+LIBRARY_DIR = os.path.join(os.path.dirname(__file__), 'data', 'libraries')
+
+LIBRARIES = 'Fixture_Process,Fixture_Component'
+
+
+class TestCorrection(unittest.TestCase):
+
+    def test_benjamini_hochberg(self):
+        self.assertEqual(0, len(correction.benjamini_hochberg([])))
+        res = correction.benjamini_hochberg([0.01, 0.04, 0.03, 0.5])
+        self.assertEqual([0.04, 0.053333, 0.053333, 0.5],
+                         [round(x, 6) for x in res])
+
+        # matches textbook definition, min over ranks at or above
+        rand = random.Random(3)
+        pvals = [rand.random() ** 3 for x in range(500)]
+        ranked = sorted(pvals)
+        expected = {}
+        for idx, pval in enumerate(ranked):
+            expected[pval] = min(1.0, min(ranked[x] * len(ranked) / (x + 1)
+                                          for x in range(idx,
+                                                         len(ranked))))
+        res = correction.benjamini_hochberg(pvals)
+        for pval, adjusted in zip(pvals, res):
+            self.assertAlmostEqual(expected[pval], adjusted, places=12)
+
+    def test_bonferroni(self):
+        self.assertEqual(0, len(correction.bonferroni([])))
+        res = correction.bonferroni([0.01, 0.2, 0.001])
+        self.assertEqual([0.03, 0.6, 0.003], [round(x, 6) for x in res])
+        self.assertEqual([1.0, 1.0], list(correction.bonferroni([0.6,
+                                                                 0.9])))
+
+    def test_adjust_pvalues(self):
+        pvals = numpy.array([0.01, 0.04, 0.03])
+        self.assertEqual(list(correction.bonferroni(pvals)),
+                         list(correction.adjust_pvalues(pvals,
+                                                        'bonferroni')))
+        self.assertEqual(list(correction.benjamini_hochberg(pvals)),
+                         list(correction.adjust_pvalues(pvals, 'bh')))
+        with self.assertRaises(ValueError):
+            correction.adjust_pvalues(pvals, 'library')
+
+    def test_query_enrichr_corrects_over_all_libraries(self):
+        theargs = cdenrichrgenestoterm._parse_arguments(
+            'desc', ['foo', '--genesets', LIBRARIES, '--maxpval', '1.0'])
+        engine = LocalEnrichr(LIBRARY_DIR)
+        genes = ['CDK1', 'CCNB1', 'CDC20', 'CASP3']
+        theargs.allterms = True
+        by_library = cdenrichrgenestoterm.query_enrichr(genes, theargs,
+                                                        engine)
+        self.assertEqual(2, len(set(by_library['Gene_set'])))
+        for method in ['bh', 'bonferroni']:
+            theargs.correction = method
+            theargs.allterms = True
+            res = cdenrichrgenestoterm.query_enrichr(genes, theargs,
+                                                     engine)
+            expected = correction.adjust_pvalues(
+                by_library['P-value'].to_numpy(), method)
+            expected = dict(zip(zip(by_library['Gene_set'],
+                                    by_library['Term']), expected))
+            self.assertEqual(len(expected), res.shape[0])
+            for row in res.to_dict('records'):
+                self.assertEqual(expected[(row['Gene_set'], row['Term'])],
+                                 row['Adjusted P-value'])
+
+            # only best row is kept but it was corrected over all rows
+            theargs.allterms = False
+            best = cdenrichrgenestoterm.query_enrichr(genes, theargs,
+                                                      engine)
+            self.assertEqual(1, best.shape[0])
+            self.assertEqual(min(expected.values()),
+                             best['Adjusted P-value'][0])
+
+    def test_main_correction(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            tfile = os.path.join(temp_dir, 'input')
+            with open(tfile, 'w') as f:
+                f.write('CDK1,CCNB1,CDC20,CASP3,CASP8')
+            myargs = ['prog', tfile, '--gmtdir', LIBRARY_DIR,
+                      '--genesets', LIBRARIES, '--maxpval', '1.0',
+                      '--allterms']
+            res = {}
+            for method in ['library', 'bh', 'bonferroni']:
+                with patch('sys.stdout', new_callable=io.StringIO) as out:
+                    self.assertEqual(0, cdenrichrgenestoterm.main(
+                        myargs + ['--correction', method]))
+                    res[method] = json.loads(out.getvalue())
+            num_terms = len(res['library'])
+            for term in res['bonferroni']:
+                raw = [x for x in res['library']
+                       if x['name'] == term['name']][0]
+                self.assertTrue(term['p_value'] >= raw['p_value'])
+            self.assertEqual(num_terms, len(res['bh']))
+            self.assertTrue(all(x['p_value'] <= y['p_value']
+                                for x, y in zip(res['bh'],
+                                                res['bh'][1:])))
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_enrichrclient
+----------------------------------
+
+Tests for `enrichrclient` module.
+"""
+
+import os
+import io
+import time
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import urllib.parse
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from unittest.mock import patch
+
+from cdenrichrgenestoterm import enrichrclient
+from cdenrichrgenestoterm import cdenrichrgenestoterm
+from cdenrichrgenestoterm.enrichrclient import TokenBucket
+from cdenrichrgenestoterm.enrichrclient import EnrichrClient
+from cdenrichrgenestoterm.enrichrclient import PooledEnrichr
+
+TERMS = {'lib1': [('term1', ['A', 'B', 'C']),
+                  ('term2', ['D', 'E', 'F', 'G'])],
+         'lib2': [('other', ['X', 'Y', 'Z'])]}
+
+
+class QuotaEnrichrHandler(BaseHTTPRequestHandler):
+    """
+    Stub of the Enrichr API that keeps connections alive, answers
+    after ``server.latency`` seconds and with HTTP 429 once more than
+    ``server.quota`` requests arrive within ``server.window`` seconds,
+    or for the next ``server.num_429`` requests. The next
+    ``server.num_html`` posts to ``/addList`` get an HTML page with
+    HTTP 200. Gene lists posted to
+    ``/addList`` are kept in ``server.lists`` and ``/export`` answers
+    with a report of the terms in :py:const:`TERMS` that overlap
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super(QuotaEnrichrHandler, self).setup()
+        with self.server.lock:
+            self.server.num_connections += 1
+
+    def _over_quota(self):
+        with self.server.lock:
+            now = time.monotonic()
+            self.server.num_requests += 1
+            self.server.times = [x for x in self.server.times
+                                 if now - x < self.server.window]
+            self.server.times.append(now)
+            if self.server.num_429 > 0:
+                self.server.num_429 -= 1
+                over = True
+            else:
+                over = self.server.quota is not None and \
+                    len(self.server.times) > self.server.quota
+            if over:
+                self.server.num_rejected += 1
+            return over
+
+    def _send(self, status, body, headers=None):
+        time.sleep(self.server.latency)
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self._over_quota():
+            self._send(429, b'{}', {'Retry-After': self.server.retry_after})
+            return
+        with self.server.lock:
+            html = self.server.num_html > 0
+            self.server.num_html -= 1
+        if html:
+            self._send(200, b'<html><body>Bad Gateway</body></html>')
+            return
+        text = body.decode('utf-8')
+        genes = text.split('name="list"\r\n\r\n')[1].split('\r\n')[0]
+        with self.server.lock:
+            self.server.lists.append(genes.split('\n'))
+            list_id = len(self.server.lists)
+        self._send(200, json.dumps({'userListId': list_id,
+                                    'shortId': 'x'}).encode('utf-8'))
+
+    def do_GET(self):
+        if self._over_quota():
+            self._send(429, b'{}', {'Retry-After': self.server.retry_after})
+            return
+        query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+        genes = set(self.server.lists[int(query['userListId'][0]) - 1])
+        lines = ['Term\tOverlap\tP-value\tAdjusted P-value\t'
+                 'Old P-value\tOld Adjusted P-value\tOdds Ratio\t'
+                 'Combined Score\tGenes']
+        for name, term_genes in TERMS[query['backgroundType'][0]]:
+            hits = sorted(genes.intersection(term_genes))
+            if len(hits) == 0:
+                continue
+            pval = 0.1 / len(hits)
+            lines.append('\t'.join([name, str(len(hits)) + '/' +
+                                    str(len(term_genes)), str(pval),
+                                    str(pval), '0', '0', '1', '1',
+                                    ';'.join(hits)]))
+        self._send(200, ('\n'.join(lines) + '\n').encode('utf-8'))
+
+
+class TestEnrichrClient(unittest.TestCase):
+
+    def setUp(self):
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                           QuotaEnrichrHandler)
+        self._server.daemon_threads = True
+        self._server.lock = threading.Lock()
+        self._server.lists = []
+        self._server.times = []
+        self._server.quota = None
+        self._server.window = 1.0
+        self._server.num_429 = 0
+        self._server.num_html = 0
+        self._server.retry_after = '0'
+        self._server.latency = 0.0
+        self._server.num_requests = 0
+        self._server.num_rejected = 0
+        self._server.num_connections = 0
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        self._url = 'http://127.0.0.1:' + \
+                    str(self._server.server_address[1])
+
+    def tearDown(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def get_args(self, *args):
+        return cdenrichrgenestoterm._parse_arguments(
+            'desc', ['foo', '--url', self._url, '--genesets', 'lib1,lib2',
+                     '--maxpval', '1.0', '--retrybackoff', '0'] +
+            list(args))
+
+    def test_token_bucket(self):
+        now = [0.0]
+        sleeps = []
+        bucket = TokenBucket(2, burst=2, clock=lambda: now[0],
+                             sleep=sleeps.append)
+        self.assertEqual([0.0, 0.0, 0.5, 1.0],
+                         [bucket.reserve() for x in range(4)])
+        now[0] = 2.0
+        self.assertEqual(0.0, bucket.acquire())
+        self.assertEqual(0.0, bucket.acquire())
+        self.assertEqual(0.5, bucket.acquire())
+        self.assertEqual([0.5], sleeps)
+
+        # no limit unless paused
+        bucket = TokenBucket(0, clock=lambda: now[0])
+        self.assertEqual([0.0] * 3, [bucket.reserve() for x in range(3)])
+        bucket.defer(3.0)
+        bucket.defer(1.0)
+        self.assertEqual(3.0, bucket.reserve())
+        now[0] = 6.0
+        self.assertEqual(0.0, bucket.reserve())
+
+    def test_invalid_url(self):
+        with self.assertRaises(ValueError):
+            EnrichrClient(url='ftp://foo')
+
+    def test_pooled_engine_reuses_connections(self):
+        client = EnrichrClient(url=self._url, pool_size=2)
+        engine = PooledEnrichr(client)
+        theargs = self.get_args('--concurrency', '4')
+        for genes, name in [(['A', 'B', 'X'], 'term1'),
+                            (['X', 'Y', 'Q'], 'other'),
+                            (['A', 'B', 'X'], 'term1')]:
+            res = cdenrichrgenestoterm.run_enrichr_on_genes(
+                genes, theargs, enrichr=engine)
+            self.assertEqual(name, res['name'])
+        client.close()
+        # each list is uploaded once however many libraries and
+        # queries it is enriched in
+        self.assertEqual([['A', 'B', 'X'], ['X', 'Y', 'Q']],
+                         self._server.lists)
+        self.assertEqual(8, self._server.num_requests)
+        self.assertTrue(self._server.num_connections <= 2)
+
+        res = engine.enrichr(gene_list=['A', 'X', 'Y'],
+                             gene_sets='lib1, lib2', cutoff=0.05,
+                             no_plot=True, outdir=None)
+        self.assertEqual(['term1', 'other'], list(res.results['Term']))
+        self.assertEqual(['lib1', 'lib2'], list(res.results['Gene_set']))
+
+    def test_rate_limit_stays_under_quota(self):
+        self._server.quota = 6
+        self._server.window = 0.5
+        client = EnrichrClient(url=self._url, pool_size=4,
+                               rate_limiter=TokenBucket(10))
+        start = time.monotonic()
+        threads = [threading.Thread(target=client.add_list,
+                                    args=(['A', str(x)],))
+                   for x in range(12)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(0, self._server.num_rejected)
+        self.assertEqual(12, len(self._server.lists))
+        self.assertTrue(time.monotonic() - start >= 1.0)
+
+        # without a limit the quota is exceeded
+        client = EnrichrClient(url=self._url, pool_size=4)
+        with self.assertRaises(Exception) as context:
+            for x in range(12):
+                client.add_list(['B', str(x)])
+        self.assertEqual(429, context.exception.response.status_code)
+
+    def test_retry_after_pauses_every_request(self):
+        self._server.num_429 = 1
+        self._server.retry_after = '0.5'
+        theargs = self.get_args()
+        client = EnrichrClient(url=self._url)
+        start = time.monotonic()
+        with patch('sys.stderr', new_callable=io.StringIO) as err:
+            res = cdenrichrgenestoterm.run_enrichr_on_genes(
+                ['A', 'B'], theargs, enrichr=PooledEnrichr(client))
+            self.assertTrue('429' in err.getvalue())
+        self.assertEqual('term1', res['name'])
+        self.assertTrue(time.monotonic() - start >= 0.5)
+        self.assertEqual(1, self._server.num_rejected)
+
+    def test_html_response_retried(self):
+        self._server.num_html = 1
+        client = EnrichrClient(url=self._url)
+        with self.assertRaises(enrichrclient.EnrichrResponseError) as ctx:
+            client.add_list(['A', 'B'])
+        self.assertTrue('status 200' in str(ctx.exception))
+        self.assertTrue('Bad Gateway' in str(ctx.exception))
+
+        self._server.num_html = 1
+        theargs = self.get_args()
+        with patch('sys.stderr', new_callable=io.StringIO) as err:
+            res = cdenrichrgenestoterm.run_enrichr_on_genes(
+                ['A', 'B'], theargs, enrichr=PooledEnrichr(client))
+            self.assertTrue('No list id' in err.getvalue())
+        self.assertEqual('term1', res['name'])
+        client.close()
+
+    def test_timeout_applied_to_each_request(self):
+        self._server.latency = 1.0
+        theargs = self.get_args('--timeout', '0.2', '--retries', '1')
+        client = EnrichrClient(url=self._url)
+        start = time.monotonic()
+        with patch('sys.stderr', new_callable=io.StringIO):
+            res = cdenrichrgenestoterm.run_enrichr_on_genes(
+                ['A', 'B'], theargs, enrichr=PooledEnrichr(client))
+        self.assertEqual(None, res)
+        self.assertTrue(time.monotonic() - start < 0.9)
+        client.close()
+
+    def test_get_client(self):
+        theargs = self.get_args('--ratelimit', '5', '--poolsize', '3')
+        client = enrichrclient.get_client(theargs)
+        self.assertTrue(client is enrichrclient.get_client(theargs))
+        self.assertTrue(client is not enrichrclient.get_client(
+            self.get_args('--ratelimit', '6')))
+        engine = cdenrichrgenestoterm.get_enrichr(theargs)
+        self.assertTrue(isinstance(engine, PooledEnrichr))
+
+    def test_main_with_url(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            tfile = os.path.join(temp_dir, 'input')
+            with open(tfile, 'w') as f:
+                f.write('a,b,x,y')
+            myargs = ['prog', tfile, '--url', self._url,
+                      '--genesets', 'lib1,lib2', '--maxpval', '1.0',
+                      '--topk', '2', '--ratelimit', '100']
+            with patch('sys.stdout', new_callable=io.StringIO) as out:
+                self.assertEqual(0, cdenrichrgenestoterm.main(myargs))
+                res = json.loads(out.getvalue())
+            self.assertEqual(['term1', 'other'], [x['name'] for x in res])
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
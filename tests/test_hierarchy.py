@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_hierarchy
+----------------------------------
+
+Tests for `hierarchy` module.
+"""
+
+import os
+import io
+import json
+import random
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from unittest.mock import MagicMock
+
+from cdenrichrgenestoterm import hierarchy
+from cdenrichrgenestoterm import cdenrichrgenestoterm
+from cdenrichrgenestoterm.localenrichr import LocalEnrichr
+from cdenrichrgenestoterm.localenrichr import TermLibrary
+
+LIBRARY_DIR = os.path.join(os.path.dirname(__file__), 'data', 'libraries')
+
+LIBRARIES = ['Fixture_Process', 'Fixture_Component']
+
+COMMUNITIES = [('root', ['HSPA1A', 'HSPA1B', 'DNAJB1', 'HSF1', 'CDK1',
+                         'CCNB1', 'CDC20', 'PLK1', 'CASP3', 'CASP8',
+                         'NOTAGENE']),
+               ('c1', ['HSPA1A', 'HSPA1B', 'DNAJB1', 'HSF1']),
+               ('c2', ['CDK1', 'CCNB1', 'CDC20', 'PLK1', 'CASP3']),
+               ('c3', ['CDK1', 'CCNB1', 'CDC20']),
+               ('c4', ['CASP3', 'CASP8'])]
+
+CHILDREN = {'root': ['c1', 'c2', 'c4'], 'c2': ['c3']}
+
+
+class TestHierarchy(unittest.TestCase):
+
+    def test_read_hierarchy_file(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            tfile = os.path.join(temp_dir, 'h.json')
+            with open(tfile, 'w') as f:
+                json.dump({'communities': [{'id': 1, 'genes': 'a,b'},
+                                           {'id': 2, 'genes': ['b']},
+                                           {'id': 3, 'genes': ['a']}],
+                           'edges': [[1, 2], {'parent': 1, 'child': 3}]},
+                          f)
+            communities, children = hierarchy.read_hierarchy_file(tfile)
+            self.assertEqual([(1, ['A', 'B']), (2, ['B']), (3, ['A'])],
+                             communities)
+            self.assertEqual({1: [2, 3]}, children)
+
+            with open(tfile, 'w') as f:
+                json.dump([], f)
+            with self.assertRaises(ValueError):
+                hierarchy.read_hierarchy_file(tfile)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_get_enrichment_order(self):
+        self.assertEqual(['c1', 'c3', 'c2', 'c4', 'root'],
+                         hierarchy.get_enrichment_order(
+                             [x[0] for x in COMMUNITIES], CHILDREN))
+        # shared child comes before both parents and only once
+        self.assertEqual(['c', 'a', 'b'],
+                         hierarchy.get_enrichment_order(
+                             ['a', 'b', 'c'], {'a': ['c'], 'b': ['c']}))
+        self.assertEqual([], hierarchy.get_enrichment_order([], {}))
+
+        with self.assertRaises(ValueError) as ve:
+            hierarchy.get_enrichment_order(['a', 'b'], {'a': ['b'],
+                                                        'b': ['a']})
+        self.assertTrue('cycle' in str(ve.exception))
+        with self.assertRaises(ValueError):
+            hierarchy.get_enrichment_order(['a'], {'a': ['x']})
+
+    def test_enrich_matches_per_community(self):
+        engine = LocalEnrichr(LIBRARY_DIR)
+        enricher = hierarchy.HierarchyEnricher(engine, LIBRARIES)
+        res = list(enricher.enrich(COMMUNITIES, CHILDREN))
+        self.assertEqual(['c1', 'c3', 'c2', 'c4', 'root'],
+                         [x[0] for x in res])
+        # root reuses c1 or c2 per library, c2 reuses c3
+        self.assertEqual(4, enricher.num_reused)
+        for c_id, genes, df_result in res:
+            expected = engine.enrichr(gene_list=genes,
+                                      gene_sets=','.join(LIBRARIES)).results
+            self.assertEqual(dict(COMMUNITIES)[c_id], genes)
+            self.assertEqual(expected.to_dict('records'),
+                             df_result.to_dict('records'))
+
+    def test_parent_only_scores_added_genes(self):
+        rand = random.Random(3)
+        genes = ['G' + str(x) for x in range(500)]
+        terms = {'t' + str(x): rand.sample(genes, rand.randint(5, 80))
+                 for x in range(300)}
+        library = TermLibrary.from_terms('lib', terms)
+        child = rand.sample(genes, 200)
+        parent = child + [x for x in genes if x not in child][:3]
+        calls = {'overlaps': [], 'hits': []}
+        get_overlaps = library.get_overlaps
+        get_hit_genes = library.get_hit_genes
+
+        def counting_overlaps(gene_ids):
+            calls['overlaps'].append(len(gene_ids))
+            return get_overlaps(gene_ids)
+
+        def counting_hits(gene_ids, term_ids):
+            calls['hits'].append(len(term_ids))
+            return get_hit_genes(gene_ids, term_ids)
+
+        library.get_overlaps = counting_overlaps
+        library.get_hit_genes = counting_hits
+        engine = MagicMock()
+        engine.get_library.return_value = library
+        enricher = hierarchy.HierarchyEnricher(engine, ['lib'])
+        res = list(enricher.enrich([('p', parent), ('c', child)],
+                                   {'p': ['c']}))
+        self.assertEqual(1, enricher.num_reused)
+        # overlaps over the whole library are only counted for the
+        # child and hit genes are only found again for the terms
+        # holding one of the 3 added genes
+        self.assertEqual([200], calls['overlaps'])
+        self.assertEqual(res[0][2].shape[0], calls['hits'][0])
+        self.assertTrue(0 < calls['hits'][1] < res[1][2].shape[0] / 2)
+        self.assertEqual(library.enrich(parent).to_dict('records'),
+                         res[1][2].to_dict('records'))
+
+    def test_enrich_child_not_subset(self):
+        engine = LocalEnrichr(LIBRARY_DIR)
+        enricher = hierarchy.HierarchyEnricher(engine, ['Fixture_Process'])
+        communities = [('p', ['CDK1', 'CCNB1']),
+                       ('c', ['CDK1', 'CCNB1', 'CDC20'])]
+        res = list(enricher.enrich(communities, {'p': ['c']}))
+        self.assertEqual(0, enricher.num_reused)
+        expected = engine.enrichr(gene_list=['CDK1', 'CCNB1'],
+                                  gene_sets='Fixture_Process').results
+        self.assertEqual(expected.to_dict('records'),
+                         res[1][2].to_dict('records'))
+
+    def test_main_hierarchy(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            tfile = os.path.join(temp_dir, 'h.json')
+            with open(tfile, 'w') as f:
+                json.dump({'communities': [{'id': x[0], 'genes': x[1]}
+                                           for x in COMMUNITIES] +
+                           [{'id': 'empty', 'genes': ''}],
+                           'edges': [[p, c] for p in CHILDREN
+                                     for c in CHILDREN[p]]}, f)
+            myargs = ['prog', tfile, '--gmtdir', LIBRARY_DIR,
+                      '--genesets', ','.join(LIBRARIES),
+                      '--maxpval', '1.0', '--hierarchy']
+            with patch('sys.stdout', new_callable=io.StringIO) as out:
+                self.assertEqual(0, cdenrichrgenestoterm.main(myargs))
+                res = [json.loads(x) for x in
+                       out.getvalue().strip().split('\n')]
+            self.assertEqual(['c1', 'c3', 'c2', 'c4', 'root', 'empty'],
+                             [x['id'] for x in res])
+            self.assertEqual(None, res[-1]['result'])
+
+            # same as enriching each community on its own
+            for record in res[:-1]:
+                gfile = os.path.join(temp_dir, 'genes')
+                with open(gfile, 'w') as f:
+                    f.write(','.join(dict(COMMUNITIES)[record['id']]))
+                with patch('sys.stdout', new_callable=io.StringIO) as out:
+                    self.assertEqual(0, cdenrichrgenestoterm.main(
+                        ['prog', gfile] + myargs[2:-1]))
+                    self.assertEqual(json.loads(out.getvalue()),
+                                     record['result'])
+
+            # fallback for engines without local libraries
+            theargs = cdenrichrgenestoterm._parse_arguments(
+                'desc', [tfile, '--hierarchy'])
+            out = io.StringIO()
+            with patch('cdenrichrgenestoterm.cdenrichrgenestoterm.'
+                       'run_enrichr_on_genes',
+                       return_value={'name': 'x'}) as mock_run:
+                count = cdenrichrgenestoterm.run_enrichr_hierarchy(
+                    tfile, theargs, out=out, enrichr=object())
+            self.assertEqual(6, count)
+            self.assertEqual(6, mock_run.call_count)
+            self.assertEqual({'id': 'c1', 'result': {'name': 'x'}},
+                             json.loads(out.getvalue().split('\n')[0]))
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_incremental
+----------------------------------
+
+Tests for `incremental` module.
+"""
+
+import os
+import io
+import json
+import random
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import pandas
+
+from cdenrichrgenestoterm import metrics
+from cdenrichrgenestoterm import incremental
+from cdenrichrgenestoterm import cdenrichrgenestoterm
+from cdenrichrgenestoterm.incremental import IncrementalEnricher
+from cdenrichrgenestoterm.localenrichr import LocalEnrichr
+from cdenrichrgenestoterm.localenrichr import TermLibrary
+
+LIBRARY_DIR = os.path.join(os.path.dirname(__file__), 'data', 'libraries')
+
+
+class TestIncremental(unittest.TestCase):
+
+    def get_library(self):
+        rand = random.Random(7)
+        genes = ['G' + str(x) for x in range(300)]
+        terms = {'term' + str(x): rand.sample(genes, rand.randint(3, 40))
+                 for x in range(120)}
+        return TermLibrary.from_terms('lib', terms), genes
+
+    def test_get_delta_overlaps(self):
+        library, genes = self.get_library()
+        added = library.get_gene_ids(genes[:5])
+        removed = library.get_gene_ids(genes[5:7])
+        term_ids, delta = library.get_delta_overlaps(added, removed)
+        expected = library.get_overlaps(added) - \
+            library.get_overlaps(removed)
+        self.assertEqual(expected.nonzero()[0].tolist(),
+                         term_ids[delta != 0].tolist())
+        self.assertEqual(expected[term_ids].tolist(), delta.tolist())
+
+    def test_update_state_matches_full_enrichment(self):
+        library, genes = self.get_library()
+        rand = random.Random(11)
+        query = rand.sample(genes, 40)
+        state = incremental.get_state(library, library.get_gene_ids(query))
+        pandas.testing.assert_frame_equal(library.enrich(query),
+                                          state.get_results(library))
+        for step in range(30):
+            query = list(query)
+            change = step % 3
+            if change in (0, 2):
+                query.remove(rand.choice(query))
+            if change in (1, 2):
+                query.append(rand.choice([x for x in genes
+                                          if x not in query]))
+            state, num_rescored = incremental.update_state(
+                library, state, library.get_gene_ids(query))
+            self.assertTrue(num_rescored <= len(state.term_ids))
+            if change == 2:
+                # query size is unchanged so only terms holding the
+                # swapped genes are rescored
+                self.assertTrue(num_rescored < len(state.term_ids))
+            pandas.testing.assert_frame_equal(library.enrich(query),
+                                              state.get_results(library))
+
+        same, num_rescored = incremental.update_state(
+            library, state, state.gene_ids)
+        self.assertTrue(same is state)
+        self.assertEqual(0, num_rescored)
+
+    def test_state_to_and_from_dict(self):
+        library, genes = self.get_library()
+        state = incremental.get_state(library,
+                                      library.get_gene_ids(genes[:30]))
+        data = json.loads(json.dumps(state.to_dict(library)))
+        # only ids and overlap counts are stored
+        self.assertEqual(['checksum', 'gene_ids', 'library', 'overlaps',
+                          'term_ids'], sorted(data.keys()))
+        loaded = incremental.LibraryState.from_dict(data, library)
+        self.assertEqual(None, loaded.hits)
+        pandas.testing.assert_frame_equal(state.get_results(library),
+                                          loaded.get_results(library))
+        loaded = incremental.LibraryState.from_dict(data, library)
+        query = genes[:25] + genes[40:45]
+        updated, num_rescored = incremental.update_state(
+            library, loaded, library.get_gene_ids(query))
+        self.assertEqual(len(updated.term_ids), num_rescored)
+        pandas.testing.assert_frame_equal(library.enrich(query),
+                                          updated.get_results(library))
+        other = TermLibrary.from_terms('lib', {'t': ['A', 'B']})
+        self.assertEqual(None,
+                         incremental.LibraryState.from_dict(data, other))
+
+        # a term edited without changing number of genes or terms
+        terms = {library.terms[x]: [library.genes[y] for y in
+                                    library._matrix[:, x].nonzero()[0]]
+                 for x in range(len(library.terms))}
+        terms['term0'] = terms['term0'][1:] + [
+            x for x in genes if x not in terms['term0']][:1]
+        edited = TermLibrary.from_terms('lib', terms)
+        self.assertEqual(len(library.genes), len(edited.genes))
+        self.assertNotEqual(library.get_checksum(), edited.get_checksum())
+        self.assertEqual(None,
+                         incremental.LibraryState.from_dict(data, edited))
+
+    def test_enricher_keeps_state(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            statedir = os.path.join(temp_dir, 'state')
+            local = LocalEnrichr(LIBRARY_DIR)
+            recorder = metrics.StageMetrics()
+            prev = metrics.set_metrics(recorder)
+            try:
+                enricher = IncrementalEnricher(local, statedir=statedir)
+                engine = enricher.get_engine('c1')
+                res = engine.enrichr(gene_list=['CDK1', 'CCNB1'],
+                                     gene_sets='Fixture_Process,'
+                                               'Fixture_Component')
+                self.assertEqual(0, recorder.get_record()['counters'].get(
+                    'incremental_updates', 0))
+                # a new enricher picks up the states from statedir
+                enricher = IncrementalEnricher(local, statedir=statedir)
+                genes = ['CDK1', 'CCNB1', 'CDC20', 'HSF1']
+                res = enricher.get_engine('c1').enrichr(
+                    gene_list=genes,
+                    gene_sets='Fixture_Process,Fixture_Component')
+                self.assertEqual(2, recorder.get_record()['counters'][
+                    'incremental_updates'])
+            finally:
+                metrics.set_metrics(prev)
+            expected = local.enrichr(gene_list=genes,
+                                     gene_sets='Fixture_Process,'
+                                               'Fixture_Component')
+            pandas.testing.assert_frame_equal(expected.results, res.results)
+            self.assertEqual(2, len(os.listdir(statedir)))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_get_enrichr(self):
+        theargs = cdenrichrgenestoterm._parse_arguments(
+            'desc', ['foo', '--incremental', '/somedir'])
+        with self.assertRaises(ValueError):
+            cdenrichrgenestoterm.get_enrichr(theargs)
+
+    def test_main_batch(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            tfile = os.path.join(temp_dir, 'batch')
+            myargs = ['prog', tfile, '--batch', '--gmtdir', LIBRARY_DIR,
+                      '--genesets', 'Fixture_Process,Fixture_Component',
+                      '--maxpval', '1.0', '--topk', '3']
+            statedir = os.path.join(temp_dir, 'state')
+            for gene_lists in [{'c1': ['CDK1', 'CCNB1', 'HSPA1A'],
+                                'c2': ['CASP3', 'CASP8']},
+                               {'c1': ['CDK1', 'CCNB1', 'CDC20'],
+                                'c2': ['CASP3', 'CASP8', 'HSF1']}]:
+                with open(tfile, 'w') as f:
+                    for c_id, genes in gene_lists.items():
+                        f.write(json.dumps({'id': c_id,
+                                            'genes': genes}) + '\n')
+                with patch('sys.stdout', new_callable=io.StringIO) as out:
+                    self.assertEqual(0, cdenrichrgenestoterm.main(myargs))
+                    expected = out.getvalue()
+                with patch('sys.stdout', new_callable=io.StringIO) as out:
+                    self.assertEqual(0, cdenrichrgenestoterm.main(
+                        myargs + ['--incremental', statedir]))
+                    self.assertEqual(expected, out.getvalue())
+            self.assertEqual(4, len(os.listdir(statedir)))
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_librarystore
+----------------------------------
+
+Tests for `librarystore` module.
+"""
+
+import os
+import io
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from urllib.request import pathname2url
+
+from cdenrichrgenestoterm import librarystore
+from cdenrichrgenestoterm import cdenrichrgenestoterm
+from cdenrichrgenestoterm.librarystore import LibraryStore
+from cdenrichrgenestoterm.localenrichr import LocalEnrichr
+
+
+FIXTURE_DIR = os.path.join(os.path.dirname(__file__), 'data', 'libraries')
+
+FIXTURE_URL = 'file://' + pathname2url(os.path.abspath(FIXTURE_DIR)) + \
+              '/{library}.gmt'
+
+FIXTURE_LIBRARIES = ['Fixture_Component', 'Fixture_Process']
+
+
+class TestLibraryStore(unittest.TestCase):
+
+    def test_get_sha256(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            tfile = os.path.join(temp_dir, 'foo')
+            with open(tfile, 'w') as f:
+                f.write('hi')
+            self.assertEqual('8f434346648f6b96df89dda901c5176b10a6d83961dd3c'
+                             '1ac88b59b2dc327aa4',
+                             librarystore.get_sha256(tfile))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_empty_store(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            store = LibraryStore(os.path.join(temp_dir, 'store'))
+            self.assertEqual([], store.get_versions())
+            for func in [store.get_current_version, store.get_snapshot_dir]:
+                try:
+                    func()
+                    self.fail('Expected LookupError')
+                except LookupError:
+                    pass
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_fetch_and_verify(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            storedir = os.path.join(temp_dir, 'store')
+            store = LibraryStore(storedir)
+            manifest = store.fetch(FIXTURE_LIBRARIES, version='v1',
+                                   url=FIXTURE_URL)
+            self.assertEqual('v1', manifest['version'])
+            self.assertEqual(FIXTURE_LIBRARIES,
+                             sorted(manifest['libraries'].keys()))
+            info = manifest['libraries']['Fixture_Process']
+            src = os.path.join(FIXTURE_DIR, 'Fixture_Process.gmt')
+            self.assertEqual(librarystore.get_sha256(src), info['sha256'])
+            self.assertEqual(os.path.getsize(src), info['size'])
+            self.assertEqual(librarystore.get_sha256(os.path.join(
+                storedir, 'v1', 'Fixture_Process.tlib')),
+                info['compiled_sha256'])
+            self.assertEqual('v1', store.get_current_version())
+            self.assertEqual(manifest, store.get_manifest())
+            snapshot_dir = store.get_snapshot_dir()
+            self.assertEqual(os.path.join(storedir, 'v1'), snapshot_dir)
+            self.assertEqual(['CURRENT', 'v1'], sorted(os.listdir(storedir)))
+            self.assertEqual(['Fixture_Component.gmt',
+                              'Fixture_Component.tlib',
+                              'Fixture_Process.gmt', 'Fixture_Process.tlib',
+                              'manifest.json'],
+                             sorted(os.listdir(snapshot_dir)))
+            self.assertEqual([], store.verify())
+
+            # existing version
+            try:
+                store.fetch(FIXTURE_LIBRARIES, version='v1', url=FIXTURE_URL)
+                self.fail('Expected ValueError')
+            except ValueError:
+                pass
+
+            # second snapshot not made current
+            store.fetch(['Fixture_Process'], version='v2', url=FIXTURE_URL,
+                        compile_libraries=False, make_current=False)
+            self.assertEqual(['v1', 'v2'], store.get_versions())
+            self.assertEqual('v1', store.get_current_version())
+            self.assertEqual(['Fixture_Process.gmt', 'manifest.json'],
+                             sorted(os.listdir(store.get_snapshot_dir('v2'))))
+            self.assertEqual(['Fixture_Process.gmt'],
+                             list(store.get_checksums('v2').keys()))
+            store.set_current_version('v2')
+            self.assertEqual('v2', store.get_current_version())
+
+            # tampered library
+            with open(os.path.join(snapshot_dir,
+                                   'Fixture_Component.gmt'), 'a') as f:
+                f.write('extra\t\tA\tB\n')
+            self.assertEqual(['Fixture_Component'], store.verify('v1'))
+            with open(os.path.join(snapshot_dir,
+                                   'Fixture_Process.tlib'), 'ab') as f:
+                f.write(b'x')
+            self.assertEqual(['Fixture_Component', 'Fixture_Process'],
+                             store.verify('v1'))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_fetch_missing_library(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            storedir = os.path.join(temp_dir, 'store')
+            store = LibraryStore(storedir)
+            try:
+                store.fetch(['Fixture_Process', 'Nope'], version='v1',
+                            url=FIXTURE_URL)
+                self.fail('Expected OSError')
+            except OSError:
+                pass
+            # no partial snapshot is left behind
+            self.assertEqual([], os.listdir(storedir))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_run_with_snapshot(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            storedir = os.path.join(temp_dir, 'store')
+            LibraryStore(storedir).fetch(FIXTURE_LIBRARIES, version='v1',
+                                         url=FIXTURE_URL)
+            tfile = os.path.join(temp_dir, 'foo')
+            with open(tfile, 'w') as f:
+                f.write('hspa1a,hspa1b,dnajb1')
+            myargs = [tfile, '--tmpdir', temp_dir, '--librarydir', storedir,
+                      '--genesets', ','.join(FIXTURE_LIBRARIES)]
+            theargs = cdenrichrgenestoterm._parse_arguments('desc', myargs)
+            engine = cdenrichrgenestoterm.get_enrichr(theargs)
+            self.assertTrue(isinstance(engine, LocalEnrichr))
+            res = cdenrichrgenestoterm.run_enrichr(tfile, theargs,
+                                                   enrichr=engine)
+            self.assertEqual('response to stress', res['name'])
+            self.assertEqual('Fixture_Process', res['source'])
+
+            # cache key depends on snapshot
+            key = cdenrichrgenestoterm.get_cache_key(['A'], theargs)
+            self.assertEqual('v1', librarystore.get_library_version(theargs))
+            theargs.libraryversion = 'v2'
+            self.assertNotEqual(key,
+                                cdenrichrgenestoterm.get_cache_key(['A'],
+                                                                   theargs))
+            try:
+                cdenrichrgenestoterm.get_enrichr(theargs)
+                self.fail('Expected LookupError')
+            except LookupError:
+                pass
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_checksums_checked_on_load(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            storedir = os.path.join(temp_dir, 'store')
+            store = LibraryStore(storedir)
+            store.fetch(FIXTURE_LIBRARIES, version='v1', url=FIXTURE_URL)
+            theargs = cdenrichrgenestoterm._parse_arguments(
+                'desc', ['foo', '--librarydir', storedir])
+            snapshot_dir = store.get_snapshot_dir()
+            # compiled file is what queries read so it is checked
+            with open(os.path.join(snapshot_dir,
+                                   'Fixture_Process.tlib'), 'ab') as f:
+                f.write(b'x')
+            engine = cdenrichrgenestoterm.get_enrichr(theargs)
+            engine.get_library('Fixture_Component')
+            with self.assertRaises(ValueError):
+                engine.get_library('Fixture_Process')
+
+            # compiled file with no checksum is ignored for the gmt file
+            os.unlink(os.path.join(snapshot_dir, 'Fixture_Process.tlib'))
+            from cdenrichrgenestoterm import compiledlibrary
+            compiledlibrary.compile_library(snapshot_dir, 'Fixture_Process')
+            checksums = store.get_checksums()
+            del checksums['Fixture_Component.tlib']
+            del checksums['Fixture_Process.tlib']
+            engine = LocalEnrichr(snapshot_dir, checksums=checksums)
+            lib = engine.get_library('Fixture_Component')
+            self.assertFalse(isinstance(lib,
+                                        compiledlibrary.CompiledTermLibrary))
+            with open(os.path.join(snapshot_dir,
+                                   'Fixture_Process.gmt'), 'a') as f:
+                f.write('extra\t\tA\tB\n')
+            with self.assertRaises(ValueError):
+                engine.get_library('Fixture_Process')
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_checksum_skipped_when_file_unchanged(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            storedir = os.path.join(temp_dir, 'store')
+            store = LibraryStore(storedir)
+            store.fetch(FIXTURE_LIBRARIES, version='v1', url=FIXTURE_URL)
+            info = store.get_manifest()['libraries']['Fixture_Process']
+            for key in ['size', 'mtime_ns', 'compiled_size',
+                        'compiled_mtime_ns']:
+                self.assertTrue(isinstance(info[key], int))
+            theargs = cdenrichrgenestoterm._parse_arguments(
+                'desc', ['foo', '--librarydir', storedir])
+            get_sha256 = librarystore.get_sha256
+            with patch('cdenrichrgenestoterm.librarystore.get_sha256',
+                       side_effect=get_sha256) as mock_sha:
+                engine = cdenrichrgenestoterm.get_enrichr(theargs)
+                for library in FIXTURE_LIBRARIES:
+                    engine.get_library(library)
+                self.assertEqual(0, mock_sha.call_count)
+
+                # same content with a new modification time, as after
+                # a copy, is checksummed on load until verified
+                tlib = os.path.join(store.get_snapshot_dir(),
+                                    'Fixture_Process.tlib')
+                os.utime(tlib, ns=(info['compiled_mtime_ns'] + 10 ** 9,
+                                   info['compiled_mtime_ns'] + 10 ** 9))
+                engine = cdenrichrgenestoterm.get_enrichr(theargs)
+                engine.get_library('Fixture_Process')
+                self.assertEqual([tlib], [x[0][0] for x in
+                                          mock_sha.call_args_list])
+                self.assertEqual([], store.verify())
+                mock_sha.reset_mock()
+                engine = cdenrichrgenestoterm.get_enrichr(theargs)
+                engine.get_library('Fixture_Process')
+                self.assertEqual(0, mock_sha.call_count)
+
+                # a changed file of the same size is caught since
+                # writing it changes its modification time
+                with open(tlib, 'r+b') as f:
+                    f.seek(-1, os.SEEK_END)
+                    last = f.read(1)
+                    f.seek(-1, os.SEEK_END)
+                    f.write(bytes([last[0] ^ 1]))
+                os.utime(tlib, ns=(info['compiled_mtime_ns'] + 2 * 10 ** 9,
+                                   info['compiled_mtime_ns'] + 2 * 10 ** 9))
+                engine = cdenrichrgenestoterm.get_enrichr(theargs)
+                with self.assertRaises(ValueError):
+                    engine.get_library('Fixture_Process')
+            self.assertEqual(['Fixture_Process'], store.verify())
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_download_timeout(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            store = LibraryStore(os.path.join(temp_dir, 'store'))
+            with patch('urllib.request.urlopen',
+                       side_effect=TimeoutError('timed out')) as urlopen:
+                with self.assertRaises(TimeoutError):
+                    store.fetch(['Fixture_Process'], url=FIXTURE_URL,
+                                timeout=2.5)
+                self.assertEqual(2.5, urlopen.call_args[1]['timeout'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_main(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            storedir = os.path.join(temp_dir, 'store')
+            prefix = ['prog', cdenrichrgenestoterm.LIBRARY_COMMAND,
+                      '--librarydir', storedir]
+            with patch('sys.stdout', new_callable=io.StringIO) as out:
+                res = cdenrichrgenestoterm.main(prefix +
+                                                ['fetch', '--genesets',
+                                                 ','.join(FIXTURE_LIBRARIES),
+                                                 '--libraryversion', 'v1',
+                                                 '--url', FIXTURE_URL])
+                self.assertEqual(0, res)
+                self.assertEqual('v1\n', out.getvalue())
+            self.assertEqual(0, cdenrichrgenestoterm.main(
+                prefix + ['fetch', '--genesets', 'Fixture_Process',
+                          '--libraryversion', 'v2', '--notcurrent',
+                          '--url', FIXTURE_URL]))
+            with patch('sys.stdout', new_callable=io.StringIO) as out:
+                res = cdenrichrgenestoterm.main(prefix + ['list'])
+                self.assertEqual(0, res)
+                self.assertEqual('* v1\n  v2\n', out.getvalue())
+            self.assertEqual(0, cdenrichrgenestoterm.main(prefix + ['verify']))
+            self.assertEqual(0, cdenrichrgenestoterm.main(prefix +
+                                                          ['use', 'v2']))
+            self.assertEqual(2, cdenrichrgenestoterm.main(prefix +
+                                                          ['use', 'v3']))
+            os.unlink(os.path.join(storedir, 'v2', 'Fixture_Process.gmt'))
+            self.assertEqual(1, cdenrichrgenestoterm.main(prefix + ['verify']))
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    sys.exit(unittest.main())
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_localenrichr
+----------------------------------
+
+Tests for `localenrichr` module.
+"""
+
+import os
+import sys
+import random
+import unittest
+import tempfile
+import shutil
+
+import numpy
+from scipy.stats import hypergeom
+
+from cdenrichrgenestoterm import localenrichr
+from cdenrichrgenestoterm.localenrichr import LocalEnrichr
+from cdenrichrgenestoterm.localenrichr import TermLibrary
+
+
+class TestLocalEnrichr(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def write_gmt(self, gmtdir, library, terms):
+        with open(os.path.join(gmtdir, library + '.gmt'), 'w') as f:
+            for term, genes in terms:
+                f.write(term + '\tdesc\t' + '\t'.join(genes) + '\n')
+
+    def test_read_gmt_file(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            gmtfile = os.path.join(temp_dir, 'foo.gmt')
+            with open(gmtfile, 'w') as f:
+                f.write('term1\t\ta\tB\tb\t\n')
+                f.write('term2\tdesc\tC,1.0\tD,0.5\n')
+                f.write('\n')
+                f.write('term3\tnogenes\n')
+            res = localenrichr.read_gmt_file(gmtfile)
+            self.assertEqual({'term1': ['A', 'B'],
+                              'term2': ['C', 'D']}, res)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_get_gmt_file(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            try:
+                localenrichr.get_gmt_file(temp_dir, 'foo')
+                self.fail('Expected LookupError')
+            except LookupError as le:
+                self.assertTrue('foo' in str(le))
+            gmtfile = os.path.join(temp_dir, 'foo.gmt')
+            open(gmtfile, 'a').close()
+            self.assertEqual(gmtfile,
+                             localenrichr.get_gmt_file(temp_dir, 'foo'))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_benjamini_hochberg(self):
+        res = localenrichr.benjamini_hochberg([])
+        self.assertEqual(0, len(res))
+        res = localenrichr.benjamini_hochberg([0.01, 0.04, 0.03, 0.5])
+        self.assertEqual([0.04, 0.053333, 0.053333, 0.5],
+                         [round(x, 6) for x in res])
+        res = localenrichr.benjamini_hochberg([0.9, 0.8])
+        self.assertEqual([0.9, 0.9], [round(x, 6) for x in res])
+
+    def test_hypergeometric_sf(self):
+        res = localenrichr.hypergeometric_sf(numpy.array([]), 10,
+                                             numpy.array([]), 3)
+        self.assertEqual(0, len(res))
+        sizes = numpy.array([1, 2, 5, 50, 300, 300, 1000, 20])
+        overlaps = numpy.array([1, 1, 2, 3, 1, 40, 100, 20])
+        res = localenrichr.hypergeometric_sf(overlaps, 20000, sizes, 200)
+        expected = hypergeom.sf(overlaps - 1, 20000, sizes, 200)
+        for x, y in zip(expected, res):
+            self.assertTrue(abs(x - y) <= 1e-9 * x, str(x) + ' ' + str(y))
+        res = localenrichr.hypergeometric_sf(numpy.array([1, 4]), 4,
+                                             numpy.array([4, 4]), 4)
+        self.assertEqual([1.0, 1.0], list(res))
+
+        # overlaps well below the mean of a large query list, where
+        # the point mass at the overlap underflows but the tail is ~1
+        sizes = numpy.array([3020, 5844, 3020, 800, 4000, 3020])
+        draws = numpy.array([5000, 2416, 5000, 5000, 3000, 5000])
+        overlaps = numpy.array([20, 25, 700, 150, 550, 755])
+        res = localenrichr.hypergeometric_sf(overlaps, 20000, sizes, draws)
+        expected = hypergeom.sf(overlaps - 1, 20000, sizes, draws)
+        self.assertEqual(1.0, round(res[0], 12))
+        self.assertEqual(1.0, round(res[1], 12))
+        for x, y in zip(expected, res):
+            self.assertTrue(abs(x - y) <= 1e-9 * x, str(x) + ' ' + str(y))
+
+    def test_term_library(self):
+        lib = TermLibrary.from_terms('lib1', {'t2': ['C', 'A'],
+                                              't1': ['B', 'C', 'D']})
+        self.assertEqual('lib1', lib.name)
+        self.assertEqual(['A', 'B', 'C', 'D'], lib.genes)
+        self.assertEqual(['t1', 't2'], lib.terms)
+        self.assertEqual([3, 2], list(lib.term_sizes))
+        gene_ids = lib.get_gene_ids(['D', 'X', 'A', 'D'])
+        self.assertEqual([0, 3], list(gene_ids))
+        overlaps = lib.get_overlaps(gene_ids)
+        self.assertEqual([1, 1], list(overlaps))
+        self.assertEqual(['D', 'A'], lib.get_hit_genes(gene_ids, [0, 1]))
+        overlaps = lib.get_overlaps(lib.get_gene_ids(['A', 'B', 'C']))
+        self.assertEqual([2, 2], list(overlaps))
+        pvals = lib.get_pvalues(overlaps, numpy.array([0, 1]), 3)
+        self.assertAlmostEqual(hypergeom.sf(1, 4, 3, 3), pvals[0])
+        self.assertAlmostEqual(hypergeom.sf(1, 4, 2, 3), pvals[1])
+
+    def test_get_hit_genes(self):
+        rand = random.Random(5)
+        genes = ['G' + str(x) for x in range(200)] + ['\u00c9A', 'B\u00df']
+        terms = {'t' + str(x): rand.sample(genes, rand.randint(1, 60))
+                 for x in range(80)}
+        lib = TermLibrary.from_terms('lib', terms)
+        gene_ids = lib.get_gene_ids(rand.sample(genes, 50) +
+                                    ['\u00c9A', 'B\u00df'])
+        overlaps = lib.get_overlaps(gene_ids)
+        query = {lib.genes[x] for x in gene_ids}
+        for term_ids in [numpy.flatnonzero(overlaps),
+                         numpy.flatnonzero(overlaps)[::3],
+                         numpy.arange(len(lib.terms))]:
+            expected = [';'.join(sorted(query.intersection(
+                terms[lib.terms[x]]))) for x in term_ids]
+            self.assertEqual(expected, lib.get_hit_genes(gene_ids,
+                                                         term_ids))
+        self.assertEqual([], lib.get_hit_genes(gene_ids,
+                                               numpy.zeros(0, dtype=int)))
+        self.assertEqual([''], lib.get_hit_genes(
+            numpy.zeros(0, dtype=numpy.int64), [0]))
+
+    def test_term_library_enrich(self):
+        lib = TermLibrary.from_terms('lib1', {'t2': ['C', 'A'],
+                                              't1': ['B', 'C', 'D'],
+                                              't3': ['E']})
+        df = lib.enrich(['X', 'c'])
+        self.assertEqual(0, df.shape[0])
+        df = lib.enrich(['C', 'A'])
+        self.assertEqual(['t1', 't2'], list(df['Term']))
+        self.assertEqual(['lib1', 'lib1'], list(df['Gene_set']))
+        self.assertEqual(['1/3', '2/2'], list(df['Overlap']))
+        self.assertEqual(['C', 'A;C'], list(df['Genes']))
+        self.assertEqual(list(localenrichr.benjamini_hochberg(
+            df['P-value'])), list(df['Adjusted P-value']))
+
+    def test_enrichr(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            self.write_gmt(temp_dir, 'lib1',
+                           [('t1', ['A', 'B', 'C']),
+                            ('t2', ['C', 'D', 'E', 'F']),
+                            ('t3', ['G', 'H'])])
+            self.write_gmt(temp_dir, 'lib2',
+                           [('x1', ['A', 'X', 'Y', 'Z'])])
+            engine = LocalEnrichr(temp_dir)
+            res = engine.enrichr(gene_list=['A', 'B', 'C', 'NOPE'],
+                                 gene_sets='lib1,lib2', cutoff=0.05,
+                                 no_plot=True, outdir=temp_dir)
+            df = res.results
+            self.assertEqual(['Gene_set', 'Term', 'Overlap', 'P-value',
+                              'Adjusted P-value', 'Genes'],
+                             list(df.columns))
+            self.assertEqual(['t1', 't2', 'x1'], list(df['Term']))
+            self.assertEqual(['lib1', 'lib1', 'lib2'],
+                             list(df['Gene_set']))
+            self.assertEqual(['3/3', '1/4', '1/4'], list(df['Overlap']))
+            self.assertEqual(['A;B;C', 'C', 'A'], list(df['Genes']))
+            self.assertAlmostEqual(hypergeom.sf(2, 8, 3, 3),
+                                   df['P-value'][0])
+            self.assertAlmostEqual(hypergeom.sf(0, 4, 4, 1),
+                                   df['P-value'][2])
+            self.assertTrue(os.path.isfile(
+                os.path.join(temp_dir,
+                             'lib1.human.enrichr.reports.txt')))
+            self.assertTrue(os.path.isfile(
+                os.path.join(temp_dir,
+                             'lib2.human.enrichr.reports.txt')))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_enrichr_no_overlap(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            self.write_gmt(temp_dir, 'lib1', [('t1', ['A', 'B'])])
+            engine = LocalEnrichr(temp_dir)
+            res = engine.enrichr(gene_list=['X'], gene_sets='lib1')
+            self.assertEqual(0, res.results.shape[0])
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_enrichr_missing_library(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            engine = LocalEnrichr(temp_dir)
+            try:
+                engine.enrichr(gene_list=['X'], gene_sets='lib1')
+                self.fail('Expected LookupError')
+            except LookupError:
+                pass
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    sys.exit(unittest.main())
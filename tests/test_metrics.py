@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_metrics
+----------------------------------
+
+Tests for `metrics` module.
+"""
+
+import os
+import io
+import json
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+from unittest.mock import MagicMock
+
+from cdenrichrgenestoterm import metrics
+from cdenrichrgenestoterm import cdenrichrgenestoterm
+from cdenrichrgenestoterm.retrypolicy import RetryPolicy
+
+LIBRARY_DIR = os.path.join(os.path.dirname(__file__), 'data', 'libraries')
+
+
+class TestMetrics(unittest.TestCase):
+
+    def tearDown(self):
+        metrics.set_metrics(None)
+
+    def test_null_metrics(self):
+        recorder = metrics.get_metrics()
+        self.assertFalse(recorder.enabled)
+        with recorder.time_stage('foo', library='lib'):
+            pass
+        recorder.record('foo', 1.0)
+        recorder.increment('bar')
+
+    def test_set_metrics(self):
+        recorder = metrics.StageMetrics()
+        prev = metrics.set_metrics(recorder)
+        self.assertFalse(prev.enabled)
+        self.assertTrue(metrics.get_metrics() is recorder)
+        self.assertTrue(metrics.set_metrics(None) is recorder)
+        self.assertFalse(metrics.get_metrics().enabled)
+
+    def test_record_and_get_record(self):
+        clock = MagicMock(side_effect=[1.0, 1.5, 2.0, 4.0])
+        recorder = metrics.StageMetrics(clock=clock)
+        with recorder.time_stage('enrich', library='lib1'):
+            pass
+        try:
+            with recorder.time_stage('enrich', library='lib2'):
+                raise ValueError('x')
+        except ValueError:
+            pass
+        recorder.record('select', 0.25)
+        recorder.record('select', 0.5)
+        recorder.increment('cache_hits')
+        recorder.increment('cache_hits', 2)
+        res = recorder.get_record()
+        self.assertEqual({'cache_hits': 3}, res['counters'])
+        self.assertEqual({'count': 2, 'seconds': 0.75, 'max_seconds': 0.5},
+                         res['stages']['select'])
+        self.assertEqual({'count': 2, 'seconds': 2.5, 'max_seconds': 2.0,
+                          'libraries': {
+                              'lib1': {'count': 1, 'seconds': 0.5,
+                                       'max_seconds': 0.5},
+                              'lib2': {'count': 1, 'seconds': 2.0,
+                                       'max_seconds': 2.0}}},
+                         res['stages']['enrich'])
+
+    def test_merge(self):
+        recorder = metrics.StageMetrics()
+        recorder.record('enrich', 1.0, library='lib1')
+        recorder.record('enrich', 3.0)
+        recorder.increment('retries')
+        other = metrics.StageMetrics()
+        other.record('enrich', 2.0, library='lib1')
+        other.merge(recorder.get_record())
+        other.merge({'counters': {'retries': 2}})
+        res = other.get_record()
+        self.assertEqual({'count': 3, 'seconds': 6.0, 'max_seconds': 3.0,
+                          'libraries': {'lib1': {'count': 2,
+                                                 'seconds': 3.0,
+                                                 'max_seconds': 2.0}}},
+                         res['stages']['enrich'])
+        self.assertEqual({'retries': 3}, res['counters'])
+
+    def test_to_prometheus(self):
+        recorder = metrics.StageMetrics()
+        recorder.record('enrich', 1.5, library='a"b')
+        recorder.record('select', 0.5)
+        recorder.increment('cache_misses')
+        res = recorder.to_prometheus()
+        self.assertTrue(res.endswith('\n'))
+        lines = res.splitlines()
+        self.assertTrue('# TYPE cdenrichrgenestoterm_stage_seconds_total '
+                        'counter' in lines)
+        self.assertTrue('cdenrichrgenestoterm_stage_seconds_total'
+                        '{stage="enrich",library="a\\"b"} 1.5' in lines)
+        self.assertTrue('cdenrichrgenestoterm_stage_count_total'
+                        '{stage="select"} 1' in lines)
+        self.assertTrue('cdenrichrgenestoterm_cache_misses_total 1'
+                        in lines)
+        self.assertTrue(all(x.startswith('#') for x in
+                            metrics.StageMetrics().to_prometheus().
+                            splitlines()))
+
+    def test_is_requested(self):
+        theargs = cdenrichrgenestoterm._parse_arguments('desc', ['foo'])
+        self.assertFalse(metrics.is_requested(theargs))
+        for flag in [['--metrics'], ['--metricsfile', 'x'],
+                     ['--prometheusfile', 'x']]:
+            theargs = cdenrichrgenestoterm._parse_arguments('desc',
+                                                            ['foo'] + flag)
+            self.assertTrue(metrics.is_requested(theargs))
+
+    def test_retry_policy_records_retries(self):
+        recorder = metrics.StageMetrics()
+        metrics.set_metrics(recorder)
+        func = MagicMock(side_effect=[OSError('busy'), 'ok'])
+        policy = RetryPolicy(max_tries=2, backoff=0.0)
+        with patch('sys.stderr', new_callable=io.StringIO):
+            self.assertEqual('ok', policy.call(func))
+        res = recorder.get_record()
+        self.assertEqual({'retries': 1}, res['counters'])
+        self.assertEqual(1, res['stages']['failed_try']['count'])
+        self.assertEqual(1, res['stages']['retry_wait']['count'])
+
+    def test_main_metrics(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            tfile = os.path.join(temp_dir, 'genes')
+            with open(tfile, 'w') as f:
+                f.write('CDK1,CCNB1,CDC20')
+            metricsfile = os.path.join(temp_dir, 'metrics.json')
+            promfile = os.path.join(temp_dir, 'metrics.prom')
+            myargs = ['prog', tfile, '--gmtdir', LIBRARY_DIR, '--genesets',
+                      'Fixture_Process,Fixture_Component',
+                      '--maxpval', '1.0']
+            with patch('sys.stdout', new_callable=io.StringIO):
+                for x in range(2):
+                    self.assertEqual(0, cdenrichrgenestoterm.main(
+                        myargs + ['--metricsfile', metricsfile,
+                                  '--prometheusfile', promfile]))
+            self.assertFalse(metrics.get_metrics().enabled)
+            with open(metricsfile, 'r') as f:
+                lines = f.read().strip().split('\n')
+            self.assertEqual(2, len(lines))
+            res = json.loads(lines[0])['metrics']
+            for stage in ['input_read', 'library_load', 'enrich',
+                          'result_load', 'select', 'serialize', 'total']:
+                self.assertTrue(stage in res['stages'], stage)
+            self.assertEqual(['Fixture_Component', 'Fixture_Process'],
+                             sorted(res['stages']['enrich']['libraries']))
+            with open(promfile, 'r') as f:
+                self.assertTrue('stage="total"' in f.read())
+
+            # metrics to standard error
+            with patch('sys.stdout', new_callable=io.StringIO), \
+                    patch('sys.stderr', new_callable=io.StringIO) as err:
+                self.assertEqual(0, cdenrichrgenestoterm.main(
+                    myargs + ['--metrics']))
+                last_line = err.getvalue().strip().split('\n')[-1]
+            self.assertTrue('select' in json.loads(last_line)['metrics']
+                            ['stages'])
+
+            # metrics recorded by batch workers are added up, lists
+            # differ so none are coalesced
+            with open(tfile, 'w') as f:
+                for x in range(5):
+                    f.write('CDK1,CCNB1,X' + str(x) + '\n')
+            with patch('sys.stdout', new_callable=io.StringIO), \
+                    patch('sys.stderr', new_callable=io.StringIO) as err:
+                self.assertEqual(0, cdenrichrgenestoterm.main(
+                    myargs + ['--metrics', '--batch', '--workers', '2']))
+                last_line = err.getvalue().strip().split('\n')[-1]
+            res = json.loads(last_line)['metrics']
+            self.assertEqual(5, res['stages']['select']['count'])
+            self.assertEqual(5, res['stages']['serialize']['count'])
+            self.assertEqual(10, res['stages']['enrich']['count'])
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
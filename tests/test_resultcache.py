@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_resultcache
+----------------------------------
+
+Tests for `resultcache` module.
+"""
+
+import os
+import sys
+import time
+import unittest
+import tempfile
+import shutil
+from unittest.mock import patch
+
+from cdenrichrgenestoterm.resultcache import ResultCache
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def test_make_key(self):
+        key = ResultCache.make_key(['A', 'b', ' C'], {'maxpval': 0.05})
+        self.assertEqual(64, len(key))
+        self.assertEqual(key, ResultCache.make_key(['c', 'B', 'a'],
+                                                   {'maxpval': 0.05}))
+        self.assertNotEqual(key, ResultCache.make_key(['c', 'B', 'a'],
+                                                      {'maxpval': 0.01}))
+        self.assertNotEqual(key, ResultCache.make_key(['c', 'B'],
+                                                      {'maxpval': 0.05}))
+
+    def test_store_and_lookup(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            cache = ResultCache(os.path.join(temp_dir, 'cache'))
+            key = ResultCache.make_key(['A'], {})
+            self.assertEqual((False, None), cache.lookup(key))
+            cache.store(key, {'name': 'foo', 'p_value': 0.01})
+            self.assertEqual((True, {'name': 'foo', 'p_value': 0.01}),
+                             cache.lookup(key))
+            other_key = ResultCache.make_key(['B'], {})
+            cache.store(other_key, None)
+            self.assertEqual((True, None), cache.lookup(other_key))
+
+            # new instance sees same entries
+            cache = ResultCache(os.path.join(temp_dir, 'cache'))
+            self.assertEqual((True, None), cache.lookup(other_key))
+            cache.clear()
+            self.assertEqual((False, None), cache.lookup(key))
+            self.assertEqual((False, None), cache.lookup(other_key))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_ttl(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            cache = ResultCache(temp_dir, ttl=0)
+            cache.store('abcd', {'name': 'foo'})
+            time.sleep(0.01)
+            self.assertEqual((False, None), cache.lookup('abcd'))
+            self.assertFalse(os.path.isfile(os.path.join(temp_dir, 'ab',
+                                                         'abcd.json')))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_entries_counted_on_first_store(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            cache = ResultCache(temp_dir, max_entries=3)
+            for x in range(3):
+                cache.store(ResultCache.make_key([str(x)], {}), x)
+            cache = ResultCache(temp_dir, max_entries=3)
+            with patch.object(cache, '_get_entry_paths',
+                              wraps=cache._get_entry_paths) as scan:
+                self.assertEqual((True, 1), cache.lookup(
+                    ResultCache.make_key(['1'], {})))
+                self.assertEqual(0, scan.call_count)
+                # overwriting an entry does not add to the count
+                for x in range(5):
+                    cache.store(ResultCache.make_key(['1'], {}), x)
+                self.assertEqual(1, scan.call_count)
+            found = [x for x in range(3)
+                     if cache.lookup(ResultCache.make_key([str(x)], {}))[0]]
+            self.assertEqual([0, 1, 2], found)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_lru_eviction(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            cache = ResultCache(temp_dir, max_entries=10)
+            now = time.time()
+            for x in range(10):
+                key = ResultCache.make_key([str(x)], {})
+                cache.store(key, x)
+                os.utime(os.path.join(temp_dir, key[:2], key + '.json'),
+                         (now - 100 + x, now - 100 + x))
+            # mark first entry as recently used
+            self.assertEqual((True, 0),
+                             cache.lookup(ResultCache.make_key(['0'], {})))
+            cache.store(ResultCache.make_key(['new'], {}), 'new')
+            found = [x for x in range(10)
+                     if cache.lookup(ResultCache.make_key([str(x)], {}))[0]]
+            self.assertEqual([0, 3, 4, 5, 6, 7, 8, 9], found)
+            self.assertEqual((True, 'new'),
+                             cache.lookup(ResultCache.make_key(['new'], {})))
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    sys.exit(unittest.main())
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_retrypolicy
+----------------------------------
+
+Tests for `retrypolicy` module.
+"""
+
+import sys
+import time
+import json
+import threading
+import unittest
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from unittest.mock import MagicMock
+
+from cdenrichrgenestoterm import retrypolicy
+from cdenrichrgenestoterm.retrypolicy import RetryPolicy
+from cdenrichrgenestoterm.retrypolicy import AttemptTimeoutError
+from cdenrichrgenestoterm.retrypolicy import DeadlineExceededError
+
+
+class StubEnrichrHandler(BaseHTTPRequestHandler):
+    """
+    Stub service that answers each request with the next
+    (status, delay) pair from ``server.responses``
+    """
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.num_requests += 1
+        if len(self.server.responses) > 1:
+            status, delay = self.server.responses.pop(0)
+        else:
+            status, delay = self.server.responses[0]
+        time.sleep(delay)
+        body = json.dumps({'status': status}).encode('utf-8')
+        try:
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            pass
+
+
+class TestRetryPolicy(unittest.TestCase):
+
+    def start_stub(self, responses):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StubEnrichrHandler)
+        server.daemon_threads = True
+        server.responses = responses
+        server.num_requests = 0
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return server
+
+    def get_url(self, server):
+        return 'http://127.0.0.1:' + str(server.server_address[1]) + '/'
+
+    def fetch(self, url=None, timeout=5):
+        with urllib.request.urlopen(url, timeout=timeout) as f:
+            return json.loads(f.read().decode('utf-8'))
+
+    def test_is_retryable(self):
+        self.assertFalse(retrypolicy.is_retryable(LookupError('x')))
+        self.assertFalse(retrypolicy.is_retryable(ValueError('x')))
+        self.assertTrue(retrypolicy.is_retryable(Exception('x')))
+        self.assertTrue(retrypolicy.is_retryable(ConnectionError('x')))
+        self.assertTrue(retrypolicy.is_retryable(AttemptTimeoutError('x')))
+        for code, expected in [(429, True), (408, True), (500, True),
+                               (503, True), (400, False), (404, False)]:
+            error = OSError('x')
+            error.response = MagicMock(status_code=code)
+            self.assertEqual(expected, retrypolicy.is_retryable(error))
+            error = urllib.error.HTTPError('http://x', code, 'x', {}, None)
+            self.assertEqual(expected, retrypolicy.is_retryable(error))
+
+    def test_get_delay(self):
+        policy = RetryPolicy(backoff=1.0, max_backoff=5.0,
+                             rand=lambda: 0.5)
+        self.assertEqual([0.5, 1.0, 2.0, 2.5, 2.5],
+                         [policy.get_delay(x) for x in range(1, 6)])
+        policy = RetryPolicy(backoff=1.0, max_backoff=5.0,
+                             rand=lambda: 0.0)
+        self.assertEqual(0.0, policy.get_delay(3))
+
+    def test_call_success_after_retries(self):
+        sleep = MagicMock()
+        func = MagicMock(side_effect=[Exception('busy'), OSError('reset'),
+                                      'ok'])
+        policy = RetryPolicy(max_tries=3, backoff=1.0, sleep=sleep,
+                             rand=lambda: 1.0)
+        self.assertEqual('ok', policy.call(func, a=1))
+        self.assertEqual(3, func.call_count)
+        func.assert_called_with(a=1)
+        self.assertEqual([1.0, 2.0], [x[0][0] for x in sleep.call_args_list])
+
+    def test_call_tries_exceeded(self):
+        sleep = MagicMock()
+        func = MagicMock(side_effect=Exception('busy'))
+        policy = RetryPolicy(max_tries=2, sleep=sleep)
+        try:
+            policy.call(func)
+            self.fail('Expected Exception')
+        except Exception as e:
+            self.assertEqual('busy', str(e))
+        self.assertEqual(2, func.call_count)
+        self.assertEqual(1, sleep.call_count)
+
+    def test_call_nonretryable(self):
+        sleep = MagicMock()
+        func = MagicMock(side_effect=LookupError('no such library'))
+        policy = RetryPolicy(max_tries=5, sleep=sleep)
+        try:
+            policy.call(func)
+            self.fail('Expected LookupError')
+        except LookupError:
+            pass
+        self.assertEqual(1, func.call_count)
+        self.assertEqual(0, sleep.call_count)
+
+    def test_call_deadline_exceeded_by_backoff(self):
+        now = [0.0]
+
+        def sleep(delay):
+            now[0] += delay
+
+        func = MagicMock(side_effect=Exception('busy'))
+        policy = RetryPolicy(max_tries=10, backoff=4.0, deadline=10.0,
+                             sleep=sleep, clock=lambda: now[0],
+                             rand=lambda: 1.0)
+        try:
+            policy.call(func)
+            self.fail('Expected DeadlineExceededError')
+        except DeadlineExceededError:
+            pass
+        # waits 4 then would wait 8 which is past the deadline
+        self.assertEqual(2, func.call_count)
+        self.assertEqual(4.0, now[0])
+
+    def test_against_stub_rate_limited(self):
+        server = self.start_stub([(429, 0), (503, 0), (200, 0)])
+        try:
+            policy = RetryPolicy(max_tries=3, backoff=0.01)
+            res = policy.call(self.fetch, url=self.get_url(server))
+            self.assertEqual({'status': 200}, res)
+            self.assertEqual(3, server.num_requests)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_against_stub_client_error(self):
+        server = self.start_stub([(404, 0)])
+        try:
+            policy = RetryPolicy(max_tries=3, backoff=0.01)
+            try:
+                policy.call(self.fetch, url=self.get_url(server))
+                self.fail('Expected HTTPError')
+            except urllib.error.HTTPError as he:
+                self.assertEqual(404, he.code)
+            self.assertEqual(1, server.num_requests)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_against_stub_hung(self):
+        server = self.start_stub([(200, 2.0), (200, 0)])
+        try:
+            policy = RetryPolicy(max_tries=2, backoff=0.0, timeout=0.2,
+                                 timeout_arg='timeout')
+            start = time.monotonic()
+            res = policy.call(self.fetch, url=self.get_url(server))
+            self.assertEqual({'status': 200}, res)
+            self.assertTrue(time.monotonic() - start < 1.5)
+            self.assertEqual(2, server.num_requests)
+
+            # deadline caps the time of all tries
+            server.responses = [(200, 2.0)]
+            policy = RetryPolicy(max_tries=10, backoff=0.0, timeout=1.0,
+                                 deadline=0.3, timeout_arg='timeout')
+            start = time.monotonic()
+            try:
+                policy.call(self.fetch, url=self.get_url(server))
+                self.fail('Expected error')
+            except (AttemptTimeoutError, DeadlineExceededError):
+                pass
+            self.assertTrue(time.monotonic() - start < 1.0)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_try_runs_in_calling_thread(self):
+        # without timeout_arg a try is never abandoned to a thread
+        # that could outlive it, the deadline is checked between tries
+        now = [0.0]
+        threads = []
+
+        def func():
+            threads.append(threading.current_thread())
+            now[0] += 5.0
+            raise OSError('busy')
+
+        policy = RetryPolicy(max_tries=5, backoff=0.0, timeout=1.0,
+                             deadline=8.0, clock=lambda: now[0],
+                             sleep=lambda x: None)
+        with self.assertRaises(DeadlineExceededError):
+            policy.call(func)
+        self.assertEqual([threading.current_thread()] * 2, threads)
+
+        timeouts = []
+        policy = RetryPolicy(max_tries=1, timeout=1.0, deadline=0.5,
+                             timeout_arg='wait')
+        policy.call(lambda wait: timeouts.append(wait))
+        self.assertTrue(0 < timeouts[0] <= 0.5)
+
+
+if __name__ == '__main__':
+    sys.exit(unittest.main())
@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_server
+----------------------------------
+
+Tests for `server` module.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import unittest
+import tempfile
+import shutil
+import threading
+import http.client
+from unittest.mock import MagicMock
+
+from cdenrichrgenestoterm import server
+from cdenrichrgenestoterm import metrics
+
+
+class TestServer(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def tearDown(self):
+        pass
+
+    def write_gmt(self, temp_dir):
+        gmtdir = os.path.join(temp_dir, 'gmt')
+        os.makedirs(gmtdir)
+        with open(os.path.join(gmtdir, 'lib1.gmt'), 'w') as f:
+            f.write('term1\t\tA\tB\tC\n')
+            f.write('term2\t\tD\tE\tF\tG\tH\n')
+            f.write('term3\t\tI\tJ\tK\tL\tM\tN\n')
+        with open(os.path.join(gmtdir, 'lib2.gmt'), 'w') as f:
+            f.write('other\t\tX\tY\tZ\n')
+            f.write('filler\t\tP\tQ\tR\tS\tT\tU\tV\n')
+        return gmtdir
+
+    def start_server(self, theargs):
+        service = server.EnrichmentService(theargs)
+        service.warm()
+        the_server = server.create_server(theargs, service)
+        thread = threading.Thread(target=the_server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return the_server, thread
+
+    def stop_server(self, the_server, thread):
+        the_server.shutdown()
+        the_server.server_close()
+        thread.join()
+
+    def post(self, conn, query):
+        if not isinstance(query, str):
+            query = json.dumps(query)
+        conn.request('POST', '/enrich', body=query,
+                     headers={'Content-Type': 'application/json'})
+        resp = conn.getresponse()
+        data = resp.read()
+        if len(data) == 0:
+            return resp.status, None
+        return resp.status, json.loads(data)
+
+    def test_parse_args(self):
+        res = server._parse_arguments('desc', [])
+        self.assertEqual('127.0.0.1', res.host)
+        self.assertEqual(8080, res.port)
+        self.assertEqual(None, res.unixsocket)
+        self.assertEqual(0.05, res.maxpval)
+        self.assertEqual(None, res.gmtdir)
+
+    def test_get_query_args(self):
+        theargs = server._parse_arguments('desc', [])
+        service = server.EnrichmentService(theargs, enrichr=MagicMock())
+        res = service.get_query_args({'genes': 'a'})
+        self.assertEqual(0.05, res.maxpval)
+        self.assertEqual(theargs.genesets, res.genesets)
+        res = service.get_query_args({'maxpval': '0.2',
+                                      'genesets': 'foo',
+                                      'topk': 3})
+        self.assertEqual(0.2, res.maxpval)
+        self.assertEqual('foo', res.genesets)
+        self.assertEqual(3, res.topk)
+        self.assertEqual(1, theargs.topk)
+        res = service.get_query_args({'allterms': True, 'offset': 2,
+                                      'limit': '5'})
+        self.assertTrue(res.allterms)
+        self.assertEqual(2, res.offset)
+        self.assertEqual(5, res.limit)
+        self.assertFalse(theargs.allterms)
+        self.assertEqual(0.05, theargs.maxpval)
+        res = service.get_query_args({'correction': 'bh'})
+        self.assertEqual('bh', res.correction)
+        self.assertEqual('library', theargs.correction)
+        with self.assertRaises(ValueError):
+            service.get_query_args({'correction': 'foo'})
+        for key in ['maxpval', 'topk', 'offset', 'limit']:
+            for value in ['x', [1], {'a': 1}]:
+                with self.assertRaises(ValueError):
+                    service.get_query_args({key: value})
+        try:
+            service.get_query_args({'genesets': ['foo']})
+            self.fail('Expected ValueError')
+        except ValueError:
+            pass
+
+    def test_enrich_invalid_query(self):
+        theargs = server._parse_arguments('desc', [])
+        service = server.EnrichmentService(theargs, enrichr=MagicMock())
+        for query in [[], {'foo': 'a'}]:
+            try:
+                service.enrich(query)
+                self.fail('Expected ValueError')
+            except ValueError:
+                pass
+
+    def test_http_server(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            gmtdir = self.write_gmt(temp_dir)
+            theargs = server._parse_arguments('desc',
+                                              ['--port', '0',
+                                               '--tmpdir', temp_dir,
+                                               '--gmtdir', gmtdir,
+                                               '--genesets', 'lib1'])
+            the_server, thread = self.start_server(theargs)
+            try:
+                conn = http.client.HTTPConnection(
+                    *the_server.server_address)
+                conn.request('GET', '/status')
+                resp = conn.getresponse()
+                self.assertEqual(200, resp.status)
+                self.assertEqual({'status': 'ok'}, json.loads(resp.read()))
+
+                status, res = self.post(conn, {'genes': ['a', 'b', 'c']})
+                self.assertEqual(200, status)
+                self.assertEqual('term1', res['name'])
+                self.assertEqual('lib1', res['source'])
+
+                status, res = self.post(conn, {'genes': 'x,y,z',
+                                               'genesets': 'lib2'})
+                self.assertEqual(200, status)
+                self.assertEqual('other', res['name'])
+                self.assertEqual('lib2', res['source'])
+
+                status, res = self.post(conn, {'genes': 'a,b,c,d',
+                                               'allterms': True,
+                                               'maxpval': 1.0})
+                self.assertEqual(200, status)
+                self.assertEqual(['term1', 'term2'],
+                                 [x['name'] for x in res])
+
+                status, res = self.post(conn, {'genes': 'a,b,c',
+                                               'maxpval': 0.0})
+                self.assertEqual(204, status)
+                self.assertEqual(None, res)
+
+                status, res = self.post(conn, 'not json')
+                self.assertEqual(400, status)
+                self.assertTrue('Invalid JSON' in res['error'])
+
+                status, res = self.post(conn, ['a'])
+                self.assertEqual(400, status)
+                self.assertTrue('genes' in res['error'])
+
+                for key in ['maxpval', 'topk', 'offset', 'limit']:
+                    for value in [[1], {'a': 1}, 'x']:
+                        status, res = self.post(conn, {'genes': 'a,b,c',
+                                                       key: value})
+                        self.assertEqual(400, status)
+                        self.assertTrue(key + ' must be a number' in
+                                        res['error'])
+
+                status, res = self.post(conn, {'genes': 'a,b,c',
+                                               'topk': None})
+                self.assertEqual(200, status)
+
+                for path in ['/foo', server.METRICS_PATH]:
+                    conn.request('GET', path)
+                    resp = conn.getresponse()
+                    resp.read()
+                    self.assertEqual(404, resp.status)
+                conn.close()
+            finally:
+                self.stop_server(the_server, thread)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_enrich_identical_queries_coalesced(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            gmtdir = self.write_gmt(temp_dir)
+            theargs = server._parse_arguments('desc',
+                                              ['--tmpdir', temp_dir,
+                                               '--gmtdir', gmtdir,
+                                               '--genesets', 'lib1'])
+            service = server.EnrichmentService(theargs)
+            enrichr = service._enrichr.enrichr
+            calls = []
+            started = threading.Event()
+
+            def slow_enrichr(**kwargs):
+                calls.append(kwargs['gene_list'])
+                started.set()
+                time.sleep(0.3)
+                return enrichr(**kwargs)
+
+            service._enrichr.enrichr = slow_enrichr
+            results = []
+
+            def enrich(genes):
+                results.append(service.enrich({'genes': genes}))
+
+            threads = [threading.Thread(target=enrich, args=(x,))
+                       for x in ['a,b,c', 'c,b,a', 'A, B ,c,a']]
+            threads[0].start()
+            started.wait()
+            for thread in threads[1:]:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(1, len(calls))
+            self.assertEqual(['term1'] * 3, [x['name'] for x in results])
+
+            # nothing is kept once done
+            service.enrich({'genes': 'a,b,c'})
+            self.assertEqual(2, len(calls))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_concurrent_enrich_keeps_stdout(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            gmtdir = self.write_gmt(temp_dir)
+            theargs = server._parse_arguments('desc',
+                                              ['--tmpdir', temp_dir,
+                                               '--gmtdir', gmtdir,
+                                               '--genesets', 'lib1,lib2',
+                                               '--maxpval', '1.0'])
+            service = server.EnrichmentService(theargs)
+            results = []
+
+            def enrich(genes):
+                results.append(service.enrich({'genes': genes}))
+
+            stdout = sys.stdout
+            threads = [threading.Thread(target=enrich,
+                                        args=('A,B,X,' + str(x),))
+                       for x in range(16)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertTrue(sys.stdout is stdout)
+            self.assertEqual(16, len(results))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_metrics_endpoint(self):
+        temp_dir = tempfile.mkdtemp()
+        recorder = metrics.StageMetrics()
+        metrics.set_metrics(recorder)
+        try:
+            gmtdir = self.write_gmt(temp_dir)
+            theargs = server._parse_arguments('desc',
+                                              ['--port', '0',
+                                               '--gmtdir', gmtdir,
+                                               '--genesets', 'lib1,lib2',
+                                               '--metrics'])
+            the_server, thread = self.start_server(theargs)
+            try:
+                conn = http.client.HTTPConnection(
+                    *the_server.server_address)
+                status, res = self.post(conn, {'genes': ['a', 'b', 'c']})
+                self.assertEqual(200, status)
+                conn.request('GET', server.METRICS_PATH)
+                resp = conn.getresponse()
+                body = resp.read().decode('utf-8')
+                self.assertEqual(200, resp.status)
+                self.assertTrue(resp.getheader('Content-Type').
+                                startswith('text/plain'))
+                conn.close()
+            finally:
+                self.stop_server(the_server, thread)
+            self.assertTrue('cdenrichrgenestoterm_stage_count_total'
+                            '{stage="enrich",library="lib1"} 1' in body)
+            self.assertTrue('stage="library_load",library="lib2"' in body)
+            self.assertTrue('stage="select"' in body)
+        finally:
+            metrics.set_metrics(None)
+            shutil.rmtree(temp_dir)
+
+    @unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'No Unix sockets')
+    def test_unix_socket_server(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            gmtdir = self.write_gmt(temp_dir)
+            sock_path = os.path.join(temp_dir, 'enrichr.sock')
+            theargs = server._parse_arguments('desc',
+                                              ['--unixsocket', sock_path,
+                                               '--tmpdir', temp_dir,
+                                               '--gmtdir', gmtdir,
+                                               '--genesets', 'lib1'])
+            the_server, thread = self.start_server(theargs)
+            try:
+                body = json.dumps({'genes': 'd,e,f'}).encode('utf-8')
+                client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                client.connect(sock_path)
+                client.sendall(b'POST /enrich HTTP/1.0\r\n'
+                               b'Content-Length: ' +
+                               str(len(body)).encode('utf-8') +
+                               b'\r\n\r\n' + body)
+                data = b''
+                while True:
+                    chunk = client.recv(4096)
+                    if not chunk:
+                        break
+                    data += chunk
+                client.close()
+                header, payload = data.split(b'\r\n\r\n', 1)
+                self.assertTrue(b' 200 ' in header.split(b'\r\n')[0])
+                self.assertEqual('term2', json.loads(payload)['name'])
+            finally:
+                self.stop_server(the_server, thread)
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    sys.exit(unittest.main())
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_singleflight
+----------------------------------
+
+Tests for `singleflight` module.
+"""
+
+import asyncio
+import threading
+import unittest
+
+from cdenrichrgenestoterm import metrics
+from cdenrichrgenestoterm.singleflight import SingleFlight
+from cdenrichrgenestoterm.singleflight import AsyncSingleFlight
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_do_coalesces_concurrent_calls(self):
+        single_flight = SingleFlight()
+        release = threading.Event()
+        calls = []
+
+        def func(value):
+            calls.append(value)
+            release.wait()
+            return {'value': value}
+
+        results = []
+
+        def call(value):
+            results.append(single_flight.do('key', func, value=value))
+
+        recorder = metrics.StageMetrics()
+        prev = metrics.set_metrics(recorder)
+        try:
+            threads = [threading.Thread(target=call, args=(x,))
+                       for x in range(5)]
+            threads[0].start()
+            while single_flight.get_num_in_flight() == 0:
+                threads[0].join(0.01)
+            for thread in threads[1:]:
+                thread.start()
+            while recorder.get_record()['counters'].get('coalesced',
+                                                        0) < 4:
+                threads[0].join(0.01)
+            release.set()
+            for thread in threads:
+                thread.join()
+        finally:
+            metrics.set_metrics(prev)
+        self.assertEqual([0], calls)
+        self.assertEqual(5, len(results))
+        self.assertTrue(all(x[0] is results[0][0] for x in results))
+        self.assertEqual({'value': 0}, results[0][0])
+        self.assertEqual([False, True, True, True, True],
+                         sorted(x[1] for x in results))
+        self.assertEqual(0, single_flight.get_num_in_flight())
+
+        # nothing is kept once a call is done
+        self.assertEqual(({'value': 7}, False),
+                         single_flight.do('key', func, value=7))
+        self.assertEqual(('b', False),
+                         single_flight.do('other', lambda: 'b'))
+
+    def test_do_shares_error(self):
+        single_flight = SingleFlight()
+        release = threading.Event()
+
+        def func():
+            release.wait()
+            raise ValueError('failed')
+
+        errors = []
+
+        def call():
+            try:
+                single_flight.do('key', func)
+            except ValueError as e:
+                errors.append(str(e))
+
+        threads = [threading.Thread(target=call) for x in range(3)]
+        threads[0].start()
+        while single_flight.get_num_in_flight() == 0:
+            threads[0].join(0.01)
+        for thread in threads[1:]:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(['failed'] * 3, errors)
+        self.assertEqual(0, single_flight.get_num_in_flight())
+
+
+class TestAsyncSingleFlight(unittest.TestCase):
+
+    def test_do_coalesces_concurrent_calls(self):
+        calls = []
+
+        async def func(value):
+            calls.append(value)
+            await asyncio.sleep(0.05)
+            return value * 2
+
+        async def run():
+            single_flight = AsyncSingleFlight()
+            res = await asyncio.gather(
+                single_flight.do('a', func, value=1),
+                single_flight.do('a', func, value=2),
+                single_flight.do('b', func, value=3))
+            self.assertEqual(0, single_flight.get_num_in_flight())
+            return res
+        self.assertEqual([(2, False), (2, True), (6, False)],
+                         asyncio.run(run()))
+        self.assertEqual([1, 3], calls)
+
+    def test_do_shares_error(self):
+        async def func():
+            await asyncio.sleep(0.05)
+            raise ValueError('failed')
+
+        async def run():
+            single_flight = AsyncSingleFlight()
+            return await asyncio.gather(single_flight.do('a', func),
+                                        single_flight.do('a', func),
+                                        return_exceptions=True)
+        res = asyncio.run(run())
+        self.assertEqual(['failed', 'failed'], [str(x) for x in res])
+
+    def test_cancel(self):
+        cancelled = []
+
+        async def func():
+            try:
+                await asyncio.sleep(0.2)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+            return 'done'
+
+        async def run():
+            single_flight = AsyncSingleFlight()
+            first = asyncio.ensure_future(single_flight.do('a', func))
+            second = asyncio.ensure_future(single_flight.do('a', func))
+            await asyncio.sleep(0.05)
+            # call goes on while anyone still waits for it
+            first.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await first
+            self.assertEqual(('done', True), await second)
+            self.assertEqual([], cancelled)
+
+            # and is cancelled once nobody does
+            third = asyncio.ensure_future(single_flight.do('a', func))
+            await asyncio.sleep(0.05)
+            third.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await third
+            await asyncio.sleep(0)
+            self.assertEqual([True], cancelled)
+            self.assertEqual(0, single_flight.get_num_in_flight())
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
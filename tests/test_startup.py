@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_startup
+----------------------------------
+
+Guards against heavy modules being imported by invocations that
+do not run enrichment. See benchmarks/startup.py for timings.
+"""
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+from cdenrichrgenestoterm import cdenrichrgenestoterm
+from cdenrichrgenestoterm.resultcache import ResultCache
+
+
+HEAVY_MODULES = ['pandas', 'numpy', 'scipy', 'gseapy', 'requests',
+                 'matplotlib']
+
+RUN_CODE = """
+import sys
+import json
+from cdenrichrgenestoterm import cdenrichrgenestoterm
+try:
+    cdenrichrgenestoterm.main(sys.argv)
+except SystemExit:
+    pass
+with open(sys.argv[-1] + '.modules', 'w') as f:
+    json.dump(sorted(set(x.split('.')[0] for x in sys.modules)), f)
+"""
+
+
+class TestStartup(unittest.TestCase):
+
+    def get_imported_heavy_modules(self, args, temp_dir):
+        """
+        Runs command line tool with `args` in a new interpreter and
+        gets the heavy modules it imported
+        """
+        out_file = os.path.join(temp_dir, 'out')
+        env = os.environ.copy()
+        pkg_dir = os.path.dirname(os.path.dirname(
+            os.path.abspath(cdenrichrgenestoterm.__file__)))
+        env['PYTHONPATH'] = pkg_dir + os.pathsep + env.get('PYTHONPATH', '')
+        # RUN_CODE names its output file after the last argument
+        # which is passed as --tmpdir since every invocation accepts it
+        cmd = [sys.executable, '-c', RUN_CODE] + args + ['--tmpdir',
+                                                         out_file]
+        subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, check=False)
+        with open(out_file + '.modules', 'r') as f:
+            modules = json.load(f)
+        return sorted(set(modules).intersection(HEAVY_MODULES))
+
+    def test_help(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            self.assertEqual([], self.get_imported_heavy_modules(['--help'],
+                                                                 temp_dir))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_empty_input(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            tfile = os.path.join(temp_dir, 'foo')
+            open(tfile, 'a').close()
+            self.assertEqual([], self.get_imported_heavy_modules([tfile],
+                                                                 temp_dir))
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_cache_hit(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            tfile = os.path.join(temp_dir, 'foo')
+            with open(tfile, 'w') as f:
+                f.write('a,b,c')
+            cachedir = os.path.join(temp_dir, 'cache')
+            theargs = cdenrichrgenestoterm._parse_arguments('desc',
+                                                            [tfile])
+            key = cdenrichrgenestoterm.get_cache_key(['A', 'B', 'C'],
+                                                     theargs)
+            ResultCache(cachedir).store(key, {'name': 'x'})
+            res = self.get_imported_heavy_modules([tfile, '--cachedir',
+                                                   cachedir], temp_dir)
+            self.assertEqual([], res)
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+    def test_batch_cache_hit(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            tfile = os.path.join(temp_dir, 'foo')
+            with open(tfile, 'w') as f:
+                f.write('a,b,c\n')
+                f.write('{"id": "x", "genes": ["d", "e"]}\n')
+            cachedir = os.path.join(temp_dir, 'cache')
+            # local engine imports numpy, pandas and scipy on creation
+            gmtdir = os.path.join(temp_dir, 'gmt')
+            os.makedirs(gmtdir)
+            theargs = cdenrichrgenestoterm._parse_arguments(
+                'desc', [tfile, '--gmtdir', gmtdir])
+            cache = ResultCache(cachedir)
+            for genes in [['A', 'B', 'C'], ['D', 'E']]:
+                cache.store(cdenrichrgenestoterm.get_cache_key(genes,
+                                                               theargs),
+                            {'name': 'x'})
+            res = self.get_imported_heavy_modules([tfile, '--batch',
+                                                   '--gmtdir', gmtdir,
+                                                   '--cachedir',
+                                                   cachedir], temp_dir)
+            self.assertEqual([], res)
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_hierarchy_cache_hit(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            tfile = os.path.join(temp_dir, 'foo')
+            with open(tfile, 'w') as f:
+                json.dump({'communities': [{'id': 1, 'genes': 'a,b'},
+                                           {'id': 2, 'genes': 'a,b,c'}],
+                           'edges': [[2, 1]]}, f)
+            cachedir = os.path.join(temp_dir, 'cache')
+            theargs = cdenrichrgenestoterm._parse_arguments('desc',
+                                                            [tfile])
+            cache = ResultCache(cachedir)
+            for genes in [['A', 'B'], ['A', 'B', 'C']]:
+                cache.store(cdenrichrgenestoterm.get_cache_key(genes,
+                                                               theargs),
+                            {'name': 'x'})
+            res = self.get_imported_heavy_modules([tfile, '--hierarchy',
+                                                   '--cachedir',
+                                                   cachedir], temp_dir)
+            self.assertEqual([], res)
+        finally:
+            shutil.rmtree(temp_dir)
+
+if __name__ == '__main__':
+    sys.exit(unittest.main())